@@ -0,0 +1,242 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import resource
+import sys
+import tensorflow as tf
+import time
+
+from helpers.precision import get_dtype, set_precision
+from helpers.tf_utils import make_session_config, tower_devices
+from training import build_training_graph
+
+"""
+End-to-end benchmark of the SVAE training step on synthetic data. The training graph is built with
+training.build_training_graph, i.e. it is the graph trained by experiments.py (inference, ELBO, Adam step and CVI
+update; incl. top_k truncation, the SMM variant, micro-batching and towers).
+Every grid point is run in a separate process s.t. the peak memory usage (max. resident set size) is measured
+independently (and the number of logical CPU devices can be set per tower count). Runs headless on CPU.
+Grids:
+  svae:      throughput over minibatch sizes N, nb components K, latent dimensionalities L, nb samples S and data
+             dimensionalities D; for the GMM and the SMM variant
+  precision: precision policies (see helpers/precision.py)
+  towers:    scaling efficiency of data-parallel training on CPU towers. Every tower processes a minibatch of size N
+             (weak scaling): efficiency = throughput(nb_towers) / (nb_towers * throughput(fewest towers))
+
+Usage:
+  python benchmark_svae.py --output results.json
+  python benchmark_svae.py --grid precision --output results.json
+  python benchmark_svae.py --output results.json --baseline baseline.json  # flags regressions, exit code 1 if any
+"""
+
+policies = {
+    'float32': dict(default=tf.float32),
+    'nn-float16': dict(default=tf.float32, nn=tf.float16),
+    'pgm-float64': dict(default=tf.float32, pgm=tf.float64),
+    'nn-float16_pgm-float64': dict(default=tf.float32, nn=tf.float16, pgm=tf.float64),
+    'float64': dict(default=tf.float64),
+}
+
+# benchmark grids: every axis is a list of values
+AXES = ('method', 'N', 'K', 'L', 'S', 'D', 'top_k', 'nb_micro_batches', 'precision', 'nb_towers')
+default_grid = {
+    'method': ['svae-cvi-gmm'],
+    'N': [256],                # size minibatch (per tower)
+    'K': [10],                 # nb components
+    'L': [6],                  # latent dimensionality
+    'S': [10],                 # nb samples for gradient computation
+    'D': [100],                # data dimensionality
+    'top_k': [None],           # truncation of q(z|y)
+    'nb_micro_batches': [1],   # nb minibatches over which gradients are accumulated
+    'precision': ['float32'],  # precision policy (see policies)
+    'nb_towers': [1]
+}
+grids = {
+    'svae': dict(default_grid, method=['svae-cvi-gmm', 'svae-cvi-smm'], N=[64, 256], K=[5, 10, 20]),
+    'precision': dict(default_grid, precision=['float32', 'nn-float16', 'pgm-float64', 'nn-float16_pgm-float64',
+                                               'float64']),
+    'towers': dict(default_grid, N=[64], nb_towers=[1, 2, 4, 8]),
+}
+
+U = 50       # hidden units
+DoF = 5      # Student-t degrees of freedom (SMM)
+lr = 0.001   # Adam stepsize
+lrcvi = 0.1  # CVI stepsize
+
+nb_warmup_iters = 5
+nb_iters = 50
+
+tower_device_type = 'cpu'
+nb_threads_per_tower = None  # intra-op threads per tower (None: use all cores), e.g. 4 for 8 towers on 32 cores
+param_device = '/cpu:0'
+seed = 0
+
+
+def run_point(point, results):
+    set_precision(**policies[point['precision']])
+    nb_towers = point['nb_towers']
+
+    with tf.Graph().as_default(), tf.device(param_device):
+        tf.set_random_seed(seed)
+
+        # synthetic data; split across towers as in make_minibatch
+        y = tf.constant(np.random.RandomState(seed).randn(nb_towers * point['N'], point['D']),
+                        dtype=get_dtype('data'), name='y')
+        y_towers = tf.split(y, nb_towers, axis=0, num=nb_towers, name='data_split') if nb_towers > 1 else [y]
+
+        encoder_layers = [(U, tf.tanh), (U, tf.tanh), (point['L'], 'natparam')]
+        decoder_layers = [(U, tf.tanh), (U, tf.tanh), (point['D'], 'standard')]
+        config = {'method': point['method'], 'K': point['K'], 'L': point['L'], 'DoF': DoF, 'seed': seed,
+                  'top_k': point['top_k']}
+
+        opt = tf.train.AdamOptimizer(learning_rate=lr)
+        model = build_training_graph(y_towers, config, opt, lrcvi, encoder_layers, decoder_layers, 'standard',
+                                     point['S'], param_device, tower_devices(nb_towers, tower_device_type),
+                                     nb_micro_batches=point['nb_micro_batches'])
+        training_step, accumulate_step, elbo = model['training_step'], model['accumulate_step'], model['elbo']
+
+        def step():
+            # one training step (incl. the accumulation steps of the first nb_micro_batches - 1 minibatches)
+            for _ in range(point['nb_micro_batches'] - 1):
+                sess.run(accumulate_step)
+            return sess.run([training_step, elbo])[1]
+
+        sess_config = make_session_config(nb_towers, tower_device_type, nb_threads_per_tower)
+        with tf.Session(config=sess_config) as sess:
+            sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+
+            for i in range(nb_warmup_iters):
+                step()
+
+            step_times = []
+            for i in range(nb_iters):
+                start = time.time()
+                elbo_val = step()
+                step_times.append(time.time() - start)
+
+    # ru_maxrss is measured in kilobytes on Linux
+    nb_datapoints = nb_towers * point['N'] * point['nb_micro_batches']
+    results.put(dict(point, **{
+        'steps_per_sec': nb_iters / np.sum(step_times),
+        'datapoints_per_sec': nb_iters * nb_datapoints / np.sum(step_times),
+        'step_time_mean': np.mean(step_times),
+        'step_time_std': np.std(step_times),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        'elbo': float(elbo_val)
+    }))
+
+
+def point_key(result, axes=AXES):
+    return tuple(result.get(axis) for axis in axes)
+
+
+def scaling_efficiencies(table):
+    """
+    Args:
+        table: list of results
+
+    Returns:
+        list of scaling efficiencies (relative to the result with the fewest towers and otherwise the same grid point)
+    """
+    axes = tuple(axis for axis in AXES if axis != 'nb_towers')
+    base = {}
+    for result in sorted(table, key=lambda r: r['nb_towers']):
+        base.setdefault(point_key(result, axes), result['datapoints_per_sec'] / result['nb_towers'])
+    return [result['datapoints_per_sec'] / (result['nb_towers'] * base[point_key(result, axes)]) for result in table]
+
+
+def compare_to_baseline(table, baseline, tolerance):
+    """
+    Args:
+        table: list of results
+        baseline: list of baseline results (grid points missing in the baseline are skipped)
+        tolerance: relative slowdown (or memory increase) tolerated before a grid point is flagged
+
+    Returns:
+        list of (result, baseline result, list of regressed measures)
+    """
+    baseline = dict((point_key(result), result) for result in baseline)
+    comparison = []
+    for result in table:
+        if point_key(result) not in baseline:
+            continue
+        base = baseline[point_key(result)]
+        regressions = []
+        if result['datapoints_per_sec'] < (1 - tolerance) * base['datapoints_per_sec']:
+            regressions.append('throughput')
+        if result['peak_rss_mb'] > (1 + tolerance) * base['peak_rss_mb']:
+            regressions.append('memory')
+        comparison.append((result, base, regressions))
+    return comparison
+
+
+def format_point(result):
+    return '%-13s %5d %3d %3d %3d %5d %5s %3d %-22s %3d' % (
+        result['method'], result['N'], result['K'], result['L'], result['S'], result['D'], str(result['top_k']),
+        result['nb_micro_batches'], result['precision'], result['nb_towers'])
+
+
+POINT_HEADER = '%-13s %5s %3s %3s %3s %5s %5s %3s %-22s %3s' % ('method', 'N', 'K', 'L', 'S', 'D', 'top_k', 'MB',
+                                                                 'precision', 'T')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SVAE training step benchmark')
+    parser.add_argument('--grid', default='svae', choices=sorted(grids.keys()), help='benchmark grid')
+    parser.add_argument('--output', default='benchmark_svae.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', default=None, help='JSON file of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='tolerated relative regression')
+    args = parser.parse_args()
+
+    # headless: don't use (or allocate memory on) GPUs
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    grid = [dict(zip(AXES, values)) for values in itertools.product(*[grids[args.grid][axis] for axis in AXES])]
+    print('Benchmarking %d grid points (%s grid) on %s' % (len(grid), args.grid, tower_device_type))
+
+    results = multiprocessing.Queue()
+    table = []
+    for point in grid:
+        p = multiprocessing.Process(target=run_point, args=(point, results))
+        p.start()
+        p.join()
+        if p.exitcode != 0:
+            print('Grid point %s failed with exit code %d' % (str(point_key(point)), p.exitcode))
+            continue
+        table.append(results.get())
+
+    print('\n%s %12s %20s %20s %15s %12s %12s' % (POINT_HEADER, 'steps/sec', 'datapoints/sec', 'step time [ms]',
+                                                 'peak RSS [MB]', 'efficiency', 'final ELBO'))
+    for result, efficiency in zip(table, scaling_efficiencies(table)):
+        print('%s %12.2f %20.1f %12.2f +- %5.2f %15.1f %12.2f %12.2f' % (
+            format_point(result), result['steps_per_sec'], result['datapoints_per_sec'],
+            1000 * result['step_time_mean'], 1000 * result['step_time_std'], result['peak_rss_mb'], efficiency,
+            result['elbo']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'grid': args.grid, 'nb_iters': nb_iters, 'nb_warmup_iters': nb_warmup_iters, 'U': U,
+                   'results': table}, f, indent=2, sort_keys=True)
+    print('\nResults written to %s' % args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        comparison = compare_to_baseline(table, baseline, args.tolerance)
+        print('\nComparison to %s (tolerance %.0f%%)' % (args.baseline, 100 * args.tolerance))
+        print('%s %18s %18s  %s' % (POINT_HEADER, 'throughput ratio', 'peak RSS ratio', 'regression'))
+        for result, base, regressions in comparison:
+            print('%s %18.3f %18.3f  %s' % (format_point(result),
+                                            result['datapoints_per_sec'] / base['datapoints_per_sec'],
+                                            result['peak_rss_mb'] / base['peak_rss_mb'], ', '.join(regressions)))
+
+        nb_regressions = sum(1 for _, _, regressions in comparison if regressions)
+        if nb_regressions > 0:
+            print('\n%d of %d grid points regressed' % (nb_regressions, len(comparison)))
+            sys.exit(1)
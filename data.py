@@ -18,7 +18,7 @@ def make_minibatch(dataset, ratio_tr=None, ratio_val=None, binarise=False, path_
             # data = mnist.input_data.read_data_sets(path_datadir + '/' + dataset, one_hot=False)
             filename_queue_tr = tf.train.string_input_producer(
                 [path_datadir + '/' + dataset + '_new/train.tfrecords'])
-            X_tr, y_tr = read_from_tfrec_file(filename_queue_tr, 784, binarise=binarise)
+            X_tr, y_tr = read_from_tfrec_file(filename_queue_tr, 784, binarise=binarise, dtype=dtype)
 
             if ratio_val is None:
                 filename_queue_te = tf.train.string_input_producer(
@@ -26,7 +26,7 @@ def make_minibatch(dataset, ratio_tr=None, ratio_val=None, binarise=False, path_
             else:
                 filename_queue_te = tf.train.string_input_producer(
                     [path_datadir + '/' + dataset + '_new/validation.tfrecords'])
-            X_te, y_te = read_from_tfrec_file(filename_queue_te, 784, binarise=binarise)
+            X_te, y_te = read_from_tfrec_file(filename_queue_te, 784, binarise=binarise, dtype=dtype)
 
             # transform labels to one-hot-vectors
             nb_classes = 10
@@ -180,7 +180,7 @@ def make_minibatch(dataset, ratio_tr=None, ratio_val=None, binarise=False, path_
         return m_batch, m_batch_lbl, m_batch_te, m_batch_te_lbl
 
 
-def read_from_tfrec_file(filename_q, D, binarise=False, seed=0):
+def read_from_tfrec_file(filename_q, D, binarise=False, seed=0, dtype=tf.float32):
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(filename_q)
     features = tf.parse_single_example(
@@ -197,7 +197,7 @@ def read_from_tfrec_file(filename_q, D, binarise=False, seed=0):
     image.set_shape([D])
 
     # Convert from [0, 255] -> [-0.5, 0.5] floats.
-    image = tf.cast(image, tf.float32) * (1. / 255)
+    image = tf.cast(image, dtype) * (1. / 255)
 
     # Convert from [0, 1] to {-1, 1} if required
     if binarise:
@@ -206,8 +206,8 @@ def read_from_tfrec_file(filename_q, D, binarise=False, seed=0):
         probs = tf.concat([1. - image, image], axis=1)
         samps = tf.reshape(tf.multinomial(logits=tf.log(probs), num_samples=1, seed=seed), (D,))
         image = tf.where(tf.equal(samps, 0),
-                         -tf.ones_like(samps, dtype=tf.float32),
-                         tf.ones_like(samps, dtype=tf.float32))
+                         -tf.ones_like(samps, dtype=dtype),
+                         tf.ones_like(samps, dtype=dtype))
         # thresholding
         # image = tf.where(image < 0.5, -tf.ones_like(image, dtype=tf.float32), tf.ones_like(image, dtype=tf.float32))
 
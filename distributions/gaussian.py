@@ -58,7 +58,7 @@ def log_probability_nat(x, eta1, eta2, weights=None):
         logprob += 1./4 * tf.einsum('nkdi,nkdi->nk', tf.matrix_solve(eta2, eta1, name='mu'), eta1)
 
         # logprob += 0.5 * tf.log(tf.matrix_determinant(-2. * eta2 + 1e-20 * tf.eye(D)))  # todo this is nummerically NOT stable!!
-        logprob += 0.5 * logdet(-2. * eta2 + 1e-20 * tf.eye(D))
+        logprob += 0.5 * logdet(-2. * eta2 + 1e-20 * tf.eye(D, dtype=eta2.dtype))
 
         if weights is not None:
             logprob += tf.expand_dims(tf.log(weights), axis=0, name='component_weighting')
@@ -97,10 +97,60 @@ def log_probability_nat_per_samp(x_samps, eta1, eta2):
 
         # 1/4 (-2 * sigma * (sigma^(-1) * mu)) sigma^(-1) * mu = -1/2 mu sigma^(-1) mu; shape = N, K, 1
         log_normal += 1.0 / 4 * tf.einsum('nkdi,nkd->nki', tf.matrix_solve(eta2, tf.expand_dims(eta1, axis=-1)), eta1)
-        log_normal -= D/2. * tf.constant(np.log(2 * np.pi), dtype=tf.float32, name='log2pi')
+        log_normal -= D/2. * tf.constant(np.log(2 * np.pi), dtype=x_samps.dtype, name='log2pi')
 
         # + 1/2 log |sigma^(-1)|
-        log_normal += 1.0 / 2 * tf.expand_dims(logdet(-2.0 * eta2 + 1e-20 * tf.eye(D)), axis=2)
+        log_normal += 1.0 / 2 * tf.expand_dims(logdet(-2.0 * eta2 + 1e-20 * tf.eye(D, dtype=eta2.dtype)), axis=2)
 
         return log_normal
 
+
+def log_probability_nat_per_comp(x_samps, eta1, eta2, comp_idx=None):
+    """
+    Same as log_probability_nat_per_samp, but for parameters that are shared across data points. All work which only
+    depends on the component k (Cholesky factorisation, mean, log-determinant and normalisation constant) is done once
+    per component; with inv_sigma = C C^T, the per-sample term is (x - mu)^T inv_sigma (x - mu) = |C^T (x - mu)|^2.
+        Args:
+            x_samps: matrix of shape (minibatch_size, nb_components, nb_samps, latent_dims); if comp_idx is passed,
+                     the 2nd axis refers to the components comp_idx[n] of each data point
+            eta1: 1st natural parameter for Gaussian distr; shape: (nb_components, latent_dim)
+            eta2: 2nd natural parameter for Gaussian distr; shape: (nb_components, latent_dim, latent_dim)
+            comp_idx: None or indices of the components evaluated for each data point; shape (minibatch_size, T)
+
+        Returns:
+            log N(x^(s)|eta1, eta2) of shape (N, K, S) (or (N, T, S))
+        """
+    N, K, S, D = x_samps.get_shape().as_list()
+    K_, D_ = eta1.get_shape().as_list()
+    assert D_ == D
+    assert eta2.get_shape() == (K_, D, D)
+    if comp_idx is None:
+        assert K_ == K
+    else:
+        assert comp_idx.get_shape() == (N, K)
+
+    with tf.name_scope('log_prob_per_comp'):
+
+        # precompute everything that only depends on k
+        with tf.name_scope('per_component'):
+            chol_prec = tf.cholesky(-2. * eta2, name='chol_prec')  # shape = K, D, D
+            mu = tf.reshape(tf.cholesky_solve(chol_prec, tf.expand_dims(eta1, axis=-1)), (K_, D), name='mu')
+
+            # 1/2 log |sigma^(-1)| - D/2 log(2 pi); shape = K
+            log_norm = tf.reduce_sum(tf.log(tf.matrix_diag_part(chol_prec)), axis=-1)
+            log_norm -= D/2. * tf.constant(np.log(2 * np.pi), dtype=eta2.dtype, name='log2pi')
+
+        if comp_idx is None:
+            # move component axis to the front to use a single batched matmul per component; shape = K, N*S, D
+            err = x_samps - tf.reshape(mu, (1, K, 1, D))
+            err = tf.reshape(tf.transpose(err, [1, 0, 2, 3]), (K, N * S, D))
+            mahalanobis_sqr_d = tf.reduce_sum(tf.square(tf.matmul(err, chol_prec)), axis=-1)
+            mahalanobis_sqr_d = tf.transpose(tf.reshape(mahalanobis_sqr_d, (K, N, S)), [1, 0, 2])  # shape = N, K, S
+            log_norm = tf.reshape(log_norm, (1, K, 1))
+        else:
+            # select the precomputed quantities of the components evaluated for each data point
+            err = x_samps - tf.expand_dims(tf.gather(mu, comp_idx), axis=2)                       # shape = N, T, S, D
+            mahalanobis_sqr_d = tf.reduce_sum(tf.square(tf.matmul(err, tf.gather(chol_prec, comp_idx))), axis=-1)
+            log_norm = tf.expand_dims(tf.gather(log_norm, comp_idx), axis=2)
+
+        return tf.subtract(log_norm, 0.5 * mahalanobis_sqr_d, name='log_normal')
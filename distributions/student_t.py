@@ -1,17 +1,19 @@
 import tensorflow as tf
 import numpy as np
 
-from helpers.tf_utils import logdet
 
-
-def _logprob_full_scale(y, mu, sigma, v, name='student_t_logprob'):
+def _logprob_full_scale(y, mu, sigma, v, comp_idx=None, name='student_t_logprob'):
     """
-    Computes Student-t log-probability with full scale matrix sigma
+    Computes Student-t log-probability with full scale matrix sigma. Each of the K scale matrices is factorised once
+    (sigma = C C^T); the Mahalanobis distances are computed with triangular solves against all samples at once, so
+    neither mu nor sigma is tiled over data points and samples.
     Args:
-        y: data tensor; shape = N, K, S, D
+        y: data tensor; shape = N, K, S, D (or N, 1, S, D to evaluate each y under all K components); if comp_idx is
+           passed, the 2nd axis refers to the components comp_idx[n] of each data point
         mu: means; shape = K, D
         sigma: scale matrices; shape = K, D, D
         v: degree of freedom; shape = K
+        comp_idx: None or indices of the components evaluated for each data point; shape = N, T
         name: operation name
 
     Returns:
@@ -19,21 +21,43 @@ def _logprob_full_scale(y, mu, sigma, v, name='student_t_logprob'):
     """
     with tf.name_scope(name):
 
-        N, K, S, D = y.get_shape().as_list()
-        assert mu.get_shape() == (K, D)
+        N, K_y, S, D = y.get_shape().as_list()
+        K, D_ = mu.get_shape().as_list()
+        assert D_ == D
         assert sigma.get_shape() == (K, D, D)
         assert v.get_shape() == K
-        mu = tf.tile(tf.expand_dims(tf.expand_dims(mu, axis=0), axis=2), (N, 1, S, 1))
-        sigma = tf.tile(tf.expand_dims(tf.expand_dims(sigma, axis=0), axis=2), (N, 1, S, 1, 1))
-        v = tf.expand_dims(tf.expand_dims(v, axis=0), axis=2)
 
+        # factorise scale matrices once per component; log|sigma| = 2 * SUM^D log(C_dd)
+        chol_sigma = tf.cholesky(sigma, name='chol_sigma')                                     # shape = K, D, D
+        logdet_sigma = 2. * tf.reduce_sum(tf.log(tf.matrix_diag_part(chol_sigma)), axis=-1)   # shape = K
+
+        if comp_idx is None:
+            assert K_y == K or K_y == 1
+            err = y - tf.reshape(mu, (1, K, 1, D))                                             # shape = N, K, S, D
+
+            # solve C * a = err for all samples of a component at once: (K, D, N*S) right-hand sides
+            err = tf.reshape(tf.transpose(err, [1, 3, 0, 2]), (K, D, N * S))
+            half_solved = tf.matrix_triangular_solve(chol_sigma, err, lower=True)
+            mahalanobis_sqr_d = tf.reshape(tf.reduce_sum(tf.square(half_solved), axis=1), (K, N, S))
+            mahalanobis_sqr_d = tf.transpose(mahalanobis_sqr_d, [1, 0, 2])                     # shape = N, K, S
+
+            logdet_sigma = tf.reshape(logdet_sigma, (1, K, 1))
+            v = tf.reshape(v, (1, K, 1))
+        else:
+            assert comp_idx.get_shape() == (N, K_y)
+            err = y - tf.expand_dims(tf.gather(mu, comp_idx), axis=2)                         # shape = N, T, S, D
+
+            # only the factors of the evaluated components are gathered; shape = N, T, D, D
+            half_solved = tf.matrix_triangular_solve(tf.gather(chol_sigma, comp_idx), tf.matrix_transpose(err),
+                                                     lower=True)
+            mahalanobis_sqr_d = tf.reduce_sum(tf.square(half_solved), axis=2)                 # shape = N, T, S
 
-        err = tf.expand_dims(y - mu, axis=-1)  # shape = N, K, S, D, 1
-        mahalanobis_sqr_d = tf.einsum('nksdi,nksdi->nks', err, tf.matrix_solve(sigma, err))  # shape = N, K, S
+            logdet_sigma = tf.expand_dims(tf.gather(logdet_sigma, comp_idx), axis=2)
+            v = tf.expand_dims(tf.gather(v, comp_idx), axis=2)
 
         logprob = tf.lgamma(0.5 * (v + D)) - tf.lgamma(0.5 * v)            # shape = 1, K, 1
-        logprob -= 0.5 * D * tf.log(tf.constant(np.pi, name='pi') * v)     # shape = 1, K, 1
-        logprob -= 0.5 * logdet(sigma)                                     # shape = N, K, S
+        logprob -= 0.5 * D * tf.log(tf.constant(np.pi, dtype=v.dtype, name='pi') * v)     # shape = 1, K, 1
+        logprob -= 0.5 * logdet_sigma                                      # shape = 1, K, 1
         logprob -= 0.5 * (v + D) * (tf.log1p(mahalanobis_sqr_d/v))         # important to use log1p for num. stability
 
         return tf.identity(logprob, name='logprob')
@@ -45,7 +69,7 @@ def logprob_smm_mixture(y, mu, sigma, v, log_pi, name='student_t_logprob'):
         N, D = y.get_shape().as_list()
         K, D_ = mu.get_shape().as_list()
         assert D_ == D                                                   # shape = N, D
-        y = tf.tile(tf.expand_dims(tf.expand_dims(y, axis=1), axis=2), (1, K, 1, 1))  # shape = N, K, 1, D
+        y = tf.expand_dims(tf.expand_dims(y, axis=1), axis=2)            # shape = N, 1, 1, D
 
         logprob = _logprob_full_scale(y, mu, sigma, v)
         logprob = tf.reshape(logprob, (N, K))                                         # shape = N, K
@@ -56,6 +80,6 @@ def logprob_smm_mixture(y, mu, sigma, v, log_pi, name='student_t_logprob'):
         return tf.identity(logprob, name='logprob')
 
 
-def log_probability_per_samp(y, mu, sigma, v, name='student_t_logprob_per_samp'):
+def log_probability_per_samp(y, mu, sigma, v, comp_idx=None, name='student_t_logprob_per_samp'):
     with tf.name_scope(name):
-        return _logprob_full_scale(y, mu, sigma, v, name='logprob_per_samp')
+        return _logprob_full_scale(y, mu, sigma, v, comp_idx=comp_idx, name='logprob_per_samp')
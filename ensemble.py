@@ -0,0 +1,208 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tensorflow as tf
+import time
+
+from data import make_minibatch
+from evaluation import EVAL_CHECKPOINT_DIR, save_eval_settings
+from helpers.logging_utils import generate_log_id
+from helpers.precision import get_dtype, get_policy, set_precision
+from losses import weighted_mse, diagonal_gaussian_logprob, bernoulli_logprob
+from training import build_training_graph
+
+"""
+Multi-seed ensemble training: R replicas of the SVAE (one per seed) are built in one graph and trained in lockstep, i.e.
+every sess.run executes the training steps of all replicas. The replicas are independent subgraphs (own variables,
+Adam optimizer and CVI update of theta), s.t. TF runs them concurrently on the inter-op thread pool; this fills the
+cores which a single run with a small minibatch leaves idle.
+The model and its training step are built as in experiments.py (see training.build_training_graph); every replica has
+its own input pipeline, shuffled with the replica's seed.
+
+Replica r's variables live in the variable scope replica_<r>, but its checkpoints use the variable names of a single
+run; thus, a seed's log directory (log_dir/<generate_log_id(config)>) can be evaluated by the evaluation worker
+(python evaluation.py <log_path>) as any other run. The graph-level random seed (and thus the sampling noise) differs
+from a single run with the same seed, hence the ensemble logs to its own log_dir instead of the single runs' one.
+"""
+
+# global settings (as in experiments.py)
+path_dataset = 'datasets'
+ratio_tr = 0.7
+ratio_val = None
+size_minibatch = 100  # per replica
+size_testbatch = -100
+seed_data = 0
+
+nb_samples = 10
+nb_samples_te = 100
+size_eval_chunk = 500
+nb_sample_chunks_te = 1
+nb_samples_pert = 20
+nb_chunks_pert = 1
+ratio_missing_data = 0.1
+
+nb_iters = 20000
+measurement_freq = 500
+imputation_freq = 25000
+checkpoint_freq = 5000
+
+device = '/cpu:0'
+async_evaluation = True  # start an evaluation worker per seed (see evaluation.py)
+eval_device = '/cpu:0'
+nb_eval_checkpoints = 5  # evaluation checkpoints (every measurement_freq/imputation_freq iterations) kept per seed
+
+nb_threads = 2  # for input queue
+log_dir = 'logs_svae_ensemble'  # not shared with single runs (see above)
+precision = dict(default=tf.float32)
+
+# base config; the ensemble consists of one replica per seed
+config = {
+    'dataset': 'pinwheel',
+    'method': 'svae-cvi-smm',
+    'lr': 0.01,
+    'lrcvi': 0.1,
+    'decay_rate': 1,
+    'delay': 0,
+    'K': 10,
+    'L': 2,
+    'U': 40,
+    'DoF': 5,
+}
+seeds = range(10)
+
+###################################################################################################################
+
+set_precision(**precision)
+configs = [dict(config, seed=seed) for seed in seeds]
+nb_replicas = len(configs)
+print('Training an ensemble of %d replicas of\n%s\n' % (nb_replicas, str(config)))
+
+with tf.Graph().as_default(), tf.device(device):
+    tf.set_random_seed(0)
+
+    binarise_data = config['dataset'] in ['mnist', 'mnist-small']
+    decoder_type = 'bernoulli' if binarise_data else 'standard'
+
+    with tf.name_scope('learning_rate'):
+        global_step = tf.get_variable('global_step', [], initializer=tf.constant_initializer(0), trainable=False)
+        lrcvi = tf.train.exponential_decay(config['lrcvi'], global_step, 1000, config.get('decay_rate', 1),
+                                           staircase=False)
+
+    replica_steps = []
+    replica_summaries = []
+    replica_savers = []
+    replica_eval_savers = []
+    for replica_id, replica_config in enumerate(configs):
+        with tf.variable_scope('replica_%d' % replica_id) as replica_scope:
+            # own input pipeline, shuffled with the replica's seed (as a single run)
+            y, _, y_te, _ = make_minibatch(config['dataset'], ratio_tr=ratio_tr, ratio_val=ratio_val,
+                                           path_datadir=path_dataset, size_minibatch=size_minibatch,
+                                           size_testbatch=size_testbatch, nb_threads=nb_threads, seed_split=seed_data,
+                                           binarise=binarise_data, seed_minibatch=replica_config['seed'],
+                                           dtype=get_dtype('data'), noise_level=config.get('noise_level', 0))
+
+            encoder_layers = [(config['U'], tf.tanh), (config['U'], tf.tanh), (config['L'], 'natparam')]
+            decoder_layers = [(config['U'], tf.tanh), (config['U'], tf.tanh), (int(y_te.get_shape()[1]), decoder_type)]
+
+            opt = tf.train.AdamOptimizer(learning_rate=config['lr'], use_locking=True)
+            model = build_training_graph([y], replica_config, opt, lrcvi, encoder_layers, decoder_layers,
+                                         decoder_type, nb_samples, device, [device])
+            replica_steps.append(model['training_step'])
+
+            # training performance of this replica
+            with tf.name_scope('perf_measures'):
+                log_z_given_y_phi, details = model['log_z_given_y_phi'], model['details']
+                y_k_mean_rec, out2_rec = model['y_mean_rec'], model['out2_rec']
+                neg_normed_elbo = -tf.divide(model['elbo'], size_minibatch)
+                if decoder_type == 'bernoulli':
+                    y_01 = tf.where(tf.equal(y, -1), tf.zeros_like(y), tf.ones_like(y))
+                    loli_tr = bernoulli_logprob(y, out2_rec, log_z_given_y_phi)
+                else:
+                    y_01 = y
+                    loli_tr = diagonal_gaussian_logprob(y, y_k_mean_rec, out2_rec, log_z_given_y_phi)
+                mse_tr = weighted_mse(y_01, y_k_mean_rec, tf.exp(log_z_given_y_phi))
+                replica_summaries.append(tf.summary.merge([
+                    tf.summary.scalar('elbo/elbo_normed', neg_normed_elbo, collections=[]),
+                    tf.summary.scalar('elbo/neg_rec_err', tf.divide(details[0], size_minibatch), collections=[]),
+                    tf.summary.scalar('elbo/regularizer', tf.divide(details[3], size_minibatch), collections=[]),
+                    tf.summary.scalar('mse_tr', mse_tr, collections=[]),
+                    tf.summary.scalar('loli_tr', loli_tr, collections=[]),
+                    tf.summary.scalar('learning_rate_cvi', lrcvi, collections=[])
+                ]))
+
+        # checkpoints use the variable names of a single run (strip the replica scope)
+        replica_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=replica_scope.name + '/')
+        var_list = dict((v.op.name[len(replica_scope.name) + 1:], v) for v in replica_vars)
+        var_list[global_step.op.name] = global_step
+        replica_savers.append(tf.train.Saver(var_list, max_to_keep=nb_iters // checkpoint_freq + 2))
+        replica_eval_savers.append(tf.train.Saver(var_list, max_to_keep=nb_eval_checkpoints))
+
+    with tf.control_dependencies(replica_steps):
+        training_step = tf.assign_add(global_step, 1, name='training_ops')
+
+    # one log directory per seed (in the ensemble's log_dir)
+    log_paths = [log_dir + '/' + generate_log_id(replica_config) for replica_config in configs]
+    for log_path in log_paths:
+        if not os.path.exists(os.path.join(log_path, EVAL_CHECKPOINT_DIR)):
+            os.makedirs(os.path.join(log_path, EVAL_CHECKPOINT_DIR))
+    summary_writers = [tf.summary.FileWriter(log_path) for log_path in log_paths]
+
+    sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+    sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+
+    eval_workers = []
+    if async_evaluation:
+        eval_env = dict(os.environ)
+        if 'cpu' in eval_device:
+            eval_env['CUDA_VISIBLE_DEVICES'] = ''
+        for replica_config, log_path in zip(configs, log_paths):
+            save_eval_settings(log_path, replica_config, get_policy(), path_dataset=path_dataset, ratio_tr=ratio_tr,
+                               ratio_val=ratio_val, size_testbatch=size_testbatch, seed_data=seed_data,
+                               nb_samples_te=nb_samples_te, nb_samples_pert=nb_samples_pert,
+                               ratio_missing_data=ratio_missing_data, size_eval_chunk=size_eval_chunk,
+                               nb_sample_chunks_te=nb_sample_chunks_te, nb_chunks_pert=nb_chunks_pert,
+                               imputation_freq=imputation_freq, nb_iters=nb_iters, eval_device=eval_device)
+            eval_workers.append(subprocess.Popen([sys.executable,
+                                                  os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               'evaluation.py'), log_path], env=eval_env))
+
+    start_time = time.time()
+    try:
+        for i in range(nb_iters):
+            if i % measurement_freq == 0 or i == nb_iters - 1:
+                _, summaries = sess.run([training_step, replica_summaries])
+                for summary_writer, summary in zip(summary_writers, summaries):
+                    summary_writer.add_summary(summary, global_step=i)
+                print('Iteration %5d\t\t%.4fsec' % (i, time.time() - start_time))
+            else:
+                sess.run(training_step)
+
+            if i % checkpoint_freq == 0 or i == nb_iters - 1:
+                for saver, log_path in zip(replica_savers, log_paths):
+                    saver.save(sess, log_path + '/checkpoint', global_step=i)
+
+            # evaluation checkpoints (on the measurement cadence) for the evaluation workers
+            if async_evaluation and (i % measurement_freq == 0 or i % imputation_freq == 0 or i == nb_iters - 1):
+                for eval_saver, log_path in zip(replica_eval_savers, log_paths):
+                    eval_saver.save(sess, os.path.join(log_path, EVAL_CHECKPOINT_DIR, 'checkpoint'), global_step=i)
+
+    finally:
+        print('Iteration %i; Done with ensemble of %d seeds' % (i, nb_replicas))
+        for summary_writer in summary_writers:
+            summary_writer.flush()
+            summary_writer.close()
+        coord.request_stop()
+        coord.join(threads)
+        sess.close()
+
+        for eval_worker in eval_workers:
+            if i == nb_iters - 1:
+                eval_worker.wait()
+            else:
+                eval_worker.terminate()
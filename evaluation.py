@@ -0,0 +1,333 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import pickle
+import sys
+import tensorflow as tf
+import time
+
+from data import make_minibatch
+from helpers.precision import get_dtype, set_precision
+from losses import weighted_mse, streaming_diagonal_gaussian_logprob, streaming_bernoulli_logprob, \
+    imputation_losses, generate_missing_data_mask, cluster_class_counts, purity_from_counts
+from models import svae
+
+"""
+Out-of-process evaluation of SVAE training runs.
+The evaluation worker watches the evaluation checkpoints of a run (<log_path>/eval_checkpoints, saved on the
+measurement cadence), restores the latest weights into an eval-only graph and writes the test performance summaries
+(mse_te, loli_te, purity_te, ...) to the run's log directory, tagged with the checkpoint's step. The imputation measures
+(imp_mse, imp_logprob) are only computed once per imputation_freq iterations (for the first evaluated checkpoint at or
+after every imputation_freq-th iteration) and for the last iteration. Checkpoints which the training run deleted
+before they were evaluated are skipped.
+The test set is processed in chunks of size_eval_chunk data points.
+Started by experiments.py (async_evaluation=True) with
+  python evaluation.py <log_path>
+where <log_path>/eval_settings.pkl contains the run's config and evaluation settings (see save_eval_settings).
+"""
+
+EVAL_SETTINGS_FILE = 'eval_settings.pkl'
+EVAL_CHECKPOINT_DIR = 'eval_checkpoints'  # subdirectory of the run's log directory
+COMPLETED_FILE = 'completed'  # written by the training run after its last checkpoint (also if stopped early)
+
+
+def save_eval_settings(log_path, config, precision, **settings):
+    """
+    Saves everything the evaluation worker needs to rebuild the model.
+    Args:
+        log_path: log directory of the run (where checkpoints are saved)
+        config: experiment config
+        precision: precision policy (dict subsystem -> dtype, see helpers.precision.get_policy)
+        **settings: path_dataset, ratio_tr, ratio_val, size_testbatch, seed_data, nb_samples_te, nb_samples_pert,
+            ratio_missing_data, size_eval_chunk, nb_sample_chunks_te, nb_chunks_pert, imputation_freq, nb_iters and
+            eval_device
+    """
+    # dtypes are stored by name
+    settings['precision'] = dict((subsystem, tf.as_dtype(dtype).name) for subsystem, dtype in precision.items())
+    settings['config'] = config
+    with open(os.path.join(log_path, EVAL_SETTINGS_FILE), 'wb') as f:
+        pickle.dump(settings, f)
+
+
+def build_chunk_measures(y, y_01, lbl, missing_data_mask, phi_gmm, encoder_layers, decoder_layers, decoder_type,
+                         nb_samples_te, nb_samples_pert, seed=0, top_k=None, nb_sample_chunks_te=1, nb_chunks_pert=1):
+    """
+    Builds test performance measures (same as the inline measures in experiments.py) for a chunk of the test set.
+    Args:
+        y: test data chunk
+        y_01: test data chunk in [0, 1] (for MSE computation in bernoulli case)
+        lbl: labels of the chunk (one-hot) or None
+        missing_data_mask: mask of the chunk's missing values (imputation)
+        phi_gmm: recognition GMM parameters
+        encoder_layers: encoder NN architecture
+        decoder_layers: decoder NN architecture
+        decoder_type: 'standard' or 'bernoulli'
+        nb_samples_te: number of samples for test inference
+        nb_samples_pert: number of perturbed samples per test data point (imputation)
+        seed: random seed
+        top_k: if not None, only the top_k components of q(z|y) are kept
+        nb_sample_chunks_te: the test loglikelihood is estimated with nb_sample_chunks_te * nb_samples_te samples
+            (streamed in chunks of nb_samples_te samples)
+        nb_chunks_pert: the perturbed samples are imputed in nb_chunks_pert chunks
+
+    Returns:
+        dict of measures averaged over the chunk's data points (and cluster-class counts N_kc summed over the chunk
+        if labels are available)
+    """
+    measures = {}
+    with tf.name_scope('test_performance'):
+        (y_k_rec, _, _, _, log_r_nk, _, _, _, comp_idx) = svae.inference(y, phi_gmm, encoder_layers, decoder_layers,
+                                                                         nb_samples_te, seed=seed,
+                                                                         name='test_inference', top_k=top_k)
+        y_k_mean_rec, out2_rec = y_k_rec
+
+        # draws another chunk of samples for the loglikelihood estimate (different seed than the first chunk)
+        def sample_chunk():
+            tf.get_variable_scope().reuse_variables()
+            ((y_k_mean_chunk, out2_chunk), _, _, _, log_r_nk_chunk, _, _, _, _) = \
+                svae.inference(y, phi_gmm, encoder_layers, decoder_layers, nb_samples_te, seed=seed + 1,
+                               name='test_inference_chunk', top_k=top_k)
+            return y_k_mean_chunk, out2_chunk, log_r_nk_chunk
+
+        with tf.name_scope('perf_measures'):
+            measures['mse_te'] = weighted_mse(y_01, y_k_mean_rec, tf.exp(log_r_nk))
+            if decoder_type == 'bernoulli':
+                measures['loli_te'] = streaming_bernoulli_logprob(y, out2_rec, log_r_nk,
+                                                                  lambda: sample_chunk()[1:], nb_sample_chunks_te)
+            else:
+                measures['loli_te'] = streaming_diagonal_gaussian_logprob(y, y_k_mean_rec, out2_rec, log_r_nk,
+                                                                          sample_chunk, nb_sample_chunks_te)
+            if lbl is not None:
+                if top_k is None:
+                    r_nk = tf.exp(log_r_nk)
+                else:
+                    r_nk = svae.scatter_responsibilities(tf.exp(log_r_nk), comp_idx,
+                                                         phi_gmm[0].get_shape().as_list()[0])
+                measures['N_kc'] = cluster_class_counts(r_nk, lbl)
+
+    with tf.name_scope('test_imputation'):
+        # define imputation graph for SVAE
+        def impute(y_perturbed, chunk_seed):
+            with tf.name_scope('missing_data_imputation'):
+                tf.get_variable_scope().reuse_variables()
+                ((y_k_mean_imp, out2_imp), _, _, _, log_r_nk_imp, _, _, _, _) = \
+                    svae.inference(y_perturbed, phi_gmm, encoder_layers, decoder_layers, nb_samples_te,
+                                   seed=chunk_seed, name='test_inference', top_k=top_k)
+                return y_k_mean_imp, out2_imp, log_r_nk_imp
+
+        measures['imp_mse'], measures['imp_logprob'] = imputation_losses(y, missing_data_mask, impute,
+                                                                         nb_samples_pert, nb_samples_te,
+                                                                         decoder_type=decoder_type, seed=seed,
+                                                                         nb_chunks_pert=nb_chunks_pert)
+
+    return measures
+
+
+def build_streaming_evaluation(y_te, y_te_01, lbl_te, phi_gmm, encoder_layers, decoder_layers, decoder_type,
+                               nb_samples_te, nb_samples_pert, ratio_missing_data, size_chunk, seed=0, top_k=None,
+                               nb_sample_chunks_te=1, nb_chunks_pert=1, name='streaming_evaluation'):
+    """
+    Evaluates the test set in chunks of size_chunk data points s.t. the memory usage is bounded by the chunk size
+    (instead of the test set size). The measures of every chunk are added to accumulators; the summaries report
+    the accumulated measures of the entire test set.
+    Usage: run reset_op, run update_ops[size] (and imputation_update_ops[size]) feeding chunk_start=start for each
+    (start, size) in chunks, then run the summaries (and imputation_summaries), see evaluate_test_set.
+    Args:
+        y_te: entire test set; shape = N, D
+        y_te_01: test set in [0, 1]
+        lbl_te: test labels (one-hot) or None
+        size_chunk: number of data points per chunk
+        (remaining args: see build_chunk_measures)
+
+    Returns:
+        dict containing chunk_start (placeholder), chunks (list of (start, size) tuples), update_ops and
+        imputation_update_ops (one per chunk size), reset_op, summaries and imputation_summaries
+    """
+    N, D = y_te.get_shape().as_list()
+    size_chunk = min(size_chunk, N)
+
+    # the last chunk is smaller if size_chunk doesn't divide N; a graph is built for every distinct chunk size
+    chunks = [(start, min(size_chunk, N - start)) for start in range(0, N, size_chunk)]
+
+    with tf.name_scope(name):
+        # mask is random, but constant for entire run.
+        missing_data_mask = generate_missing_data_mask(y_te, ratio_missing_data, seed=seed)
+
+        chunk_start = tf.placeholder(tf.int32, shape=(), name='chunk_start')
+
+        # accumulated sums over all data points
+        dtype = get_dtype('loss')
+        acc_names = ['mse_te', 'loli_te']
+        imp_acc_names = ['imp_mse', 'imp_logprob']
+        accumulators = dict((acc_name, tf.Variable(tf.zeros((), dtype=dtype), trainable=False,
+                                                   collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                                   name='acc_' + acc_name))
+                            for acc_name in acc_names + imp_acc_names)
+        if lbl_te is not None:
+            K = phi_gmm[0].get_shape().as_list()[0]
+            C = lbl_te.get_shape().as_list()[1]
+            accumulators['N_kc'] = tf.Variable(tf.zeros((K, C), dtype=dtype), trainable=False,
+                                               collections=[tf.GraphKeys.LOCAL_VARIABLES], name='acc_N_kc')
+
+        update_ops = {}
+        imputation_update_ops = {}
+        for size in sorted(set(size for _, size in chunks), reverse=True):
+            with tf.name_scope('chunk_%d' % size):
+                def get_chunk(tensor):
+                    return tf.slice(tensor, [chunk_start, 0], [size, int(tensor.get_shape()[1])])
+
+                lbl = get_chunk(lbl_te) if lbl_te is not None else None
+                measures = build_chunk_measures(get_chunk(y_te), get_chunk(y_te_01), lbl,
+                                                get_chunk(missing_data_mask), phi_gmm, encoder_layers,
+                                                decoder_layers, decoder_type, nb_samples_te, nb_samples_pert, seed,
+                                                top_k, nb_sample_chunks_te, nb_chunks_pert)
+                # the graphs of all chunk sizes share the model parameters
+                tf.get_variable_scope().reuse_variables()
+
+                # measures are averages over the chunk's data points; accumulate sums
+                updates = [tf.assign_add(accumulators[acc_name], size * measures[acc_name])
+                           for acc_name in acc_names]
+                if lbl_te is not None:
+                    updates.append(tf.assign_add(accumulators['N_kc'], measures['N_kc']))
+                update_ops[size] = tf.group(*updates, name='update_accumulators')
+                imputation_update_ops[size] = tf.group(*[tf.assign_add(accumulators[acc_name],
+                                                                       size * measures[acc_name])
+                                                         for acc_name in imp_acc_names],
+                                                       name='update_imputation_accumulators')
+
+        reset_op = tf.variables_initializer(list(accumulators.values()), name='reset_accumulators')
+
+        summaries = [tf.summary.scalar(acc_name, tf.divide(accumulators[acc_name], N), collections=[])
+                     for acc_name in acc_names]
+        if lbl_te is not None:
+            entr_te, prty_te = purity_from_counts(accumulators['N_kc'])
+            summaries.append(tf.summary.scalar('entropy_te', entr_te, collections=[]))
+            summaries.append(tf.summary.scalar('purity_te', prty_te, collections=[]))
+        imputation_summaries = [tf.summary.scalar(acc_name, tf.divide(accumulators[acc_name], N), collections=[])
+                                for acc_name in imp_acc_names]
+
+    return {'chunk_start': chunk_start, 'chunks': chunks, 'update_ops': update_ops,
+            'imputation_update_ops': imputation_update_ops, 'reset_op': reset_op, 'summaries': summaries,
+            'imputation_summaries': imputation_summaries}
+
+
+def evaluate_test_set(sess, evaluator, imputation=True):
+    """
+    Runs the streaming evaluation built by build_streaming_evaluation.
+    Args:
+        sess: session
+        evaluator: see build_streaming_evaluation
+        imputation: also evaluate the imputation measures
+
+    Returns:
+        evaluated summaries
+    """
+    sess.run(evaluator['reset_op'])
+    for start, size in evaluator['chunks']:
+        update_ops = [evaluator['update_ops'][size]]
+        if imputation:
+            update_ops.append(evaluator['imputation_update_ops'][size])
+        sess.run(update_ops, feed_dict={evaluator['chunk_start']: start})
+    summaries = evaluator['summaries'] + (evaluator['imputation_summaries'] if imputation else [])
+    return sess.run(summaries)
+
+
+def evaluate_checkpoints(log_path, settings, timeout=None, poll_interval=10):
+    """
+    Evaluates the evaluation checkpoints of a run as soon as they are written; returns after the run's last checkpoint
+    has been evaluated (or if no new checkpoint appeared within timeout seconds).
+    Args:
+        log_path: log directory of the run
+        settings: evaluation settings (see save_eval_settings)
+        timeout: max. number of seconds to wait for a new checkpoint (None: wait forever)
+        poll_interval: seconds between checks whether the run has completed (e.g. stopped early)
+    """
+    config = settings['config']
+    set_precision(**settings['precision'])
+
+    with tf.Graph().as_default(), tf.device(settings['eval_device']):
+        tf.set_random_seed(config['seed'])
+
+        # test data (same split as in the training run)
+        binarise_data = config['dataset'] in ['mnist', 'mnist-small']
+        _, _, y_te, lbl_te = make_minibatch(config['dataset'], ratio_tr=settings['ratio_tr'],
+                                            ratio_val=settings['ratio_val'], path_datadir=settings['path_dataset'],
+                                            size_minibatch=-1, size_testbatch=settings['size_testbatch'],
+                                            seed_split=settings['seed_data'], binarise=binarise_data,
+                                            seed_minibatch=config['seed'], dtype=get_dtype('data'),
+                                            noise_level=config.get('noise_level', 0))
+        y_te_01 = y_te
+        if binarise_data:
+            y_te_01 = tf.where(tf.equal(y_te, -1), tf.zeros_like(y_te), tf.ones_like(y_te))
+
+        # same architecture (and variable names) as in the training graph
+        decoder_type = 'bernoulli' if config['dataset'] in ['mnist', 'mnist-small'] else 'standard'
+        encoder_layers = [(config['U'], tf.tanh), (config['U'], tf.tanh), (config['L'], 'natparam')]
+        decoder_layers = [(config['U'], tf.tanh), (config['U'], tf.tanh), (int(y_te.get_shape()[1]), decoder_type)]
+        _, _, phi_gmm = svae.init_model_params(config['method'], config['K'], config['L'], dof=config.get('DoF'),
+                                               seed=config['seed'], param_device=settings['eval_device'])
+
+        evaluator = build_streaming_evaluation(y_te, y_te_01, lbl_te, phi_gmm, encoder_layers, decoder_layers,
+                                               decoder_type, settings['nb_samples_te'], settings['nb_samples_pert'],
+                                               settings['ratio_missing_data'], settings['size_eval_chunk'],
+                                               seed=config['seed'], top_k=config.get('top_k', None),
+                                               nb_sample_chunks_te=settings['nb_sample_chunks_te'],
+                                               nb_chunks_pert=settings['nb_chunks_pert'])
+
+        # only the variables of the eval graph are restored
+        saver = tf.train.Saver(tf.global_variables())
+        summary_writer = tf.summary.FileWriter(log_path)
+
+        sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+        sess.run(tf.local_variables_initializer())
+
+        last_checkpoint_time = [time.time()]
+        next_imputation_step = 0
+
+        def stop_waiting():
+            # called if no new checkpoint appeared within poll_interval seconds
+            if os.path.exists(os.path.join(log_path, COMPLETED_FILE)):
+                return True
+            return timeout is not None and time.time() - last_checkpoint_time[0] > timeout
+
+        try:
+            for checkpoint in tf.contrib.training.checkpoints_iterator(os.path.join(log_path, EVAL_CHECKPOINT_DIR),
+                                                                       timeout=poll_interval, timeout_fn=stop_waiting):
+                last_checkpoint_time[0] = time.time()
+                try:
+                    saver.restore(sess, checkpoint)
+                except tf.errors.NotFoundError:
+                    # deleted by the training run (only the latest checkpoints are kept) before it was evaluated; the
+                    # iterator continues with the newest checkpoint
+                    print('Skipped deleted checkpoint %s' % checkpoint)
+                    continue
+                step = int(checkpoint.split('-')[-1])
+
+                # imputation is due on the first checkpoint at or after the next multiple of imputation_freq (the
+                # checkpoint of this iteration may have been deleted before it was evaluated)
+                imputation = step >= next_imputation_step or step >= settings['nb_iters'] - 1
+                if imputation:
+                    next_imputation_step = (step // settings['imputation_freq'] + 1) * settings['imputation_freq']
+                for summary in evaluate_test_set(sess, evaluator, imputation):
+                    summary_writer.add_summary(summary, global_step=step)
+                summary_writer.flush()
+                print('Evaluated checkpoint of iteration %d' % step)
+
+                if step >= settings['nb_iters'] - 1:
+                    break
+        finally:
+            coord.request_stop()
+            coord.join(threads)
+            summary_writer.close()
+            sess.close()
+
+
+if __name__ == '__main__':
+    log_path = sys.argv[1]
+    with open(os.path.join(log_path, EVAL_SETTINGS_FILE), 'rb') as f:
+        eval_settings = pickle.load(f)
+    evaluate_checkpoints(log_path, eval_settings)
@@ -2,23 +2,33 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
+import json
 import matplotlib  # todo
 matplotlib.use('Agg')
 import numpy as np
 import os
+import subprocess
+import sys
 import tensorflow as tf
 import time
 
 from data import make_minibatch
 from distributions import dirichlet, gaussian, niw
+from evaluation import COMPLETED_FILE, EVAL_CHECKPOINT_DIR, save_eval_settings
+from helpers.early_stopping import ConvergenceMonitor
+from helpers.executor import run_schedule_parallel, worker_config_id, worker_nb_threads
 from helpers.logging_utils import generate_log_id
+from helpers.planning import plan_resources
+from helpers.precision import get_dtype, get_policy, set_precision
 from losses import weighted_mse, diagonal_gaussian_logprob, bernoulli_logprob, imputation_losses, \
     generate_missing_data_mask, purity
 from models import svae
-from helpers.tf_utils import average_gradients
-from visualisation.visualise_svae import svae_dashboard
-from helpers.scheduling import create_schedule
-from helpers.tf_utils import variable_on_device
+from helpers.tf_utils import make_session_config, tower_devices
+from visualisation.dashboard_renderer import DashboardRenderer
+from helpers.scheduling import collect_fetches, create_schedule
+from helpers.tracing import StepStatistics, is_traced_step, make_trace_options, phase_times, save_trace
+from training import build_training_graph
 
 
 # global settings
@@ -30,7 +40,10 @@ size_testbatch = -100  # if negative: full testset
 
 nb_samples = 10  # nb samples for gradient computation
 nb_samples_te = 100  # 100 for small datasets; 20 for mnist on laptop (OOM otherwise)
+size_eval_chunk = 500  # the evaluation worker processes the test set in chunks of this size (bounds memory usage)
+nb_sample_chunks_te = 1  # test loglik is estimated with nb_sample_chunks_te * nb_samples_te samples (evaluation worker)
 nb_samples_pert = 20  # how many perturbed samples to be generated per test data point (for missing data imputation)
+nb_chunks_pert = 1  # perturbed samples are imputed in this many chunks (has to divide nb_samples_pert)
 ratio_missing_data = 0.1
 
 nb_iters = 20000
@@ -38,19 +51,67 @@ measurement_freq = 500
 plot_freq = 2500
 imputation_freq = 25000
 checkpoint_freq = 25000
+resume_freq = 1000  # the latest state is saved every resume_freq iterations to resume interrupted runs from
 
-nb_gpu = 1  # number of GPUs to be used
+nb_towers = 1  # number of model replicas (data parallelism)
+tower_device_type = 'gpu'  # 'gpu': one tower per GPU; 'cpu': one tower per logical CPU device
+nb_threads_per_tower = None  # intra-op threads per CPU tower (None: use all cores)
+nb_micro_batches = 1  # nb minibatches over which gradients are accumulated before they are applied (theta: last one)
+nb_parallel_runs = 1  # >1: schedule entries run concurrently in worker processes on disjoint cores (see executor.py)
 param_device = '/gpu:0'  # where parameters are stored
 meas_device = '/gpu:0'   # where performance is evaluated
 
+# evaluate test performance (incl. imputation) in a separate process on the saved checkpoints (see evaluation.py);
+# if False, it is evaluated inline (blocking training)
+async_evaluation = True
+eval_device = '/cpu:0'  # where the evaluation worker runs
+nb_eval_checkpoints = 5  # evaluation checkpoints (saved every measurement_freq/imputation_freq iterations) kept on disk
+
 nb_threads = 2  # for input queue
 
+# pre-flight planning (see helpers/planning.py): the evaluation chunk sizes and test sample counts are reduced s.t. the
+# estimated memory usage fits; experiments whose training step doesn't fit are skipped
+memory_budget_gb = None  # None: detect available host memory (cgroup limit, e.g. slurm --mem, or physical memory)
+memory_margin = 0.8  # only this fraction of the budget is planned
+
 stddev_init_nn = 0.01  # neural net initialization
 
 log_dir = 'logs_svae'
+resume = True  # continue interrupted runs from their latest checkpoint; skip completed runs
+RESUME_CHECKPOINT_DIR = 'resume_checkpoints'  # subdirectory of the run's log directory (only the latest one is kept)
+
+# stop a run as soon as the smoothed neg. ELBO (and loli_te) improved by less than early_stopping_tol (relative)
+# over the last early_stopping_window measurements (see helpers/early_stopping.py)
+early_stopping = False
+early_stopping_window = 5
+early_stopping_tol = 1e-3
+early_stopping_smoothing = 0.7  # exponential smoothing of the measurements
+early_stopping_loli_te = False  # also monitor loli_te (inline estimate; one sample per test point if async_evaluation)
+early_stopping_min_iters = 2000
 
 verbose = False  # log device placement
 
+# execution tracing (see helpers/tracing.py); traces are written to <log_path>/traces
+trace_freq = None  # trace every trace_freq-th iteration (None: no periodic tracing)
+trace_window = None  # (first, last) iteration traced, e.g. (100, 104) (None: no window)
+trace_memory = False  # add memory allocations to the Chrome traces
+trace_to_tensorboard = False  # also add the run metadata of traced steps to the event file
+
+# step timing: latency percentiles, samples/sec and per-phase times (encoder, e_step, ...) are logged at every
+# measurement (TensorBoard scalars timing/* and <log_dir>/<log_id>_timing.csv)
+phase_profile_freq = measurement_freq  # run every phase_profile_freq-th step with SOFTWARE_TRACE (None: no phases)
+timing_window = 500  # the statistics are computed over this many recent steps
+
+# numeric precision per subsystem (data, nn, pgm, loss; see helpers/precision.py); can be overridden per experiment
+# by scheduling 'precision': [dict(default=tf.float32, nn=tf.float16, pgm=tf.float64), ...]; float16 runs use static
+# loss scaling (128 by default, e.g. dict(default=tf.float32, nn=tf.float16, loss_scale=1024))
+precision = dict(default=tf.float32)
+
+# scheduled hyperparameters which are fed when the variables are initialised: consecutive schedule entries which only
+# differ in these share the graph (each run still gets its own session, i.e. fresh input queues and random streams)
+HYPERPARAMETERS = ('lr', 'lrcvi', 'decay_rate')
+hyperparameter_defaults = {'decay_rate': 1}  # no decay by default
+
 # set size_minibatch=64
 schedule = create_schedule({
     'dataset': 'gtex',
@@ -97,13 +158,60 @@ seed_data = 0
 
 ###################################################################################################################
 
-# iterate through scheduled experiments
-for config_id, config in enumerate(schedule):
-
-    print("Experiment %d with config\n%s\n" % (config_id, str(config)))
+# if nb_parallel_runs > 1, this process only dispatches the schedule entries to workers (running this script for a
+# single entry each)
+config_id_worker = worker_config_id()
+if config_id_worker is not None:
+    config_ids = [config_id_worker]
+elif nb_parallel_runs > 1:
+    run_schedule_parallel(os.path.abspath(__file__), schedule, log_dir, nb_parallel_runs)
+    config_ids = []
+else:
+    config_ids = range(len(schedule))
+
+# the dashboard is rendered by a separate process (forked before any TF session is created)
+dashboard_renderer = DashboardRenderer() if len(config_ids) > 0 else None
+
+# runs are identified by their log_id: resume an interrupted run from its latest checkpoint
+runs = []
+for config_id in config_ids:
+    config = schedule[config_id]
+    log_id = generate_log_id(config)
+    log_path = log_dir + '/' + log_id
+    latest_checkpoint = None
+    start_iter = 0
+    if resume and os.path.exists(log_path):
+        checkpoints = [tf.train.latest_checkpoint(path) for path in [log_path,
+                                                                     os.path.join(log_path, RESUME_CHECKPOINT_DIR)]]
+        checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint is not None]
+        if checkpoints:
+            latest_checkpoint = max(checkpoints, key=lambda checkpoint: int(checkpoint.split('-')[-1]))
+            start_iter = int(latest_checkpoint.split('-')[-1]) + 1
+        if os.path.exists(os.path.join(log_path, COMPLETED_FILE)) or start_iter >= nb_iters:
+            print('Skipping experiment %d: already completed (%s)' % (config_id, log_path))
+            continue
+        if latest_checkpoint is not None:
+            print('Resuming experiment %d from %s' % (config_id, latest_checkpoint))
+    runs.append((config_id, start_iter, latest_checkpoint))
+
+
+def graph_key(run):
+    # everything but the hyperparameters determines the graph (the minibatch seed also depends on start_iter)
+    config_id, start_iter, _ = run
+    config = schedule[config_id]
+    return generate_log_id(dict((key, val) for key, val in config.items() if key not in HYPERPARAMETERS)), start_iter
+
+
+# iterate through scheduled experiments (consecutive runs with the same graph key share the graph)
+for (_, start_iter), graph_runs in itertools.groupby(runs, graph_key):
+    graph_runs = list(graph_runs)
+    config = schedule[graph_runs[0][0]]
+
+    # precision policy has to be set before the graph is built
+    set_precision(**config.get('precision', precision))
 
     # reset Tensorflow graph
-    with tf.Graph().as_default(), tf.device(param_device):
+    with tf.Graph().as_default() as graph, tf.device(param_device):
 
         # set graph-level seed
         tf.set_random_seed(config['seed'])
@@ -113,13 +221,36 @@ for config_id, config in enumerate(schedule):
 
         noise_level = config.get('noise_level', 0)
 
+        # if set, only the top_k most probable components of q(z|y) are kept per data point (for large K)
+        top_k = config.get('top_k', None)
+
+        # the shuffle queues can't be checkpointed: a resumed run continues with another minibatch seed (instead of
+        # replaying the minibatch sequence from the start)
         y_tr, lbl_tr, y_te, lbl_te = make_minibatch(config['dataset'], ratio_tr=ratio_tr, ratio_val=ratio_val,
                                                     path_datadir=path_dataset, size_minibatch=size_minibatch,
-                                                    size_testbatch=size_testbatch, nb_towers=nb_gpu,
+                                                    size_testbatch=size_testbatch, nb_towers=nb_towers,
                                                     nb_threads=nb_threads, seed_split=seed_data,
-                                                    binarise=binarise_data, seed_minibatch=config['seed'],
-                                                    dtype=tf.float32, noise_level=noise_level)
+                                                    binarise=binarise_data, seed_minibatch=config['seed'] + start_iter,
+                                                    dtype=get_dtype('data'), noise_level=noise_level)
+
 
+        # estimate memory usage and adapt the evaluation settings before the model graph is built
+        try:
+            plan = plan_resources({'size_minibatch': size_minibatch, 'nb_towers': nb_towers,
+                                   'N_te': int(y_te.get_shape()[0]), 'D': int(y_te.get_shape()[1]), 'K': config['K'],
+                                   'L': config['L'], 'U': config['U'], 'S': nb_samples, 'top_k': top_k,
+                                   'nb_samples_te': nb_samples_te, 'nb_sample_chunks_te': nb_sample_chunks_te,
+                                   'nb_samples_pert': nb_samples_pert, 'nb_chunks_pert': nb_chunks_pert,
+                                   'size_eval_chunk': size_eval_chunk, 'async_evaluation': async_evaluation},
+                                  memory_budget=None if memory_budget_gb is None else memory_budget_gb * 1024 ** 3,
+                                  memory_margin=memory_margin)
+        except MemoryError as e:
+            print('Skipping experiments %s: %s' % (str([run[0] for run in graph_runs]), str(e)))
+            continue
+        planned = plan['settings']
+        print('Estimated memory usage: %.0fMB of %.0fMB; %.2f GFLOPs per training step%s' % (
+            plan['total_mb'], plan['budget_mb'], plan['training_gflops_per_step'],
+            ''.join('\n  adjusted ' + adjustment for adjustment in plan['adjustments'])))
 
         # for error computation we need images in [0, 1] instead of {-1, 1}
         y_tr_01 = tf.concat(y_tr, axis=0)
@@ -127,151 +258,63 @@ for config_id, config in enumerate(schedule):
 
         if binarise_data:
             y_tr_01 = tf.where(tf.equal(y_tr_01, -1),
-                               tf.zeros_like(y_tr_01, dtype=tf.float32),
-                               tf.ones_like(y_tr_01, dtype=tf.float32))
+                               tf.zeros_like(y_tr_01),
+                               tf.ones_like(y_tr_01))
             y_te_01 = tf.where(tf.equal(y_te, -1),
-                               tf.zeros_like(y_te, dtype=tf.float32),
-                               tf.ones_like(y_te, dtype=tf.float32))
+                               tf.zeros_like(y_te),
+                               tf.ones_like(y_te))
 
         # define nn-architecture
         decoder_type = 'bernoulli' if config['dataset'] in ['mnist', 'mnist-small'] else 'standard'
         encoder_layers = [(config['U'], tf.tanh), (config['U'], tf.tanh), (config['L'], 'natparam')]
         decoder_layers = [(config['U'], tf.tanh), (config['U'], tf.tanh), (int(y_te.get_shape()[1]), decoder_type)]
 
+        # hyperparameters are local variables (not checkpointed) initialised with the values fed for the current run
+        with tf.name_scope('hyperparameters'):
+            hyperparameter_values = dict((name, tf.placeholder(tf.float32, [], name=name)) for name in HYPERPARAMETERS)
+            hyperparameters = dict((name, tf.Variable(value, trainable=False, name=name,
+                                                      collections=[tf.GraphKeys.LOCAL_VARIABLES]))
+                                   for name, value in hyperparameter_values.items())
+
         # define step size (CVI step-size can be decreasing)
         with tf.name_scope('learning_rate'):
             global_step = tf.get_variable('global_step', [], initializer=tf.constant_initializer(0), trainable=False)
-            decay_rate = config.get('decay_rate', 1)  # no decay by default
-            lrcvi = tf.train.exponential_decay(config['lrcvi'], global_step, 1000, decay_rate, staircase=False)
+            lrcvi = tf.train.exponential_decay(hyperparameters['lrcvi'], global_step, 1000,
+                                               hyperparameters['decay_rate'], staircase=False)
             tf.summary.scalar('learning_rate_cvi', lrcvi)
 
         # optimiser
-        opt = tf.train.AdamOptimizer(learning_rate=config['lr'], use_locking=True)
-        # opt = tf.train.AdagradOptimizer(learning_rate=config['lr'], use_locking=True)
-
-        # mu_theta and sigma_theta are point estimates in the SMM case.
-        if 'smm' in config['method']:
-            # init helper values for SMM (theta is a constant, we just need it to init the rec GMM below)
-            gmm_prior, theta = svae.init_mm(config['K'], config['L'], seed=config['seed'], param_device=param_device,
-                                            theta_as_variable=False)
-
-            # create tensor for Student-t parameters
-            with tf.variable_scope('theta'):
-                mu_k, L_k = svae.make_loc_scale_variables(gmm_prior, param_device=param_device)
-                DoF = config['DoF'] * tf.ones((config['K'],), dtype=tf.float32)
-                DoF = variable_on_device('DoF_k', shape=None, initializer=DoF, trainable=False, device=param_device)
-
-                alpha_k = variable_on_device('alpha_k', shape=None, initializer=theta[0], trainable=False,
-                                             device=param_device)
-
-            # init inference GMM parameters
-            phi_gmm = svae.init_recognition_params(theta, config['K'], seed=config['seed'],
-                                                   param_device=param_device)
-
-            # only keep dirichlet prior, as other parameters will be point estimates
-            gmm_prior = gmm_prior[0]
-            theta = (alpha_k, mu_k, L_k, DoF)
-
-        else:
-            # init model-GMM
-            gmm_prior, theta = svae.init_mm(config['K'], config['L'], seed=config['seed'], param_device=param_device)
-
-            # init recognition-GMM
-            phi_gmm = svae.init_recognition_params(theta, config['K'], seed=config['seed'], param_device=param_device)
-
-        # init lists for collecting tower outputs
-        tower_grads = []
-        tower_x_samps = []
-        tower_r_nk = []
-        tower_elbo = []
-        tower_neg_rec_err = []
-        tower_regularizer = []
-        tower_numerator = []
-        tower_denominator = []
-        tower_mean_rec = []
-        tower_out2_rec = []
-
-        # build computation graph (distributed on multiple GPUs if required)
-        with tf.variable_scope(tf.get_variable_scope()) as v_scope:
-            for gpu_id in range(nb_gpu):
-                with tf.device('/gpu:%d' % gpu_id):
-                    with tf.name_scope('tower_%d' % gpu_id):
-
-                        # get current tower's part of the minibatch
-                        if nb_gpu > 1:
-                            y_tr_tower = y_tr[gpu_id]
-                        else:
-                            y_tr_tower = y_tr
-
-                        # build model, using parameters saved on param_device
-                        (y_k_rec, y_enc, x_k_samples, x_samples,
-                         log_z_given_y_phi,
-                         phi_gmm, phi_tilde) = svae.inference(y_tr_tower, phi_gmm, encoder_layers, decoder_layers,
-                                                              nb_samples, param_device=param_device,
-                                                              seed=config['seed'])
-
-                        # share model parameters across GPUs
-                        v_scope.reuse_variables()
-
-                        # collect local variables for updating PGM parameter theta
-                        tower_x_samps.append(x_samples)
-                        tower_r_nk.append(log_z_given_y_phi)
-
-                        # compute elbo
-                        if 'smm' in config['method']:
-                            elbo, details = svae.compute_elbo_smm(y_tr_tower, y_k_rec, theta, phi_tilde,
-                                                                  x_k_samples, log_z_given_y_phi,
-                                                                  decoder_type=decoder_type)
-                        else:
-                            elbo, details = svae.compute_elbo(y_tr_tower, y_k_rec, theta, phi_tilde,
-                                                              x_k_samples, log_z_given_y_phi,
-                                                              decoder_type=decoder_type)
-
-                        # compute gradients for this tower
-                        grads_and_vars = opt.compute_gradients(-elbo, gate_gradients=0)
-                        tower_grads.append(grads_and_vars)
-
-                        # save values computed in this tower
-                        y_k_mean_rec, out2_rec = y_k_rec  # out2 are either bernoulli logits or gaussian variances
-                        tower_mean_rec.append(y_k_mean_rec)
-                        tower_out2_rec.append(out2_rec)
-                        tower_elbo.append(elbo)
-                        # for debugging...
-                        tower_neg_rec_err.append(details[0])
-                        tower_numerator.append(details[1])
-                        tower_denominator.append(details[2])
-                        tower_regularizer.append(details[3])
-
-        # collect local variables from all towers
-        log_z_given_y_phi = tf.concat(tower_r_nk, axis=0)
-        x_samples = tf.concat(tower_x_samps, axis=0)
-
-        # update GMM on param_device
-        with tf.name_scope('GMM_update'):
-            with tf.device(param_device):
-                if 'smm' in config['method']:
-                    # only alpha is updated...
-                    alpha_star = svae.m_step_smm(smm_prior=gmm_prior, r_nk=tf.exp(log_z_given_y_phi))
-                    update_theta = svae.update_gmm_params([theta[0]], [alpha_star], lrcvi)
-                else:
-                    theta_star = svae.m_step(gmm_prior=gmm_prior, x_samples=x_samples,
-                                             r_nk=tf.exp(log_z_given_y_phi))
-                    update_theta = svae.update_gmm_params(theta, theta_star, lrcvi)
-
-        # update deterministic parameters
-        with tf.name_scope('training'):
-            grads_and_vars = average_gradients(tower_grads)
-            update_deterministic = opt.apply_gradients(grads_and_vars, global_step=global_step)
-
-        training_step = tf.group(update_theta, update_deterministic, name='training_ops')
-
-        # use trained model for test prediction
+        opt = tf.train.AdamOptimizer(learning_rate=hyperparameters['lr'], use_locking=True)
+        # opt = tf.train.AdagradOptimizer(learning_rate=hyperparameters['lr'], use_locking=True)
+
+        # build model, ELBO and training step (distributed on multiple GPUs or logical CPU devices if required)
+        if nb_towers == 1:
+            y_tr = [y_tr]
+        model = build_training_graph(y_tr, config, opt, lrcvi, encoder_layers, decoder_layers, decoder_type,
+                                     nb_samples, param_device, tower_devices(nb_towers, tower_device_type),
+                                     global_step=global_step, nb_micro_batches=nb_micro_batches)
+        theta, phi_gmm, training_step = model['theta'], model['phi_gmm'], model['training_step']
+        accumulate_step = model['accumulate_step']
+        log_z_given_y_phi, r_nk, x_samples = model['log_z_given_y_phi'], model['r_nk'], model['x_samples']
+        details = model['details']
+
+        # summaries which only depend on the parameters (not on the minibatch); they are evaluated before the training
+        # step of a measurement iteration, s.t. they are not read concurrently with the parameter updates
+        param_summary_collections = ['parameter_summaries']
+
+        # use trained model for test prediction (if evaluated asynchronously, only needed for plotting: one sample)
         with tf.name_scope('test_performance'), tf.device(meas_device):
             tf.get_variable_scope().reuse_variables()
+            nb_samples_plot = 1 if async_evaluation else planned['nb_samples_te']
             (y_k_te_rec, y_te_enc, x_k_te_samples, x_te_samples,
-             log_r_nk_te, _, _) = svae.inference(y_te, phi_gmm, encoder_layers, decoder_layers, nb_samples_te,
-                                                 seed=config['seed'], name='test_inference')
+             log_r_nk_te, _, _, _, comp_idx_te) = svae.inference(y_te, phi_gmm, encoder_layers, decoder_layers,
+                                                                 nb_samples_plot, seed=config['seed'],
+                                                                 name='test_inference', top_k=top_k)
             y_k_te_mean_rec, out2_te_rec = y_k_te_rec
+            if top_k is None:
+                r_nk_te = tf.exp(log_r_nk_te)
+            else:
+                r_nk_te = svae.scatter_responsibilities(tf.exp(log_r_nk_te), comp_idx_te, config['K'])
             with tf.name_scope('perf_measures'):
                 # test performance
                 mse_te = weighted_mse(y_te_01, y_k_te_mean_rec, tf.exp(log_r_nk_te))
@@ -279,16 +322,16 @@ for config_id, config in enumerate(schedule):
                     loli_te = bernoulli_logprob(y_te, out2_te_rec, log_r_nk_te)
                 else:
                     loli_te = diagonal_gaussian_logprob(y_te, y_k_te_mean_rec, out2_te_rec, log_r_nk_te)
-                tf.summary.scalar('mse_te', mse_te)
-                tf.summary.scalar('loli_te', loli_te)
-                if lbl_te is not None:
-                    entr_te, prty_te = purity(tf.exp(log_r_nk_te), lbl_te)
-                    tf.summary.scalar('entropy_te', entr_te)
-                    tf.summary.scalar('purity_te', prty_te)
+                if not async_evaluation:
+                    tf.summary.scalar('mse_te', mse_te, collections=param_summary_collections)
+                    tf.summary.scalar('loli_te', loli_te, collections=param_summary_collections)
+                    if lbl_te is not None:
+                        entr_te, prty_te = purity(r_nk_te, lbl_te)
+                        tf.summary.scalar('entropy_te', entr_te, collections=param_summary_collections)
+                        tf.summary.scalar('purity_te', prty_te, collections=param_summary_collections)
 
                 # training performance
-                y_mean_rec = tf.concat(tower_mean_rec, axis=0)
-                out2_rec = tf.concat(tower_out2_rec, axis=0)
+                y_mean_rec, out2_rec = model['y_mean_rec'], model['out2_rec']
                 y_tr_coll = tf.concat(y_tr, axis=0)  # collect training batch
                 mse_tr = weighted_mse(y_tr_01, y_mean_rec, tf.exp(log_z_given_y_phi))
                 if decoder_type == 'bernoulli':
@@ -298,7 +341,7 @@ for config_id, config in enumerate(schedule):
                 tf.summary.scalar('mse_tr', mse_tr)
                 tf.summary.scalar('loli_tr', loli_tr)
                 if lbl_tr is not None:
-                    entr_tr, prty_tr = purity(tf.exp(log_z_given_y_phi), lbl_tr)
+                    entr_tr, prty_tr = purity(r_nk, lbl_tr)
                     tf.summary.scalar('entropy_tr', entr_tr)
                     tf.summary.scalar('purity_tr', prty_tr)
 
@@ -313,30 +356,32 @@ for config_id, config in enumerate(schedule):
             expected_log_pi = dirichlet.expected_log_pi(alpha_k)
             pi_theta = tf.exp(expected_log_pi)
             theta_plot = mu, sigma, pi_theta
-            q_z_given_y_phi = tf.exp(log_z_given_y_phi)
-            neg_normed_elbo = -tf.divide(tf.reduce_sum(tower_elbo), size_minibatch)
+            q_z_given_y_phi = r_nk
+            neg_normed_elbo = -tf.divide(model['elbo'], size_minibatch)
 
             tf.summary.scalar('elbo/elbo_normed', neg_normed_elbo)
-            tf.summary.scalar('elbo/neg_rec_err', tf.divide(tf.reduce_sum(tower_neg_rec_err), size_minibatch))
-            tf.summary.scalar('elbo/regularizer', tf.divide(tf.reduce_sum(tower_regularizer), size_minibatch))
-            tf.summary.scalar('elbo/regularizer/log_numerator', tf.reduce_sum(tower_numerator))
-            tf.summary.scalar('elbo/regularizer/log_denominator', tf.reduce_sum(tower_denominator))
+            tf.summary.scalar('elbo/neg_rec_err', tf.divide(details[0], size_minibatch))
+            tf.summary.scalar('elbo/regularizer', tf.divide(details[3], size_minibatch))
+            tf.summary.scalar('elbo/regularizer/log_numerator', details[1])
+            tf.summary.scalar('elbo/regularizer/log_denominator', details[2])
 
             phi_gmm_unpacked = svae.unpack_recognition_gmm(phi_gmm)
             phi_gmm_plot = gaussian.natural_to_standard(*phi_gmm_unpacked[:2])
 
-            tf.summary.histogram('mixture_coefficients', pi_theta)  # keep track of component weights
-            tf.summary.tensor_summary('cluster_means', mu)
-            tf.summary.tensor_summary('cluster_covs', sigma)
-            tf.summary.tensor_summary('cluster_weights', pi_theta)
+            # keep track of component weights
+            tf.summary.histogram('mixture_coefficients', pi_theta, collections=param_summary_collections)
+            tf.summary.tensor_summary('cluster_means', mu, collections=param_summary_collections)
+            tf.summary.tensor_summary('cluster_covs', sigma, collections=param_summary_collections)
+            tf.summary.tensor_summary('cluster_weights', pi_theta, collections=param_summary_collections)
 
             # for plotting...
-            clustering = tf.argmax(log_r_nk_te, axis=1)  # most likely cluster allocation
+            clustering = tf.argmax(r_nk_te, axis=1)  # most likely cluster allocation
             N, D = y_te.shape
             # get the first reconstruction sample of the most likely cluster... (N, K, S, D) -> (N, D)
             with tf.name_scope('prepare_indices'):
                 n_idx = tf.constant(np.arange(int(N)).reshape(-1, 1), dtype=tf.int64, name='n_idx')
-                k_idx = tf.reshape(clustering, (-1, 1), name='k_idx')
+                # position of the most likely cluster in y_k_te_mean_rec (differs from clustering if truncated)
+                k_idx = tf.reshape(tf.argmax(log_r_nk_te, axis=1), (-1, 1), name='k_idx')
                 s_idx = tf.constant(np.zeros(int(N)).reshape(-1, 1), dtype=tf.int64, name='s_idx')
                 d_idx = tf.constant(np.arange(int(D))[None, :, None], dtype=tf.int64, name='d_idx')
                 nks_idx = tf.concat([n_idx, k_idx, s_idx], axis=1, name='nks_idx')
@@ -346,43 +391,48 @@ for config_id, config in enumerate(schedule):
 
         # init tensorboard
         perf_summaries = tf.summary.merge_all()  # these summaries will be saved regularly
-        log_id = generate_log_id(config)
-        log_path = log_dir + '/' + log_id
-        print(log_path)
-        if not os.path.exists(log_path):
-            os.mkdir(log_path)
-        summary_writer = tf.summary.FileWriter(log_path, graph=tf.get_default_graph())
+        param_summaries = tf.summary.merge_all(param_summary_collections[0])
 
         # init model saver to store trained variables (make sure that old ckpnts are not deleted)
         model_saver = tf.train.Saver(max_to_keep=nb_iters//checkpoint_freq + 2)
+        resume_saver = tf.train.Saver(max_to_keep=1)
+
+        # the evaluation worker evaluates checkpoints saved on the measurement (and imputation) cadence; only the
+        # latest ones are kept since they are evaluated as soon as they are written
+        if async_evaluation:
+            eval_saver = tf.train.Saver(max_to_keep=nb_eval_checkpoints)
 
         # compute imputation error (this will be done less regularly than other performance measurements)
-        with tf.name_scope('test_imputation'), tf.device(meas_device):
-            # mask is random, but constant for entire run.
-            missing_data_mask = generate_missing_data_mask(y_te, ratio_missing_data, seed=config['seed'])
+        # (done by the evaluation worker if async_evaluation)
+        if not async_evaluation:
+            with tf.name_scope('test_imputation'), tf.device(meas_device):
+                # mask is random, but constant for entire run.
+                missing_data_mask = generate_missing_data_mask(y_te, ratio_missing_data, seed=config['seed'])
 
-            # define imputation graph for SVAE
-            def impute(y_perturbed):
-                with tf.name_scope('missing_data_imputation'):
-                    tf.get_variable_scope().reuse_variables()
-                    ((y_k_mean_imp, out2_imp), _, _, _, log_r_nk_imp, _, _) = \
-                        svae.inference(y_perturbed, phi_gmm, encoder_layers, decoder_layers, nb_samples_te,
-                                       seed=config['seed'], name='test_inference')
-                    return y_k_mean_imp, out2_imp, log_r_nk_imp
+                # define imputation graph for SVAE
+                def impute(y_perturbed, chunk_seed):
+                    with tf.name_scope('missing_data_imputation'):
+                        tf.get_variable_scope().reuse_variables()
+                        ((y_k_mean_imp, out2_imp), _, _, _, log_r_nk_imp, _, _, _, _) = \
+                            svae.inference(y_perturbed, phi_gmm, encoder_layers, decoder_layers,
+                                           planned['nb_samples_te'], seed=chunk_seed, name='test_inference',
+                                           top_k=top_k)
+                        return y_k_mean_imp, out2_imp, log_r_nk_imp
 
 
-            # impute missing values
-            imp_mse, imp_lopr = imputation_losses(y_te, missing_data_mask, impute, nb_samples_pert,
-                                                  nb_samples_te, decoder_type=decoder_type, seed=config['seed'])
+                # impute missing values
+                imp_mse, imp_lopr = imputation_losses(y_te, missing_data_mask, impute, nb_samples_pert,
+                                                      planned['nb_samples_te'], decoder_type=decoder_type,
+                                                      seed=config['seed'], nb_chunks_pert=planned['nb_chunks_pert'])
 
-            imp_smry_mse = tf.summary.scalar('imp_mse', imp_mse)
-            imp_smry_lopr = tf.summary.scalar('imp_logprob', imp_lopr)
+                imp_smry_mse = tf.summary.scalar('imp_mse', imp_mse)
+                imp_smry_lopr = tf.summary.scalar('imp_logprob', imp_lopr)
 
-            imp_summaries = [imp_smry_mse, imp_smry_lopr]
+                imp_summaries = [imp_smry_mse, imp_smry_lopr]
 
-            # save missing_data_mask (add two axes for batch size and channel)
-            md_mask_summary = tf.summary.image('missing_data_mask',
-                                               tf.expand_dims(tf.expand_dims(tf.to_float(missing_data_mask), 0), 3))
+                # save missing_data_mask (add two axes for batch size and channel)
+                md_mask_summary = tf.summary.image('missing_data_mask',
+                                                   tf.expand_dims(tf.expand_dims(tf.to_float(missing_data_mask), 0), 3))
 
         # save some images in summary to look at them (and their reconstruction) in tensorboard
         if config['dataset'] in ['mnist', 'mnist-small', 'fashion']:
@@ -398,13 +448,52 @@ for config_id, config in enumerate(schedule):
                 smp_te_rec = tf.summary.image('test_rec_samps', tf.reshape(y_rec, (nb_rec_samps, 28, 28, 1)),
                                               max_outputs=nb_rec_samps)
 
-        # create session, init variables and start input queue threads
-        sess_config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=verbose)
-        sess = tf.Session(config=sess_config)
         init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+        mu_dbg, sigma_dbg, pi, L_dbg = svae.unpack_recognition_gmm_debug(phi_gmm)
+
+    # train all runs of this graph (the graph isn't modified anymore)
+    for config_id, start_iter, latest_checkpoint in graph_runs:
+        config = schedule[config_id]
+        log_id = generate_log_id(config)
+        log_path = log_dir + '/' + log_id
+
+        print("Experiment %d with config\n%s\n" % (config_id, str(config)))
+
+        print(log_path)
+        if not os.path.exists(log_path):
+            os.makedirs(log_path)
+        if async_evaluation and not os.path.exists(os.path.join(log_path, EVAL_CHECKPOINT_DIR)):
+            os.makedirs(os.path.join(log_path, EVAL_CHECKPOINT_DIR))
+        if not os.path.exists(os.path.join(log_path, RESUME_CHECKPOINT_DIR)):
+            os.makedirs(os.path.join(log_path, RESUME_CHECKPOINT_DIR))
+        summary_writer = tf.summary.FileWriter(log_path, graph=graph)
+
+        # log resource estimate next to the run
+        with open(log_path + '/plan.json', 'w') as f:
+            json.dump(plan, f, indent=2, sort_keys=True)
+
+        # the savers only delete checkpoints of the current run
+        model_saver.set_last_checkpoints_with_time([])
+        resume_saver.set_last_checkpoints_with_time([])
+        if async_evaluation:
+            eval_saver.set_last_checkpoints_with_time([])
+
+        # create a new session (fresh input queues and random streams), init variables with the run's hyperparameters
+        # and start input queue threads
+        sess_config = make_session_config(nb_towers, tower_device_type, nb_threads_per_tower,
+                                          log_device_placement=verbose,
+                                          nb_threads=worker_nb_threads() if config_id_worker is not None else None)
+        sess = tf.Session(graph=graph, config=sess_config)
         coord = tf.train.Coordinator()
         threads = tf.train.start_queue_runners(sess=sess, coord=coord)
-        sess.run(init)
+        sess.run(init, feed_dict=dict((hyperparameter_values[name], config.get(name, hyperparameter_defaults.get(name)))
+                                      for name in HYPERPARAMETERS))
+
+        # restore variables (incl. global_step and optimizer slots); summaries of the interrupted run written after the
+        # checkpoint are discarded by TensorBoard
+        if latest_checkpoint is not None:
+            resume_saver.restore(sess, latest_checkpoint)
+            summary_writer.add_session_log(tf.SessionLog(status=tf.SessionLog.START), global_step=start_iter)
 
         # init performance measurement arrays (used for plotting current training performance)
         nb_measurements = int(nb_iters / measurement_freq)
@@ -414,64 +503,173 @@ for config_id, config in enumerate(schedule):
 
         # make test set plottable...
         y_te_np = sess.run(y_te_01)
+        dashboard_renderer.new_run(y_te_np, log_dir + '/' + log_id + '.png')
 
         # save missing_data_mask
-        summary_writer.add_summary(sess.run(md_mask_summary), 0)
+        if not async_evaluation:
+            summary_writer.add_summary(sess.run(md_mask_summary), 0)
 
         if config['dataset'] in ['mnist', 'mnist-small', 'fashion']:
             summary_writer.add_summary(sess.run(smp_te_true), 0)
-        mu_dbg, sigma_dbg, pi, L_dbg = svae.unpack_recognition_gmm_debug(phi_gmm)
 
         start_time = time.time()
+        finished = False
+        if early_stopping:
+            monitored = {'neg_elbo': False, 'loli_te': True} if early_stopping_loli_te else {'neg_elbo': False}
+            convergence_monitor = ConvergenceMonitor(monitored, early_stopping_window, early_stopping_tol,
+                                                     early_stopping_smoothing, early_stopping_min_iters)
+        step_statistics = StepStatistics(log_dir + '/' + log_id + '_timing.csv', window=timing_window,
+                                         append=latest_checkpoint is not None)
+
+        # measurements of the training minibatch are fetched together with the training step (same minibatch and
+        # forward pass); name: (frequency, fetch, also evaluated in iteration 1)
+        periodic_fetches = {
+            'checkpoint': (checkpoint_freq, [], False),
+            'resume_checkpoint': (resume_freq, [], False),
+            'perf_summaries': (measurement_freq, perf_summaries, True),
+            'plot_samples': (plot_freq, [x_samples, q_z_given_y_phi], True)
+        }
+        # measurements which only read the parameters (test performance, theta) are evaluated in a separate run before
+        # the training step: fetched together with it, they would be read concurrently with the parameter updates (no
+        # minibatch is dequeued for them). Both thus refer to the parameters of the same forward pass.
+        param_fetches = {
+            'param_summaries': (measurement_freq, param_summaries, True),
+            'plot': (plot_freq, [theta_plot, y_te_mean_rec, clustering], True)
+        }
+        # loli_te requires inference on the full test set: only estimated inline if early stopping monitors it
+        monitor_loli_te = early_stopping and early_stopping_loli_te
+        if monitor_loli_te:
+            param_fetches['loli_te'] = (measurement_freq, loli_te, True)
+        if async_evaluation:
+            periodic_fetches['eval_checkpoint'] = (measurement_freq, [], False)
+            periodic_fetches['imp_eval_checkpoint'] = (imputation_freq, [], False)
+        else:
+            param_fetches['imp_summaries'] = (imputation_freq, imp_summaries, True)
+        if config['dataset'] in ['mnist', 'mnist-small', 'fashion']:
+            param_fetches['smp_te_rec'] = (plot_freq, smp_te_rec, True)
+
+        # start evaluation worker (it evaluates the checkpoints saved during training)
+        if async_evaluation:
+            save_eval_settings(log_path, config, get_policy(), path_dataset=path_dataset, ratio_tr=ratio_tr,
+                               ratio_val=ratio_val, size_testbatch=size_testbatch, seed_data=seed_data,
+                               nb_samples_te=planned['nb_samples_te'], nb_samples_pert=nb_samples_pert,
+                               ratio_missing_data=ratio_missing_data, size_eval_chunk=planned['size_eval_chunk'],
+                               nb_sample_chunks_te=planned['nb_sample_chunks_te'],
+                               nb_chunks_pert=planned['nb_chunks_pert'], imputation_freq=imputation_freq,
+                               nb_iters=nb_iters, eval_device=eval_device)
+            eval_env = dict(os.environ)
+            if 'cpu' in eval_device:
+                # don't allocate GPU memory in the worker
+                eval_env['CUDA_VISIBLE_DEVICES'] = ''
+            eval_worker = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                         'evaluation.py'), log_path], env=eval_env)
 
         # train
         try:
-            for i in range(nb_iters):
-
-                # periodically save tf-checkpoint and execution stats
-                if i % checkpoint_freq == 0 or i == nb_iters - 1:
-                    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-                    run_metadata = tf.RunMetadata()
-                    _, neg_elbo, dtl = sess.run([training_step, neg_normed_elbo, details],
-                                                options=run_options,
-                                                run_metadata=run_metadata)
-                    summary_writer.add_run_metadata(run_metadata, 'step%d' % i)
-                    model_saver.save(sess, log_path + '/checkpoint', global_step=i)
-                    # _, neg_elbo, dtl = sess.run([training_step, neg_normed_elbo, details])  # todo
+            for i in range(start_iter, nb_iters):
+                measurements = collect_fetches(i, nb_iters, {}, param_fetches)
+                if measurements:
+                    measurements = sess.run(measurements)
+
+                step_start = time.time()
+
+                # accumulate gradients of the first nb_micro_batches - 1 minibatches (applied in the training step)
+                for _ in range(nb_micro_batches - 1):
+                    sess.run(accumulate_step)
+
+                fetches = collect_fetches(i, nb_iters, {'training_step': training_step, 'neg_elbo': neg_normed_elbo,
+                                                        'details': details}, periodic_fetches)
+
+                # only traced iterations collect execution stats (profiled iterations: op timings for phase_times);
+                # profiled iterations lie between the measurement iterations, s.t. their phases only contain training
+                traced = is_traced_step(i, trace_freq, trace_window)
+                profiled = phase_profile_freq is not None and i % phase_profile_freq == phase_profile_freq // 2
+                if traced:
+                    run_options, run_metadata = make_trace_options()
+                elif profiled:
+                    run_options, run_metadata = make_trace_options(tf.RunOptions.SOFTWARE_TRACE)
                 else:
-                    _, neg_elbo, dtl = sess.run([training_step, neg_normed_elbo, details])
+                    run_options, run_metadata = None, None
+
+                results = sess.run(fetches, options=run_options, run_metadata=run_metadata)
+                neg_elbo, dtl = results['neg_elbo'], results['details']
+
+                # FULL_TRACE steps are much slower and would distort the latency statistics
+                if not traced:
+                    step_statistics.add_step(time.time() - step_start, size_minibatch * nb_micro_batches)
+                if traced or profiled:
+                    step_statistics.add_phase_times(phase_times(run_metadata.step_stats))
+
+                if traced:
+                    save_trace(run_metadata, log_path + '/traces', i, show_memory=trace_memory)
+                    if trace_to_tensorboard:
+                        summary_writer.add_run_metadata(run_metadata, 'step%d' % i)
 
-                # evaluate performance (i.e. run performance summaries)
-                if i % measurement_freq == 0 or i == nb_iters - 1 or i == 1:
-                    summaries = sess.run(perf_summaries)
+                if 'checkpoint' in results:
+                    model_saver.save(sess, log_path + '/checkpoint', global_step=i)
+                elif 'resume_checkpoint' in results:
+                    resume_saver.save(sess, os.path.join(log_path, RESUME_CHECKPOINT_DIR, 'checkpoint'), global_step=i)
+                if 'eval_checkpoint' in results or 'imp_eval_checkpoint' in results:
+                    eval_saver.save(sess, os.path.join(log_path, EVAL_CHECKPOINT_DIR, 'checkpoint'), global_step=i)
+
+                # performance summaries (training performance is measured on the minibatch trained on)
+                if 'perf_summaries' in results:
                     measurement_iter = int(i / measurement_freq)
                     elbo_meas[measurement_iter] = neg_elbo
                     debug_meas[measurement_iter, :] = np.squeeze(dtl)
                     print('Iteration %5d\t\t%.4fsec\t\t%.4f' % (i, time.time() - start_time, neg_elbo))
-                    summary_writer.add_summary(summaries, global_step=i)
-
-                # evaluate imputation performance
-                if i % imputation_freq == 0 or i == nb_iters - 1 or i == 1:
-                    imp_sum_evaluated = sess.run(imp_summaries)
-                    for summary in imp_sum_evaluated:
+                    summary_writer.add_summary(results['perf_summaries'], global_step=i)
+                    summary_writer.add_summary(measurements['param_summaries'], global_step=i)
+                    summary_writer.add_summary(step_statistics.summarise(i), global_step=i)
+
+                    # stop if converged (after saving a checkpoint of the current state)
+                    monitored_values = {'neg_elbo': neg_elbo}
+                    if monitor_loli_te:
+                        monitored_values['loli_te'] = measurements['loli_te']
+                    if early_stopping and convergence_monitor.update(i, monitored_values):
+                        print('Iteration %5d\t\tconverged; stopping early' % i)
+                        if 'checkpoint' not in results:
+                            model_saver.save(sess, log_path + '/checkpoint', global_step=i)
+                        break
+
+                # imputation performance
+                if 'imp_summaries' in measurements:
+                    for summary in measurements['imp_summaries']:
                         summary_writer.add_summary(summary, global_step=i)
 
-                # update plot
-                if i % plot_freq == 0 or i == nb_iters - 1 or i == 1:
-                    mean_cov_mc, x_samps, r_nk, y_te_rec_np, cluster_alloc = sess.run([
-                        theta_plot, x_samples, q_z_given_y_phi, y_te_mean_rec, clustering])
-                    plt = svae_dashboard(i, y_te_np, y_te_rec_np, x_samps, r_nk, cluster_alloc, mean_cov_mc,
-                                         size_minibatch, perf_meas_iters, measurement_freq, elbo_meas,
-                                         debug_meas, None)
-                    plt.tight_layout()
-                    plt.savefig(log_dir + '/' + log_id + '.png')
-
-                    # save sample reconstructions
-                    if config['dataset'] in ['mnist', 'mnist-small', 'fashion']:
-                        summary_writer.add_summary(sess.run(smp_te_rec), global_step=i)
+                # update plot (dropped if the renderer is still busy with earlier plots)
+                if 'plot' in measurements:
+                    mean_cov_mc, y_te_rec_np, cluster_alloc = measurements['plot']
+                    x_samps, r_nk_np = results['plot_samples']
+                    dashboard_renderer.submit(iter=i, y_te_rec=y_te_rec_np, x_samps=x_samps, r_nk=r_nk_np,
+                                              cluster_alloc=cluster_alloc, theta=mean_cov_mc,
+                                              size_minibatch=size_minibatch, perf_meas_iters=perf_meas_iters,
+                                              measurement_freq=measurement_freq, elbo=elbo_meas,
+                                              debug_meas=debug_meas)
+
+                # save sample reconstructions
+                if 'smp_te_rec' in measurements:
+                    summary_writer.add_summary(measurements['smp_te_rec'], global_step=i)
+
+            # mark the run as completed (it is skipped if the schedule is rerun; the evaluation worker stops after the
+            # last checkpoint)
+            open(os.path.join(log_path, COMPLETED_FILE), 'w').close()
+            finished = True
 
         finally:  # always flush summaries and close session
             print("Iteration %i; Done with experiment\n%s\n\n" % (i, str(config)))
             summary_writer.flush()
             summary_writer.close()
-            sess.close()
\ No newline at end of file
+            coord.request_stop()
+            coord.join(threads)
+            sess.close()
+
+            # the evaluation worker terminates after evaluating the last checkpoint
+            if async_evaluation:
+                if finished:
+                    eval_worker.wait()
+                else:
+                    eval_worker.terminate()
+
+if dashboard_renderer is not None:
+    dashboard_renderer.close()
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+"""
+Convergence-based early stopping: a run is stopped as soon as all monitored metrics have converged, i.e. the relative
+improvement of their exponentially smoothed values over the last window measurements is below a tolerance.
+"""
+
+
+class ConvergenceMonitor(object):
+
+    def __init__(self, metrics, window=5, tolerance=1e-3, smoothing=0.7, min_iters=0):
+        """
+        Args:
+            metrics: dict {name: True if higher values are better}, e.g. {'neg_elbo': False, 'loli_te': True}
+            window: number of measurements over which the improvement is computed
+            tolerance: max. relative improvement of a converged metric
+            smoothing: weight of the previous value in the exponential moving average (0: no smoothing)
+            min_iters: a run is never stopped before this iteration
+        """
+        self.metrics = metrics
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.min_iters = min_iters
+        self.smoothed = dict((name, None) for name in metrics)
+        self.history = dict((name, collections.deque(maxlen=window + 1)) for name in metrics)
+
+    def relative_improvement(self, name):
+        # relative improvement of the smoothed metric over the window (None if the window isn't full yet)
+        history = self.history[name]
+        if len(history) < history.maxlen:
+            return None
+        improvement = history[-1] - history[0] if self.metrics[name] else history[0] - history[-1]
+        return improvement / max(abs(history[0]), 1e-12)
+
+    def update(self, i, values):
+        """
+        Args:
+            i: current iteration
+            values: dict {name: value} containing the current values of all monitored metrics
+
+        Returns:
+            True if all metrics have converged
+        """
+        for name in self.metrics:
+            if self.smoothed[name] is None:
+                self.smoothed[name] = values[name]
+            else:
+                self.smoothed[name] = self.smoothing * self.smoothed[name] + (1 - self.smoothing) * values[name]
+            self.history[name].append(self.smoothed[name])
+
+        if i < self.min_iters:
+            return False
+        improvements = [self.relative_improvement(name) for name in self.metrics]
+        return all(improvement is not None and improvement < self.tolerance for improvement in improvements)
@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+from helpers.logging_utils import generate_log_id
+
+"""
+Parallel execution of schedule entries (see create_schedule): every entry is run by its own worker process
+  python <script> <config_id>
+s.t. it builds its own TF graph. The available cores are split into nb_parallel_runs disjoint slots; a worker is pinned
+to the cores of its slot (CPU affinity, inherited by its evaluation worker) and caps its TF thread pools accordingly.
+A failing worker (e.g. killed by the OOM killer) doesn't affect the other runs. The output of a worker is written to
+<log_dir>/<log_id>.out, next to the run's log directory.
+Meant for CPU runs: all workers share the visible GPUs.
+"""
+
+
+def worker_config_id():
+    # schedule entry passed by run_schedule_parallel (None if not run as worker)
+    return int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+
+def worker_nb_threads():
+    # number of cores the worker is pinned to
+    return len(os.sched_getaffinity(0))
+
+
+def split_cores(nb_slots):
+    # splits the available cores into nb_slots disjoint sets of (almost) equal size
+    cores = sorted(os.sched_getaffinity(0))
+    if nb_slots > len(cores):
+        raise ValueError('Cannot run %d workers on %d cores.' % (nb_slots, len(cores)))
+    return [cores[i::nb_slots] for i in range(nb_slots)]
+
+
+def run_schedule_parallel(script, schedule, log_dir, nb_parallel_runs, poll_interval=1.):
+    """
+    Runs all schedule entries with at most nb_parallel_runs worker processes at a time.
+    Args:
+        script: path of the experiment script; it has to run only the entry worker_config_id() if it is set
+        schedule: list of configs
+        log_dir: log directory of the runs
+        nb_parallel_runs: max. number of concurrent workers
+        poll_interval: seconds between checks for finished workers
+
+    Returns:
+        dict {config_id: exit code}; negative exit codes: the worker was killed by this signal (e.g. -9 if OOM-killed)
+    """
+    if not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+
+    free_slots = split_cores(nb_parallel_runs)
+    pending = list(range(len(schedule)))
+    running = {}  # config_id: (process, slot, output file)
+    exit_codes = {}
+
+    try:
+        while pending or running:
+            # dispatch pending entries to free slots
+            while pending and free_slots:
+                config_id = pending.pop(0)
+                slot = free_slots.pop(0)
+                output = open(os.path.join(log_dir, generate_log_id(schedule[config_id]) + '.out'), 'w')
+                process = subprocess.Popen([sys.executable, script, str(config_id)], stdout=output,
+                                           stderr=subprocess.STDOUT,
+                                           preexec_fn=lambda cores=slot: os.sched_setaffinity(0, cores))
+                running[config_id] = (process, slot, output)
+                print('Started experiment %d on cores %s (pid %d)' % (config_id, str(slot), process.pid))
+
+            time.sleep(poll_interval)
+
+            # collect finished workers
+            for config_id, (process, slot, output) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                output.close()
+                free_slots.append(slot)
+                del running[config_id]
+                exit_codes[config_id] = process.returncode
+                if process.returncode == 0:
+                    print('Experiment %d finished' % config_id)
+                else:
+                    print('Experiment %d failed with exit code %d (see %s)' % (config_id, process.returncode,
+                                                                              output.name))
+    finally:
+        # don't leave orphaned workers behind (e.g. on KeyboardInterrupt)
+        for process, _, output in running.values():
+            process.terminate()
+            output.close()
+
+    nb_failed = sum(1 for code in exit_codes.values() if code != 0)
+    print('Done with %d experiments (%d failed)' % (len(exit_codes), nb_failed))
+    return exit_codes
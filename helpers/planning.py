@@ -0,0 +1,164 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from helpers.precision import get_dtype
+
+"""
+Pre-flight resource planning: estimates the memory usage and FLOPs of an experiment from its sizes before the model
+graph is built, and adapts the evaluation chunk sizes and sample counts s.t. the run fits into the available memory.
+
+The estimate only counts the dominant tensors (everything of size N x K x S x ... and N x K x L x L):
+  reconstructions (means and variances/logits), N x K x S x D, and the decoder's hidden layers, N x K x S x U
+  phi_tilde, its Cholesky factor and the x_k samples, N x K x L x L (and N x K x S x L)
+For training, the forward pass is kept for backprop (factor BACKPROP_FACTOR incl. the gradients). The imputation
+tensors are the perturbed copies of the (chunk of the) test set, stacked along the batch axis (see imputation_losses).
+All towers, the test inference and the evaluation worker are counted together since they share the host memory in the
+CPU case (conservative for GPUs).
+"""
+
+BACKPROP_FACTOR = 3
+MB = 1024. ** 2
+
+
+def available_memory():
+    """
+    Returns:
+        available host memory in bytes: the cgroup memory limit (e.g. set by slurm's --mem) or, if there is none, the
+        physical memory
+    """
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for cgroup_limit_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(cgroup_limit_file) as f:
+                limit = f.read().strip()
+        except IOError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    return memory
+
+
+def inference_bytes(N, K, S, L, D, U):
+    # dominant tensors of svae.inference for a batch of N data points, K components and S samples
+    nn_size = get_dtype('nn').size
+    pgm_size = get_dtype('pgm').size
+    return {
+        'reconstructions': 2 * N * K * S * D * nn_size,
+        'decoder_hidden': 2 * N * K * S * U * nn_size,
+        'phi_tilde': 3 * N * K * L * L * pgm_size + N * K * S * L * pgm_size
+    }
+
+
+def training_flops(N, K, S, L, D, U):
+    # multiply-adds of the forward pass (x2 for FLOPs) and backward pass (~2x the forward pass)
+    encoder = N * (D * U + U * U + U * 2 * L)
+    decoder = N * K * S * (L * U + U * U + U * 2 * D)
+    e_step = N * K * (L ** 3 / 3. + S * L * L)
+    return 2 * BACKPROP_FACTOR * (encoder + decoder + e_step)
+
+
+def estimate_resources(settings):
+    """
+    Args:
+        settings: dict with size_minibatch, nb_towers, N_te, D, K, L, U, S, top_k, nb_samples_te, nb_sample_chunks_te,
+            nb_samples_pert, nb_chunks_pert, size_eval_chunk and async_evaluation
+
+    Returns:
+        dict {part: bytes} of the training step, test inference, test imputation and (if async_evaluation) the
+        evaluation worker; training FLOPs per step
+    """
+    K = settings['K'] if settings['top_k'] is None else settings['top_k']
+    L, D, U = settings['L'], settings['D'], settings['U']
+    N_tower = settings['size_minibatch'] // settings['nb_towers']
+    N_te = settings['N_te']
+    P_chunk = settings['nb_samples_pert'] // settings['nb_chunks_pert']
+
+    estimate = {'training': settings['nb_towers'] * BACKPROP_FACTOR * sum(inference_bytes(N_tower, K, settings['S'], L,
+                                                                                          D, U).values())}
+    if settings['async_evaluation']:
+        # inline: one sample per test point for plotting; evaluation worker: one chunk of the test set at a time
+        N_eval = min(settings['size_eval_chunk'], N_te)
+        estimate['test_inference'] = sum(inference_bytes(N_te, K, 1, L, D, U).values())
+        estimate['eval_worker_inference'] = sum(inference_bytes(N_eval, K, settings['nb_samples_te'], L, D,
+                                                                U).values())
+        estimate['eval_worker_imputation'] = sum(inference_bytes(P_chunk * N_eval, K, settings['nb_samples_te'], L,
+                                                                 D, U).values())
+    else:
+        estimate['test_inference'] = sum(inference_bytes(N_te, K, settings['nb_samples_te'], L, D, U).values())
+        estimate['test_imputation'] = sum(inference_bytes(P_chunk * N_te, K, settings['nb_samples_te'], L, D,
+                                                          U).values())
+
+    return estimate, training_flops(settings['size_minibatch'], K, settings['S'], L, D, U)
+
+
+def _adjust(settings):
+    # one step towards a smaller memory footprint (None if nothing is left to adjust)
+    settings = dict(settings)
+
+    # 1. impute the perturbed samples in more chunks (next divisor of nb_samples_pert)
+    for nb_chunks in range(settings['nb_chunks_pert'] + 1, settings['nb_samples_pert'] + 1):
+        if settings['nb_samples_pert'] % nb_chunks == 0:
+            settings['nb_chunks_pert'] = nb_chunks
+            return settings, 'nb_chunks_pert=%d' % nb_chunks
+
+    # 2. evaluate smaller chunks of the test set
+    if settings['async_evaluation'] and settings['size_eval_chunk'] > 1:
+        settings['size_eval_chunk'] = max(1, min(settings['size_eval_chunk'], settings['N_te']) // 2)
+        return settings, 'size_eval_chunk=%d' % settings['size_eval_chunk']
+
+    # 3. fewer test samples at once (the evaluation worker's loglik estimate keeps the total nb of samples by streaming
+    # over more chunks)
+    if settings['nb_samples_te'] > 1 and settings['nb_samples_te'] % 2 == 0:
+        settings['nb_samples_te'] //= 2
+        settings['nb_sample_chunks_te'] *= 2
+        return settings, 'nb_samples_te=%d, nb_sample_chunks_te=%d' % (settings['nb_samples_te'],
+                                                                       settings['nb_sample_chunks_te'])
+    return None, None
+
+
+def plan_resources(settings, memory_budget=None, memory_margin=0.8):
+    """
+    Estimates the resources of an experiment and adapts the evaluation settings until the estimate fits.
+    Args:
+        settings: see estimate_resources
+        memory_budget: available memory in bytes (None: available_memory())
+        memory_margin: only this fraction of the budget is planned (the estimate neglects the smaller tensors and the
+            runtime's overhead)
+
+    Returns:
+        plan: dict containing the adapted settings, the memory estimate per part (MB), budget (MB), training GFLOPs per
+            step and the list of adjustments made
+
+    Raises:
+        MemoryError: if the training step alone exceeds the budget or the evaluation can't be made to fit
+    """
+    if memory_budget is None:
+        memory_budget = available_memory()
+    budget = memory_margin * memory_budget
+
+    adjustments = []
+    estimate, flops = estimate_resources(settings)
+    if estimate['training'] > budget:
+        raise MemoryError('The training step needs ~%.0fMB, but only %.0fMB are available; reduce size_minibatch, K, '
+                          'nb_samples or use top_k.' % (estimate['training'] / MB, budget / MB))
+
+    while sum(estimate.values()) > budget:
+        settings, adjustment = _adjust(settings)
+        if settings is None:
+            raise MemoryError('The experiment needs ~%.0fMB (%s), but only %.0fMB are available.' % (
+                sum(estimate.values()) / MB,
+                ', '.join('%s: %.0fMB' % (part, size / MB) for part, size in sorted(estimate.items())), budget / MB))
+        adjustments.append(adjustment)
+        estimate, flops = estimate_resources(settings)
+
+    return {
+        'settings': settings,
+        'estimate_mb': dict((part, size / MB) for part, size in estimate.items()),
+        'total_mb': sum(estimate.values()) / MB,
+        'budget_mb': budget / MB,
+        'training_gflops_per_step': flops / 1e9,
+        'adjustments': adjustments
+    }
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+"""
+Global numeric precision policy.
+
+The model graph is split into subsystems which can run in different precisions:
+  data: input pipeline (make_minibatch)
+  nn:   encoder/decoder networks, i.e. the large N x K x S x D reconstruction tensors
+  pgm:  recognition GMM and PGM parameters, e-step, m-step and KL regulariser (small K x L x L natural parameter algebra)
+  loss: reconstruction loglikelihood, ELBO and performance measures
+Tensors are cast where they cross from one subsystem to the next.
+
+Trainable float16 variables are stored in float32 (master weights) and cast to float16 where they are read, s.t. the
+optimizer updates them in float32 (e.g. Adam's epsilon=1e-8 underflows in float16). The gradients of float16 graphs
+are computed with static loss scaling (see compute_scaled_gradients) s.t. small gradients don't underflow.
+"""
+
+SUBSYSTEMS = ('data', 'nn', 'pgm', 'loss')
+DEFAULT_LOSS_SCALE_FP16 = 128.
+
+_policy = dict((subsystem, tf.float32) for subsystem in SUBSYSTEMS)
+_loss_scale = [1.]
+
+
+def set_precision(default=tf.float32, loss_scale=None, **overrides):
+    """
+    Sets the precision policy; has to be called before the graph is built.
+    Args:
+        default: dtype used for all subsystems which are not overridden
+        loss_scale: static loss scale (None: DEFAULT_LOSS_SCALE_FP16 if any subsystem runs in float16, 1 otherwise)
+        **overrides: per-subsystem dtypes, e.g. set_precision(tf.float32, nn=tf.float16, pgm=tf.float64)
+    """
+    for subsystem in overrides:
+        if subsystem not in SUBSYSTEMS:
+            raise ValueError("Subsystem '%s' does not exist. Choose one of %s." % (subsystem, str(SUBSYSTEMS)))
+
+    for subsystem in SUBSYSTEMS:
+        _policy[subsystem] = tf.as_dtype(overrides.get(subsystem, default))
+
+    if loss_scale is None:
+        loss_scale = DEFAULT_LOSS_SCALE_FP16 if tf.float16 in _policy.values() else 1.
+    _loss_scale[0] = float(loss_scale)
+
+
+def get_dtype(subsystem):
+    return _policy[subsystem]
+
+
+def get_policy():
+    return dict(_policy)
+
+
+def get_loss_scale():
+    return _loss_scale[0]
+
+
+def cast(x, subsystem, name='cast'):
+    # cast x to the subsystem's precision (no-op if it is already of this type)
+    dtype = _policy[subsystem]
+    if x.dtype.base_dtype == dtype:
+        return x
+    return tf.cast(x, dtype, name=name + '_to_' + subsystem)
+
+
+def storage_dtype(dtype, trainable=True):
+    # dtype in which a variable of the given dtype is stored (trainable float16 variables are kept in float32)
+    dtype = tf.as_dtype(dtype).base_dtype
+    return tf.float32 if trainable and dtype == tf.float16 else dtype
+
+
+def fp32_storage_getter(getter, name, *args, **kwargs):
+    """
+    Custom getter (tf.variable_scope(..., custom_getter=fp32_storage_getter)) which stores trainable float16 variables
+    in float32 and returns them cast to float16; the optimizer thus updates the float32 variables.
+    """
+    dtype = kwargs.get('dtype')
+    if dtype is None or storage_dtype(dtype, kwargs.get('trainable', True)) == tf.as_dtype(dtype).base_dtype:
+        return getter(name, *args, **kwargs)
+
+    kwargs['dtype'] = tf.float32
+    if isinstance(kwargs.get('initializer'), tf.Tensor):
+        kwargs['initializer'] = tf.cast(kwargs['initializer'], tf.float32)
+    variable = getter(name, *args, **kwargs)
+    return tf.cast(variable, dtype, name=name.split('/')[-1] + '_fp16')
+
+
+def compute_scaled_gradients(opt, loss, **kwargs):
+    """
+    opt.compute_gradients(loss) with static loss scaling: the loss is multiplied by get_loss_scale() before
+    backpropagation and the gradients (of the float32 variables) are divided by it afterwards.
+    Args:
+        opt: optimizer
+        loss: loss tensor
+        **kwargs: passed to opt.compute_gradients
+
+    Returns:
+        list of (gradient, variable) tuples
+    """
+    loss_scale = get_loss_scale()
+    if loss_scale == 1.:
+        return opt.compute_gradients(loss, **kwargs)
+
+    grads_and_vars = opt.compute_gradients(tf.multiply(loss, loss_scale, name='scaled_loss'), **kwargs)
+    with tf.name_scope('unscale_gradients'):
+        unscaled = []
+        for grad, var in grads_and_vars:
+            if isinstance(grad, tf.IndexedSlices):
+                grad = tf.IndexedSlices(grad.values / loss_scale, grad.indices, grad.dense_shape)
+            elif grad is not None:
+                grad = grad / loss_scale
+            unscaled.append((grad, var))
+        return unscaled
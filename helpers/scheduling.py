@@ -34,3 +34,23 @@ def create_schedule(param_ranges, verbose=False):
 
     return schedule
 
+
+
+def collect_fetches(i, nb_iters, fetches, periodic_fetches):
+    """
+    Collects everything that has to be evaluated in iteration i s.t. it can be fetched in a single session run.
+    Args:
+        i: current iteration
+        nb_iters: total number of iterations
+        fetches: dict of fetches evaluated in every iteration (e.g. the training step)
+        periodic_fetches: dict of the form {'name': (frequency, fetch, at_iter_1), ...}; fetch is evaluated if
+            i % frequency == 0, in the last iteration and (if at_iter_1 is True) in the second iteration
+
+    Returns:
+        dict containing fetches and the periodic fetches due in iteration i
+    """
+    due_fetches = dict(fetches)
+    for name, (frequency, fetch, at_iter_1) in periodic_fetches.items():
+        if i % frequency == 0 or i == nb_iters - 1 or (at_iter_1 and i == 1):
+            due_fetches[name] = fetch
+    return due_fetches
@@ -4,24 +4,81 @@ from __future__ import print_function
 
 import tensorflow as tf
 
+from helpers.precision import get_dtype, storage_dtype
 
-def variable_on_device(name, shape, initializer, trainable=True, dtype=tf.float32, device='/gpu:0'):
+
+def variable_on_device(name, shape, initializer, trainable=True, dtype=None, device='/gpu:0'):
     """Helper to create a Variable stored on specified device.
     Args:
       name: name of the variable
       shape: list of ints
       initializer: initializer for Variable
       trainable: indicates whether variable is trainable
-      dtype: variable's type
+      dtype: variable's type; if None, the initializer's type (if it is a tensor) or the 'pgm' precision
       device: indicates where variable should be stored
     Returns:
-      Variable Tensor
+      Variable Tensor; trainable float16 variables are stored in float32 and returned cast to float16
     """
+    if dtype is None:
+        if isinstance(initializer, tf.Tensor):
+            dtype = initializer.dtype.base_dtype
+        else:
+            dtype = get_dtype('pgm')
+    var_dtype = storage_dtype(dtype, trainable)
+    if isinstance(initializer, tf.Tensor) and initializer.dtype.base_dtype != var_dtype:
+        initializer = tf.cast(initializer, var_dtype)
     with tf.device(device):
-        var = tf.get_variable(name, shape=shape, initializer=initializer, trainable=trainable, dtype=dtype)
+        var = tf.get_variable(name, shape=shape, initializer=initializer, trainable=trainable, dtype=var_dtype)
+        if var_dtype != dtype:
+            var = tf.cast(var, dtype, name=name + '_fp16')
     return var
 
 
+def tower_devices(nb_towers, device_type='gpu'):
+    """
+    Devices on which the model replicas (towers) are placed.
+    Args:
+        nb_towers: number of towers
+        device_type: 'gpu' (one tower per GPU) or 'cpu' (one tower per logical CPU device, see make_session_config)
+
+    Returns:
+        list of device names
+    """
+    if device_type not in ['gpu', 'cpu']:
+        raise NotImplementedError("Towers can't be placed on devices of type '%s'." % device_type)
+    return ['/%s:%d' % (device_type, tower_id) for tower_id in range(nb_towers)]
+
+
+def make_session_config(nb_towers=1, device_type='gpu', nb_threads_per_tower=None, log_device_placement=False,
+                        nb_threads=None):
+    """
+    Session configuration matching tower_devices.
+    For CPU towers, nb_towers logical CPU devices are created. The towers are executed concurrently on the inter-op
+    thread pool (TF default size) and share an intra-op thread pool with nb_threads_per_tower threads per tower.
+    Args:
+        nb_towers: number of towers
+        device_type: 'gpu' or 'cpu'
+        nb_threads_per_tower: intra-op threads per CPU tower; if None, TensorFlow uses all cores
+        log_device_placement: log device placement
+        nb_threads: if not None, caps the intra- and inter-op thread pools (e.g. if several runs share the machine)
+
+    Returns:
+        tf.ConfigProto
+    """
+    sess_config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=log_device_placement)
+    if device_type == 'cpu':
+        sess_config.device_count['CPU'] = nb_towers
+        if nb_threads_per_tower is not None:
+            sess_config.intra_op_parallelism_threads = nb_threads_per_tower * nb_towers
+    if nb_threads is not None:
+        # 0 means 'TF default', i.e. one thread per core
+        sess_config.intra_op_parallelism_threads = min(sess_config.intra_op_parallelism_threads or nb_threads,
+                                                       nb_threads)
+        sess_config.inter_op_parallelism_threads = min(sess_config.inter_op_parallelism_threads or nb_threads,
+                                                       nb_threads)
+    return sess_config
+
+
 def logdet(A, name='logdet'):
     """
     Numerically stable implementation of log(det(A)) for symmetric positive definite matrices
@@ -49,39 +106,108 @@ def logdet(A, name='logdet'):
         )
 
 
-def average_gradients(tower_grads):
+def average_gradients(tower_grads, bucket_size=2**20, name='average_gradients'):
     """
     Calculate average gradient for each shared variable across all towers.
+    Instead of stacking and averaging every gradient separately, the gradients are flattened into a few contiguous
+    buckets (per dtype, with at most bucket_size elements). The buckets are summed across towers and split into the
+    per-variable gradients again.
     Note that this function provides a synchronization point across all towers.
     Args:
       tower_grads: List of lists of (gradient, variable) tuples. The outer list
         is over individual gradients. The inner list is over the gradient
         calculation for each tower.
+      bucket_size: max. number of elements per bucket (a larger variable gets its own bucket)
+      name: tf name scope
     Returns:
        List of pairs of (gradient, variable) where the gradient has been
-       averaged across all towers.
+       averaged across all towers. The gradient is None if no tower computed a gradient for the variable.
+    """
+    with tf.name_scope(name):
+        # Keep in mind that the Variables are redundant because they are shared
+        # across towers. So we will just use the first tower's pointer to
+        # the Variable.
+        variables = [v for _, v in tower_grads[0]]
+        average_grads = [None] * len(variables)
+
+        # sort variables with gradients into buckets; each bucket is a list of variable indices
+        buckets = []
+        open_buckets = {}  # currently filled bucket and its size for each dtype
+        for var_id, grad_and_vars in enumerate(zip(*tower_grads)):
+            # gradients can be missing (None) for some or all towers
+            if all(g is None for g, _ in grad_and_vars):
+                continue
+
+            var = variables[var_id]
+            dtype = var.dtype.base_dtype
+            var_size = var.get_shape().num_elements()
+            bucket, size = open_buckets.get(dtype, (None, 0))
+            if bucket is None or size + var_size > bucket_size:
+                bucket, size = [], 0
+                buckets.append(bucket)
+            bucket.append(var_id)
+            open_buckets[dtype] = (bucket, size + var_size)
+
+        for bucket_id, bucket in enumerate(buckets):
+            with tf.name_scope('bucket_%d' % bucket_id):
+                # flatten and concatenate the gradients of this bucket for each tower
+                flat_tower_buckets = []
+                for grads_and_vars in tower_grads:
+                    flat_grads = []
+                    for var_id in bucket:
+                        g = grads_and_vars[var_id][0]
+                        if g is None:
+                            # this tower does not contribute to the variable's gradient
+                            g = tf.zeros_like(variables[var_id])
+                        flat_grads.append(tf.reshape(tf.convert_to_tensor(g), (-1,)))
+                    flat_tower_buckets.append(tf.concat(flat_grads, axis=0) if len(flat_grads) > 1 else flat_grads[0])
+
+                # sum over towers (without stacking the towers' gradients)
+                bucket_sum = tf.add_n(flat_tower_buckets, name='sum_towers')
+
+                # split bucket and average over the towers which computed the gradient
+                sizes = [variables[var_id].get_shape().num_elements() for var_id in bucket]
+                for var_id, flat_grad in zip(bucket, tf.split(bucket_sum, sizes, axis=0)):
+                    var = variables[var_id]
+                    nb_contributing_towers = sum(g is not None for g in [grads[var_id][0] for grads in tower_grads])
+                    average_grads[var_id] = tf.reshape(flat_grad / nb_contributing_towers, var.get_shape())
+
+        return list(zip(average_grads, variables))
+
+
+def accumulate_gradients(grads_and_vars, nb_micro_batches, name='accumulate_gradients'):
     """
-    average_grads = []
-    for grad_and_vars in zip(*tower_grads):
+    Accumulates gradients over several micro-batches before they are applied.
+    Usage: run accumulate_step for the first nb_micro_batches - 1 micro-batches; for the last micro-batch, run the
+    optimizer on accumulated_grads_and_vars (which adds the current micro-batch) and reset the accumulators afterwards.
+    Args:
+        grads_and_vars: list of (gradient, variable) tuples (gradient can be None)
+        nb_micro_batches: number of micro-batches to average over
+        name: tf name scope
 
-        # Note that each grad_and_vars looks as follows:
-        #   ((grad0_gpu0, var0_gpu0), ... , (grad0_gpuN, var0_gpuN))
-        grads = []
-        for g, _ in grad_and_vars:
-            # Add 0 dimension to the gradients to represent the tower.
-            expanded_g = tf.expand_dims(g, 0)
+    Returns:
+        accumulate_step: adds the current micro-batch's gradients to the accumulators
+        accumulated_grads_and_vars: list of (averaged gradient, variable) tuples including the current micro-batch
+        accumulators: accumulator variables (have to be reset to zero after the gradients have been applied)
+    """
+    with tf.name_scope(name):
+        accumulations = []
+        accumulated_grads_and_vars = []
+        accumulators = []
+        for g, v in grads_and_vars:
+            if g is None:
+                accumulated_grads_and_vars.append((None, v))
+                continue
 
-            # Append on a 'tower' dimension which we will average over below.
-            grads.append(expanded_g)
+            # accumulator is stored next to the variable
+            with tf.device(v.device):
+                acc = tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), trainable=False,
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES], name='acc_' + v.op.name.split('/')[-1])
+            accumulators.append(acc)
 
-        # Average over the 'tower' dimension.
-        grad = tf.concat(grads, 0)
-        grad = tf.reduce_mean(grad, 0)
+            # assign_add returns the updated accumulator
+            accumulated = tf.assign_add(acc, tf.convert_to_tensor(g))
+            accumulations.append(accumulated)
+            accumulated_grads_and_vars.append((accumulated / nb_micro_batches, v))
 
-        # Keep in mind that the Variables are redundant because they are shared
-        # across towers. So we will just return the first tower's pointer to
-        # the Variable.
-        v = grad_and_vars[0][1]
-        grad_and_var = (grad, v)
-        average_grads.append(grad_and_var)
-    return average_grads
+        return tf.group(*accumulations, name='accumulate_step'), accumulated_grads_and_vars, accumulators
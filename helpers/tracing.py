@@ -0,0 +1,264 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import csv
+import numpy as np
+import os
+import re
+import tensorflow as tf
+
+from tensorflow.python.client import timeline
+
+"""
+Opt-in execution tracing of single training steps.
+
+Only the traced steps are run with FULL_TRACE. For every traced step i, three files are written to the trace directory:
+  step<i>.json:        Chrome trace (open in chrome://tracing)
+  step<i>_ops.csv:     compute time per device and op type
+  step<i>_scopes.csv:  compute time per device and name scope; times are inclusive, i.e. tower_0/e_step contains the
+                       time of all ops below tower_0/e_step/...
+The CSV tables are sorted by time s.t. the hot spots of two commits can be compared with diff.
+
+Independently of tracing, the training loop records the wall-clock time of every step (StepStatistics) and attributes
+the step time of sampled steps to the phases of the SVAE training step (phase_times).
+"""
+
+# phases of the training step: (phase, name scopes); an op belongs to the first phase with a matching scope in its name
+# (reused scopes are uniquified by TF, e.g. encoder_net_1). Gradient ops are named gradients/<forward op>, s.t. the
+# backward pass is matched before the forward phases.
+PHASES = [
+    ('input_dequeue', ['data_prep']),  # dequeue from the shuffle_batch queue, i.e. incl. waiting for the queue runners
+    ('backprop', ['gradients']),
+    ('gradient_aggregation', ['average_gradients', 'accumulate_gradients']),
+    ('adam', ['Adam']),
+    ('cvi_update', ['GMM_update']),
+    ('encoder', ['encoder_net']),
+    ('e_step', ['e_step', 'subsample_x']),
+    ('decoder', ['decoder_net']),
+    ('elbo', ['elbo']),
+]
+PHASE_NAMES = [phase for phase, _ in PHASES] + ['other']
+
+
+def is_traced_step(i, trace_freq=None, trace_window=None):
+    """
+    Args:
+        i: current iteration
+        trace_freq: every trace_freq-th iteration is traced (None: no periodic tracing)
+        trace_window: (first, last) iteration of a window of traced iterations (None: no window)
+
+    Returns:
+        True if iteration i is traced
+    """
+    if trace_freq is not None and i > 0 and i % trace_freq == 0:
+        return True
+    if trace_window is not None and trace_window[0] <= i <= trace_window[1]:
+        return True
+    return False
+
+
+def make_trace_options(trace_level=tf.RunOptions.FULL_TRACE):
+    # run options and metadata container for a traced session run
+    return tf.RunOptions(trace_level=trace_level), tf.RunMetadata()
+
+
+def _op_type(node_stats):
+    # the timeline label has the form 'node_name = OpType(inputs)'; GPU stream stats are labeled 'node_name:OpType'
+    label = node_stats.timeline_label
+    if ' = ' in label:
+        return label.split(' = ', 1)[1].split('(', 1)[0]
+    if ':' in node_stats.node_name:
+        return node_stats.node_name.split(':', 1)[1]
+    return node_stats.node_name
+
+
+def _is_duplicate_stream(device):
+    # GPU kernels are listed per stream and again under /stream:all; only the latter is counted
+    return '/stream:' in device and not device.endswith('/stream:all')
+
+
+def op_time_tables(step_stats):
+    """
+    Aggregates the op execution times of a traced step.
+    Args:
+        step_stats: RunMetadata.step_stats
+
+    Returns:
+        op_times: dict {(device, op_type): [nb_ops, time in us]}
+        scope_times: dict {(device, name_scope): [nb_ops, time in us]} with inclusive times (ops outside of any name
+            scope are not listed)
+    """
+    op_times = collections.defaultdict(lambda: [0, 0])
+    scope_times = collections.defaultdict(lambda: [0, 0])
+
+    for dev_stats in step_stats.dev_stats:
+        if _is_duplicate_stream(dev_stats.device):
+            continue
+
+        for node_stats in dev_stats.node_stats:
+            duration = node_stats.all_end_rel_micros
+            node_name = node_stats.node_name.split(':', 1)[0]
+
+            op_entry = op_times[(dev_stats.device, _op_type(node_stats))]
+            op_entry[0] += 1
+            op_entry[1] += duration
+
+            # add the op's time to all enclosing scopes
+            scopes = node_name.split('/')[:-1]
+            for depth in range(1, len(scopes) + 1):
+                scope_entry = scope_times[(dev_stats.device, '/'.join(scopes[:depth]))]
+                scope_entry[0] += 1
+                scope_entry[1] += duration
+
+    return op_times, scope_times
+
+
+def _write_time_table(path, key_name, times, total_per_device):
+    # time_ratio: fraction of the total op time on the device
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['device', key_name, 'nb_ops', 'time_us', 'time_ratio'])
+        for key, (nb_ops, duration) in sorted(times.items(), key=lambda item: (item[0][0], -item[1][1])):
+            ratio = duration / total_per_device[key[0]] if total_per_device[key[0]] > 0 else 0.
+            writer.writerow(list(key) + [nb_ops, duration, '%.4f' % ratio])
+
+
+def save_trace(run_metadata, trace_dir, step, show_memory=False):
+    """
+    Writes the Chrome trace and the per-op and per-name-scope time tables of a traced step.
+    Args:
+        run_metadata: RunMetadata filled by a session run with the options from make_trace_options
+        trace_dir: output directory (created if it does not exist)
+        step: iteration number (used in the file names)
+        show_memory: add memory allocations to the Chrome trace
+    """
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+    path_prefix = os.path.join(trace_dir, 'step%d' % step)
+
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(path_prefix + '.json', 'w') as f:
+        f.write(trace.generate_chrome_trace_format(show_memory=show_memory))
+
+    op_times, scope_times = op_time_tables(run_metadata.step_stats)
+    total_per_device = collections.defaultdict(int)
+    for (device, _), (_, duration) in op_times.items():
+        total_per_device[device] += duration
+
+    _write_time_table(path_prefix + '_ops.csv', 'op_type', op_times, total_per_device)
+    _write_time_table(path_prefix + '_scopes.csv', 'name_scope', scope_times, total_per_device)
+
+
+def _phase_of(node_name, phase_patterns):
+    scopes = node_name.split('/')[:-1]
+    for phase, pattern in phase_patterns:
+        if any(pattern.match(scope) for scope in scopes):
+            return phase
+    return 'other'
+
+
+def _union_length(intervals):
+    # total length covered by a list of (start, end) intervals
+    length = 0
+    covered_until = None
+    for start, end in sorted(intervals):
+        if covered_until is None or start > covered_until:
+            length += end - start
+            covered_until = end
+        elif end > covered_until:
+            length += end - covered_until
+            covered_until = end
+    return length
+
+
+def phase_times(step_stats, phases=PHASES):
+    """
+    Attributes the wall-clock time of a step to its phases. Ops of a phase run concurrently (on several devices and
+    inter-op threads), therefore the time of a phase is the length of the union of its op intervals and not the sum
+    of its op times.
+    Args:
+        step_stats: RunMetadata.step_stats of a step run with trace_level >= SOFTWARE_TRACE
+        phases: list of (phase, name scopes), see PHASES
+
+    Returns:
+        dict {phase: wall-clock time in ms}; ops which don't belong to any phase are attributed to 'other'
+    """
+    phase_patterns = [(phase, re.compile('^%s(_[0-9]+)?$' % re.escape(scope)))
+                      for phase, scopes in phases for scope in scopes]
+
+    intervals = collections.defaultdict(list)
+    for dev_stats in step_stats.dev_stats:
+        if _is_duplicate_stream(dev_stats.device):
+            continue
+        for node_stats in dev_stats.node_stats:
+            phase = _phase_of(node_stats.node_name.split(':', 1)[0], phase_patterns)
+            start = node_stats.all_start_micros
+            intervals[phase].append((start, start + node_stats.all_end_rel_micros))
+
+    return dict((phase, _union_length(phase_intervals) / 1000.) for phase, phase_intervals in intervals.items())
+
+
+class StepStatistics(object):
+    """
+    Rolling statistics of the step latency, throughput and phase times; written as TensorBoard scalars and to a CSV
+    sidecar file (one row per summary).
+    """
+
+    def __init__(self, csv_path, window=500, percentiles=(50, 95, 99), phase_names=PHASE_NAMES, append=False):
+        """
+        Args:
+            csv_path: path of the CSV file (overwritten unless append)
+            window: the statistics are computed over the last window steps (and phase measurements)
+            percentiles: percentiles of the step latency
+            phase_names: phases reported (see phase_times)
+            append: append to an existing CSV file (e.g. of an interrupted run which is resumed)
+        """
+        self.csv_path = csv_path
+        self.percentiles = percentiles
+        self.phase_names = phase_names
+        self.step_times = collections.deque(maxlen=window)
+        self.step_samples = collections.deque(maxlen=window)
+        self.phase_meas = dict((phase, collections.deque(maxlen=window)) for phase in phase_names)
+
+        self.columns = ['step', 'samples_per_sec'] + ['step_time_p%d_ms' % p for p in percentiles] + \
+                       ['%s_p50_ms' % phase for phase in phase_names]
+        if not (append and os.path.exists(self.csv_path)):
+            with open(self.csv_path, 'w') as f:
+                csv.writer(f).writerow(self.columns)
+
+    def add_step(self, duration, nb_samples):
+        # duration in seconds; nb_samples: nb data points processed in this step
+        self.step_times.append(duration)
+        self.step_samples.append(nb_samples)
+
+    def add_phase_times(self, times):
+        # times: dict {phase: ms} as returned by phase_times; phases without ops took 0 ms
+        for phase in self.phase_names:
+            self.phase_meas[phase].append(times.get(phase, 0.))
+
+    def summarise(self, step):
+        """
+        Appends the current statistics to the CSV file.
+        Args:
+            step: current iteration
+
+        Returns:
+            tf.Summary containing the statistics as scalars (empty if no step has been recorded yet)
+        """
+        if len(self.step_times) == 0:
+            return tf.Summary()
+
+        values = {'step': step, 'samples_per_sec': np.sum(self.step_samples) / np.sum(self.step_times)}
+        for p in self.percentiles:
+            values['step_time_p%d_ms' % p] = 1000 * np.percentile(self.step_times, p)
+        for phase in self.phase_names:
+            if len(self.phase_meas[phase]) > 0:
+                values['%s_p50_ms' % phase] = np.percentile(self.phase_meas[phase], 50)
+
+        with open(self.csv_path, 'a') as f:
+            csv.writer(f).writerow([values.get(column, '') for column in self.columns])
+
+        return tf.Summary(value=[tf.Summary.Value(tag='timing/' + column, simple_value=values[column])
+                                 for column in self.columns[1:] if column in values])
@@ -5,6 +5,8 @@ from __future__ import print_function
 import tensorflow as tf
 import numpy as np
 
+from helpers.precision import cast, get_dtype
+
 
 def weighted_mse(y_true, y_pred, r_nk_pred, name='mse'):
     """
@@ -21,6 +23,7 @@ def weighted_mse(y_true, y_pred, r_nk_pred, name='mse'):
         N, K, S, D = y_pred.get_shape().as_list()
         assert y_true.get_shape() == (N, D)
         assert r_nk_pred.get_shape() == (N, K)
+        y_true, y_pred, r_nk_pred = [cast(t, 'loss') for t in (y_true, y_pred, r_nk_pred)]
 
         # mean square error (square euclidean distance averaged over samples); shape = N, K
         mse = tf.reduce_mean(
@@ -38,7 +41,18 @@ def weighted_mse(y_true, y_pred, r_nk_pred, name='mse'):
             name='mse')  # mean over data points; shape = 1
 
 
-def bernoulli_logprob(y_true_bin, logits, log_weights=None, missing_data_mask=None, name='bernoulli_logprob'):
+def bernoulli_logprob_per_sample(y_true_bin, logits, log_weights=None, missing_data_mask=None,
+                                 name='bernoulli_logprob_per_sample'):
+    """
+    Args:
+        y_true_bin: binary data in {-1, 1}; shape = N, D
+        logits: predicted bernoulli logits; shape = N, S, D or (if log_weights is not None) N, K, S, D
+        log_weights: predicted component responsibilities: shape = (N, K) or shape = (N, K, S)
+        missing_data_mask: if not None, only the loglikelihood of the missing values is computed
+
+    Returns:
+        log p(y_n|x_s) (components are integrated out if log_weights is not None); shape = N, S
+    """
     with tf.name_scope(name):
         if log_weights is None:
             N, S, D = logits.get_shape().as_list()
@@ -48,6 +62,10 @@ def bernoulli_logprob(y_true_bin, logits, log_weights=None, missing_data_mask=No
             if log_weights.get_shape() == (N, K):
                 log_weights = tf.expand_dims(log_weights, 2)
         assert y_true_bin.get_shape() == (N, D)
+        dtype = get_dtype('loss')
+        y_true_bin, logits = cast(y_true_bin, 'loss'), cast(logits, 'loss')
+        if log_weights is not None:
+            log_weights = cast(log_weights, 'loss')
 
         # add dimensions for S (and K)
         y_true_bin = tf.expand_dims(y_true_bin, axis=1)
@@ -58,7 +76,7 @@ def bernoulli_logprob(y_true_bin, logits, log_weights=None, missing_data_mask=No
 
         # set log p(y_nd = ŷ_nd) = 0 if y_nd is observed.
         if missing_data_mask is not None:
-            missing_data_mask = tf.expand_dims(tf.to_float(missing_data_mask), axis=1)
+            missing_data_mask = tf.expand_dims(tf.cast(missing_data_mask, dtype), axis=1)
             if log_weights is not None:
                 missing_data_mask = tf.expand_dims(missing_data_mask, axis=1)
 
@@ -71,26 +89,35 @@ def bernoulli_logprob(y_true_bin, logits, log_weights=None, missing_data_mask=No
         if log_weights is not None:
             logprobs = tf.reduce_logsumexp(tf.add(logprobs, log_weights), axis=1, name='log_p_y_x')
 
+        return logprobs
+
+
+def bernoulli_logprob(y_true_bin, logits, log_weights=None, missing_data_mask=None, name='bernoulli_logprob'):
+    with tf.name_scope(name):
+        S = logits.get_shape().as_list()[-2]
+        logprobs = bernoulli_logprob_per_sample(y_true_bin, logits, log_weights, missing_data_mask)
+
         # integrate out x: log(1/S SUM^S p(y_n|x*, z))
         img_logprobs = tf.subtract(tf.reduce_logsumexp(logprobs, axis=-1),
-                                   tf.constant(S, dtype=tf.float32, name='nb_samples'),
+                                   tf.constant(S, dtype=logprobs.dtype, name='nb_samples'),
                                    name='log_p_y')
 
         # average over batch: return mean reconstruction loglike
         return tf.reduce_mean(img_logprobs, name='log_p_yn')
 
 
-def diagonal_gaussian_logprob(y_true, mean, var, log_weights, mask=None, name='gauss_logprob'):
+def diagonal_gaussian_logprob_per_sample(y_true, mean, var, log_weights, mask=None,
+                                         name='gauss_logprob_per_sample'):
     """
-
     Args:
-        y_true:
+        y_true: data; shape = N, D
         mean: predicted reconstruction means; shape = N, K, S, D
         var: predicted reconstruction variances (diagonal); shape = N, K, S, D
         log_weights: predicted component responsibilities: shape = (N, K) or shape = (N, K, S)
+        mask: if not None, only the loglikelihood of the masked (missing) values is computed
         name:
     Returns:
-        log p(y) = log 1/S SUM^S N(y|mu(x), var(x)); z ~ q(y|x, phi)
+        log N(y|mu(x_s), var(x_s)) + log_weights; shape = N, K, S
     """
     with tf.name_scope(name):
         N, K, S, D = mean.get_shape().as_list()
@@ -99,6 +126,8 @@ def diagonal_gaussian_logprob(y_true, mean, var, log_weights, mask=None, name='g
         assert log_weights.get_shape() == (N, K) or log_weights.get_shape() == (N, K, S)
         if mask is not None:
             assert mask.get_shape() == (N, D)
+        dtype = get_dtype('loss')
+        y_true, mean, var, log_weights = [cast(t, 'loss') for t in (y_true, mean, var, log_weights)]
 
         # add dimensions s.t. y_true.shape = N, 1, 1, D
         y_true = tf.expand_dims(tf.expand_dims(y_true, 1), 2)
@@ -107,21 +136,39 @@ def diagonal_gaussian_logprob(y_true, mean, var, log_weights, mask=None, name='g
         with tf.name_scope('p_y_given_x_z'):
             log_p_y_given_x_z = tf.divide(tf.square(y_true - mean), var)
             log_p_y_given_x_z += tf.log(var)
-            log_p_y_given_x_z += tf.constant(np.log(2 * np.pi), dtype=tf.float32, name='log2pi')
+            log_p_y_given_x_z += tf.constant(np.log(2 * np.pi), dtype=dtype, name='log2pi')
             log_p_y_given_x_z *= -0.5
 
             # keep only imputed logliks: for 'observed values', set log p(y_nd = ŷ_nd) = 0
             if mask is not None:
                 with tf.name_scope('mask_missing_data'):
                     log_p_y_given_x_z = tf.multiply(
-                        tf.to_float(tf.expand_dims(tf.expand_dims(mask, 1), 2)),
+                        tf.cast(tf.expand_dims(tf.expand_dims(mask, 1), 2), dtype),
                         log_p_y_given_x_z,
                         name='missing_data')
 
             # sum over dimensions and add log_weights; shape = N, K, S
             if len(log_weights.get_shape()) == 2:
                 log_weights = tf.expand_dims(log_weights, 2)
-            log_p_y_given_x_z = tf.add(tf.reduce_sum(log_p_y_given_x_z, axis=3), log_weights, name='log_p_y_given_x_z')
+            return tf.add(tf.reduce_sum(log_p_y_given_x_z, axis=3), log_weights, name='log_p_y_given_x_z')
+
+
+def diagonal_gaussian_logprob(y_true, mean, var, log_weights, mask=None, name='gauss_logprob'):
+    """
+
+    Args:
+        y_true:
+        mean: predicted reconstruction means; shape = N, K, S, D
+        var: predicted reconstruction variances (diagonal); shape = N, K, S, D
+        log_weights: predicted component responsibilities: shape = (N, K) or shape = (N, K, S)
+        name:
+    Returns:
+        log p(y) = log 1/S SUM^S N(y|mu(x), var(x)); z ~ q(y|x, phi)
+    """
+    with tf.name_scope(name):
+        N, K, S, D = mean.get_shape().as_list()
+        dtype = get_dtype('loss')
+        log_p_y_given_x_z = diagonal_gaussian_logprob_per_sample(y_true, mean, var, log_weights, mask)
 
         # integrate out x: log(1/S SUM^S p(y|x*, z)) = log(SUM^S p(y|x*, z)) - log(S)
         with tf.name_scope('int_out_x'):
@@ -131,7 +178,7 @@ def diagonal_gaussian_logprob(y_true, mean, var, log_weights, mask=None, name='g
                     tf.log(tf.reduce_sum(tf.exp(log_p_y_given_x_z - max_y_given_x_z), axis=2)),
                     tf.reshape(max_y_given_x_z, (N, K)))
             # divide by sample size (= subract log(S))
-            log_p_y_given_z -= tf.log(tf.constant(S, dtype=tf.float32), name='log_p_y_given_z')  # shape = (N, K)
+            log_p_y_given_z -= tf.log(tf.constant(S, dtype=dtype), name='log_p_y_given_z')  # shape = (N, K)
 
         # integrate out z (sum over weighted components):
         with tf.name_scope('int_out_z'):
@@ -145,17 +192,128 @@ def diagonal_gaussian_logprob(y_true, mean, var, log_weights, mask=None, name='g
         return tf.reduce_mean(p_y, name='log_p_yn')
 
 
+def streaming_log_sum_exp(log_values, chunk_fn, nb_chunks, axis, sums=(), name='streaming_log_sum_exp'):
+    """
+    Computes log SUM exp(log_values) over axis and over several chunks of log values without keeping more than one
+    chunk in memory: a running max and a running sum of exp(log_values - max) are kept for every remaining entry.
+    The chunks (except the first one) are generated in a tf.while_loop.
+    Args:
+        log_values: log values of the first chunk
+        chunk_fn: builds the next chunk (called inside the while loop); returns log values (same shape as log_values)
+            and a list of values (same shapes as sums) which are summed over the chunks
+        nb_chunks: total number of chunks (incl. the first one)
+        axis: axis or list of axes to reduce
+        sums: values of the first chunk which are summed over all chunks (e.g. chunk MSEs)
+        name: tf name scope
+
+    Returns:
+        log SUM exp over axis and all chunks; list of summed values
+    """
+    with tf.name_scope(name):
+        axis = [axis] if isinstance(axis, int) else list(axis)
+
+        # running max and sum (reduced dimensions are kept for broadcasting)
+        running_max = tf.reduce_max(log_values, axis=axis, keep_dims=True)
+        running_sum = tf.reduce_sum(tf.exp(log_values - running_max), axis=axis, keep_dims=True)
+        sums = list(sums)
+
+        if nb_chunks > 1:
+            def cond(i, running_max, running_sum, *sums):
+                return i < nb_chunks
+
+            def body(i, running_max, running_sum, *sums):
+                chunk_log_values, chunk_sums = chunk_fn()
+
+                # rescale running sum to the new max
+                new_max = tf.maximum(running_max, tf.reduce_max(chunk_log_values, axis=axis, keep_dims=True))
+                running_sum = tf.add(running_sum * tf.exp(running_max - new_max),
+                                     tf.reduce_sum(tf.exp(chunk_log_values - new_max), axis=axis, keep_dims=True))
+
+                return [i + 1, new_max, running_sum] + [s + cs for s, cs in zip(sums, chunk_sums)]
+
+            loop_vars = tf.while_loop(cond, body, [tf.constant(1), running_max, running_sum] + sums,
+                                      back_prop=False, name='chunk_loop')
+            running_max, running_sum, sums = loop_vars[1], loop_vars[2], list(loop_vars[3:])
+
+        log_sum_exp = tf.squeeze(running_max + tf.log(running_sum), axis=axis, name='log_sum_exp')
+        return log_sum_exp, sums
+
+
+def streaming_diagonal_gaussian_logprob(y_true, mean, var, log_weights, sample_chunk_fn, nb_chunks, mask=None,
+                                        name='streaming_gauss_logprob'):
+    """
+    Same estimate as diagonal_gaussian_logprob, but the samples are consumed in nb_chunks chunks of S samples s.t.
+    nb_chunks * S samples can be used at the memory cost of S samples.
+    Args:
+        y_true: data; shape = N, D
+        mean, var, log_weights: first chunk (see diagonal_gaussian_logprob)
+        sample_chunk_fn: returns (mean, var, log_weights) of a new chunk of samples (called inside a tf.while_loop)
+        nb_chunks: number of chunks (incl. the first one)
+        mask: if not None, only the loglikelihood of the masked (missing) values is computed
+
+    Returns:
+        log p(y) = log 1/(nb_chunks*S) SUM N(y|mu(x), var(x)); averaged over data points
+    """
+    with tf.name_scope(name):
+        S = mean.get_shape().as_list()[2]
+        log_p_y_given_x_z = diagonal_gaussian_logprob_per_sample(y_true, mean, var, log_weights, mask)
+
+        def chunk_fn():
+            return diagonal_gaussian_logprob_per_sample(y_true, *sample_chunk_fn(), mask=mask), []
+
+        # integrate out x (over samples of all chunks)
+        log_sum_p_y_given_z, _ = streaming_log_sum_exp(log_p_y_given_x_z, chunk_fn, nb_chunks, axis=2)
+        log_p_y_given_z = tf.subtract(log_sum_p_y_given_z,
+                                      tf.log(tf.constant(nb_chunks * S, dtype=log_sum_p_y_given_z.dtype)),
+                                      name='log_p_y_given_z')  # shape = N, K
+
+        # integrate out z and average over batch
+        return tf.reduce_mean(tf.reduce_logsumexp(log_p_y_given_z, axis=1), name='log_p_yn')
+
+
+def streaming_bernoulli_logprob(y_true_bin, logits, log_weights, sample_chunk_fn, nb_chunks, missing_data_mask=None,
+                                name='streaming_bernoulli_logprob'):
+    """
+    Same estimate as bernoulli_logprob, but the samples are consumed in nb_chunks chunks of S samples (see
+    streaming_diagonal_gaussian_logprob).
+    Args:
+        y_true_bin: binary data in {-1, 1}; shape = N, D
+        logits, log_weights: first chunk (see bernoulli_logprob)
+        sample_chunk_fn: returns (logits, log_weights) of a new chunk of samples (called inside a tf.while_loop)
+        nb_chunks: number of chunks (incl. the first one)
+        missing_data_mask: if not None, only the loglikelihood of the missing values is computed
+
+    Returns:
+        mean reconstruction loglike
+    """
+    with tf.name_scope(name):
+        S = logits.get_shape().as_list()[-2]
+        logprobs = bernoulli_logprob_per_sample(y_true_bin, logits, log_weights, missing_data_mask)
+
+        def chunk_fn():
+            return bernoulli_logprob_per_sample(y_true_bin, *sample_chunk_fn(),
+                                                missing_data_mask=missing_data_mask), []
+
+        # integrate out x (over samples of all chunks; normalised as in bernoulli_logprob)
+        log_sum_p_y, _ = streaming_log_sum_exp(logprobs, chunk_fn, nb_chunks, axis=1)
+        img_logprobs = tf.subtract(log_sum_p_y, tf.constant(nb_chunks * S, dtype=log_sum_p_y.dtype,
+                                                            name='nb_samples'), name='log_p_y')
+        return tf.reduce_mean(img_logprobs, name='log_p_yn')
+
+
 def imputation_mse(y_true, y_pred, r_nk_pred, missing_data_mask, name='imp_mse'):
     with tf.name_scope(name):
         N, K, S, D = y_pred.get_shape().as_list()
         assert y_true.get_shape() == (N, D)
         assert r_nk_pred.get_shape() == (N, K)
         assert missing_data_mask.get_shape() == (N, D)
+        dtype = get_dtype('loss')
+        y_true, y_pred, r_nk_pred = [cast(t, 'loss') for t in (y_true, y_pred, r_nk_pred)]
 
         # set observed values to 0 in ground truth and predictions
-        y_true_missing = tf.multiply(y_true, tf.to_float(missing_data_mask))
+        y_true_missing = tf.multiply(y_true, tf.cast(missing_data_mask, dtype))
         y_pred_missing = tf.multiply(
-            tf.to_float(tf.expand_dims(tf.expand_dims(missing_data_mask, 1), 2)),  # shape N, 1, 1, D
+            tf.cast(tf.expand_dims(tf.expand_dims(missing_data_mask, 1), 2), dtype),  # shape N, 1, 1, D
             y_pred,  # shape N, K, S, D
             name='missing_data')
 
@@ -166,78 +324,102 @@ def imputation_mse(y_true, y_pred, r_nk_pred, missing_data_mask, name='imp_mse')
         # use responsibilities to normalize over components
         w_square_err = tf.multiply(square_err, tf.expand_dims(r_nk_pred, 2), name='weighted_sample_avg_se')
 
-        return tf.divide(tf.reduce_sum(w_square_err), tf.constant(N, dtype=tf.float32), name='imputation_mse')
+        return tf.divide(tf.reduce_sum(w_square_err), tf.constant(N, dtype=dtype), name='imputation_mse')
 
 
 def imputation_losses(y_true, missing_data_mask, imputation_method, nb_samples_pert=100, nb_samples_rec=100, seed=0,
-                      decoder_type='standard', name='imputation_losses'):
+                      decoder_type='standard', nb_chunks_pert=1, name='imputation_losses'):
     """
     Args:
         y_true: true data
         missing_data_mask: masks missing values
-        imputation_method: function to impute missing values
+        imputation_method: function (y_perturbed, seed) to impute missing values; called for all perturbed samples of
+            a chunk at once (stacked along the batch axis, i.e. on a batch of size nb_samples_pert/nb_chunks_pert * N)
+            with the op seed of the chunk's sampling ops
         nb_samples_pert: number of perturbed samples should be created per data point
         nb_samples_rec: number of times a perturbed sample should be imputed
         seed: random seed
         decoder_type: 'bernoulli' or 'standard'
+        nb_chunks_pert: the perturbed samples are imputed in this many chunks (the memory usage is bounded by the
+            chunk size); has to divide nb_samples_pert
         name: tensorflow name scope
 
     Returns:
        imputation performance
     """
     with tf.name_scope(name):
-        mse = tf.constant(0, dtype=tf.float32)
+        N, D = y_true.get_shape().as_list()
+        dtype = get_dtype('loss')
+        assert nb_samples_pert % nb_chunks_pert == 0
+        nb_samples_pert_chunk = nb_samples_pert // nb_chunks_pert
 
         # for MSE computation, we compare to binary data in {-1, 1}
         if decoder_type == 'bernoulli':
             y_true_01 = tf.where(tf.equal(y_true, -1),
-                                 tf.zeros_like(y_true, dtype=tf.float32),
-                                 tf.ones_like(y_true, dtype=tf.float32))
+                                 tf.zeros_like(y_true, dtype=dtype),
+                                 tf.ones_like(y_true, dtype=dtype))
         else:
             y_true_01 = y_true
 
-        # init lists for loglike computation
-        collected_means = []
-        collected_vars = []
-        log_weights = []
+        # stack the perturbed samples of a chunk along the batch axis s.t. a single inference is run; shape = P*N, D
+        with tf.name_scope('stack_perturbations'):
+            y_true_tiled = tf.tile(y_true, (nb_samples_pert_chunk, 1))
+            y_true_01_tiled = tf.tile(y_true_01, (nb_samples_pert_chunk, 1))
+            missing_data_mask_tiled = tf.tile(missing_data_mask, (nb_samples_pert_chunk, 1))
 
-        for s in range(nb_samples_pert):
+        def impute_chunk(seed):
             # sample missing data (fill missing values with random noise)
-            y_perturbed = perturb_data(y_true, missing_data_mask, seed)
+            y_perturbed = perturb_data(y_true_tiled, missing_data_mask_tiled, seed)
 
             # use trained variables
             tf.get_variable_scope().reuse_variables()
-            y_k_rec_mean, y_k_rec_var, log_r_nk = imputation_method(y_perturbed)
+            y_k_rec_mean, y_k_rec_var, log_r_nk = [cast(t, 'loss') for t in imputation_method(y_perturbed, seed)]
 
             # set all values to zero except the ones we want to evaluate
             missing_data_pred = tf.multiply(
-                tf.to_float(tf.expand_dims(tf.expand_dims(missing_data_mask, 1), 2)),
+                tf.cast(tf.expand_dims(tf.expand_dims(missing_data_mask_tiled, 1), 2), dtype),
                 y_k_rec_mean,
                 name='missing_data')
 
-            # compute MSE over missing values
-            mse += imputation_mse(y_true_01, missing_data_pred, tf.exp(log_r_nk), missing_data_mask,
-                                  name='mse_sample')
+            # MSE over missing values; averaging over the P*N rows averages the sample-MSEs of the perturbations
+            mse = imputation_mse(y_true_01_tiled, missing_data_pred, tf.exp(log_r_nk), missing_data_mask_tiled,
+                                 name='mse_sample')
 
-            # collect predicted means, vars and weights (shapes of means and vars: N, K, S, D; log_weights: N, K, S)
-            collected_means.append(y_k_rec_mean)
-            collected_vars.append(y_k_rec_var)
-            log_weights.append(tf.tile(tf.expand_dims(log_r_nk, 2), (1, 1, nb_samples_rec)))
+            # loglikelihood per sample (reshaped s.t. the perturbations have their own axis)
+            S = y_k_rec_mean.get_shape().as_list()[2]
+            if decoder_type == 'bernoulli':
+                logprobs = bernoulli_logprob_per_sample(y_true_tiled, y_k_rec_var, log_r_nk, missing_data_mask_tiled)
+                logprobs = tf.reshape(logprobs, (nb_samples_pert_chunk, N, S))
+            else:
+                logprobs = diagonal_gaussian_logprob_per_sample(y_true_tiled, y_k_rec_mean, y_k_rec_var, log_r_nk,
+                                                                mask=missing_data_mask_tiled)
+                K = logprobs.get_shape().as_list()[1]
+                logprobs = tf.reshape(logprobs, (nb_samples_pert_chunk, N, K, S))
+            return logprobs, [mse]
+
+        # first chunk; the remaining chunks (built once in the while loop) use a different seed for the perturbation and
+        # the inference, otherwise the second chunk would repeat the first chunk's noise
+        logprobs, (mse,) = impute_chunk(seed)
+        S = logprobs.get_shape().as_list()[-1]
+
+        # integrate out x over the S samples of all P perturbations (streaming over chunks of perturbations)
+        sample_axes = [0, 2] if decoder_type == 'bernoulli' else [0, 3]
+        log_sum_p, (mse_sum,) = streaming_log_sum_exp(logprobs, lambda: impute_chunk(seed + 1), nb_chunks_pert,
+                                                      sample_axes, sums=[mse])
 
         # average sample-MSEs
-        expected_mse = tf.divide(mse, tf.constant(nb_samples_pert, dtype=tf.float32, name='nb_samps'), name='expected_mse')
-
-        # collect predicted means, vars/logits and responsibilities
-        means = tf.concat(collected_means, axis=2, name='collect_means')  # shape = N, K, (nb_samps_pert*nb_samps_rec)
-        vars_or_logits = tf.concat(collected_vars, axis=2, name='collect_vars_or_logits')  # same shape
-        log_weights = tf.concat(log_weights, axis=2, name='collected_weights')  # same shape
+        expected_mse = tf.divide(mse_sum, tf.constant(nb_chunks_pert, dtype=dtype, name='nb_chunks'),
+                                 name='expected_mse')
 
         # compute loglikelihood
         if decoder_type == 'bernoulli':
-            loglike = bernoulli_logprob(y_true, vars_or_logits, log_weights, missing_data_mask, name='gauss_logprob')
+            img_logprobs = tf.subtract(log_sum_p, tf.constant(nb_samples_pert * S, dtype=dtype, name='nb_samples'),
+                                       name='log_p_y')  # normalised as in bernoulli_logprob
+            loglike = tf.reduce_mean(img_logprobs, name='log_p_yn')
         else:
-            loglike = diagonal_gaussian_logprob(y_true, means, vars_or_logits, log_weights, mask=missing_data_mask,
-                                                name='gauss_logprob')
+            log_p_y_given_z = tf.subtract(log_sum_p, tf.log(tf.constant(nb_samples_pert * S, dtype=dtype)),
+                                          name='log_p_y_given_z')  # shape = N, K
+            loglike = tf.reduce_mean(tf.reduce_logsumexp(log_p_y_given_z, axis=1), name='log_p_yn')
 
         return expected_mse, loglike
 
@@ -293,49 +475,64 @@ def perturb_data(y, missing_data_mask, seed, decoder_type='standard', name='pert
 
         # replace some random elements by random noise.
         if decoder_type == 'standard':
-            noise_missing = tf.random_normal(mean=0, stddev=1., seed=seed, shape=missing_data_mask.get_shape())
+            noise_missing = tf.random_normal(mean=0, stddev=1., seed=seed, shape=missing_data_mask.get_shape(),
+                                             dtype=y.dtype)
         elif decoder_type == 'bernoulli':
-            probs = 0.5 * tf.ones_like(missing_data_mask, dtype=tf.float32)
+            probs = 0.5 * tf.ones_like(missing_data_mask, dtype=y.dtype)
             noise_missing = tf.distributions.Bernoulli(probs=probs).sample(seed=seed)
             noise_missing = tf.where(tf.equal(noise_missing, 0),
-                                     -tf.ones_like(noise_missing, dtype=tf.float32),
-                                     tf.ones_like(noise_missing, dtype=tf.float32))
+                                     -tf.ones_like(noise_missing, dtype=y.dtype),
+                                     tf.ones_like(noise_missing, dtype=y.dtype))
         else:
             raise NotImplementedError
-        noise_missing = tf.multiply(tf.to_float(missing_data_mask), noise_missing, name='missing_data')
+        noise_missing = tf.multiply(tf.cast(missing_data_mask, y.dtype), noise_missing, name='missing_data')
 
         # remove missing data
-        y_remaining = tf.multiply(tf.to_float(tf.logical_not(missing_data_mask)), y, name='remaining_data')
+        y_remaining = tf.multiply(tf.cast(tf.logical_not(missing_data_mask), y.dtype), y, name='remaining_data')
 
         return tf.add(y_remaining, noise_missing, 'perturbed_data')
 
 
-def purity(r_nk, labels, eps=1e-10, name='purity'):
+def cluster_class_counts(r_nk, labels, name='clust_lbl_scores'):
     """
-    A measure of the extent to which a cluster contains objects of a single class.
-    From https://www-users.cs.umn.edu/~kumar/dmbook/ch8.pdf
+    For all samples in a class c, sum their probabilities of being in cluster k.
     Args:
         r_nk: component responsibilities per data point
         labels: ground truth; binary matrix of shape N, C
-        name:
 
     Returns:
-        entropy (0 if perfect clustering) and purity (1 if perfect clustering)
+        N_kc; shape = K, C (can be summed over several batches of data points, see purity_from_counts)
     """
     with tf.name_scope(name):
         N, K = r_nk.get_shape().as_list()
         N, C = labels.get_shape().as_list()
-
-        eps = tf.constant(eps, name='epsilon', dtype=tf.float32)
+        r_nk, labels = cast(r_nk, 'loss'), cast(labels, 'loss')
 
         r_nk_tiled = tf.tile(tf.expand_dims(r_nk, 2), (1, 1, C))      # shape = N, K, C
         labels_tiled = tf.tile(tf.expand_dims(labels, 1), (1, K, 1))  # shape = N, K, C
 
-        # for all samples in a class c, sum their probabilities of being in cluster k
-        N_kc = tf.reduce_sum(tf.multiply(r_nk_tiled, labels_tiled), axis=0, name='clust_lbl_scores')  # shape = N, C
+        return tf.reduce_sum(tf.multiply(r_nk_tiled, labels_tiled), axis=0, name='N_kc')  # shape = K, C
+
 
-        # sum the weights for each cluster
-        N_k = tf.reduce_sum(r_nk, axis=0)  # shape = N, C
+def purity_from_counts(N_kc, eps=1e-10, name='purity'):
+    """
+    Computes entropy and purity from the cluster-class counts N_kc (see cluster_class_counts).
+    Args:
+        N_kc: summed probabilities of the elements of class c being in cluster k; shape = K, C
+        eps: for numerical stability
+        name: tf name scope
+
+    Returns:
+        entropy (0 if perfect clustering) and purity (1 if perfect clustering)
+    """
+    with tf.name_scope(name):
+        K, C = N_kc.get_shape().as_list()
+        eps = tf.constant(eps, name='epsilon', dtype=N_kc.dtype)
+
+        # sum the weights for each cluster (labels are one-hot: summing over classes is the same as summing over
+        # data points) and the number of data points
+        N_k = tf.reduce_sum(N_kc, axis=1)  # shape = K
+        N = tf.reduce_sum(N_k)
 
         # probability that element of class C is in cluster K: p(x \in C and x \in K)
         p_kc = tf.divide(N_kc, tf.tile(tf.expand_dims(N_k + eps, 1), (1, C)), name='p_kc')
@@ -347,3 +544,20 @@ def purity(r_nk, labels, eps=1e-10, name='purity'):
         purity = tf.reduce_sum(tf.multiply(tf.divide(N_k, N), cluster_purity), name='purity')
 
         return entropy, purity
+
+
+def purity(r_nk, labels, eps=1e-10, name='purity'):
+    """
+    A measure of the extent to which a cluster contains objects of a single class.
+    From https://www-users.cs.umn.edu/~kumar/dmbook/ch8.pdf
+    Args:
+        r_nk: component responsibilities per data point
+        labels: ground truth; binary matrix of shape N, C
+        name:
+
+    Returns:
+        entropy (0 if perfect clustering) and purity (1 if perfect clustering)
+    """
+    with tf.name_scope(name):
+        N_kc = cluster_class_counts(r_nk, labels)
+        return purity_from_counts(N_kc, eps, name='purity_from_counts')
@@ -8,10 +8,66 @@ from distributions import dirichlet, gaussian, niw, student_t
 from models import vae, gmm, smm
 import re
 
+from helpers.precision import cast, get_dtype
 from helpers.tf_utils import variable_on_device
 
+# graph collection holding the global-parameter transforms which are shared by all consumers (see cached_transform)
+TRANSFORM_CACHE = 'svae_transform_cache'
 
-def e_step(phi_enc, phi_gmm, nb_samples, seed=0, name="e_step"):
+
+def cached_transform(key, params, transform):
+    """
+    Builds transform(params) only once per graph. Later calls with the same parameters return the same tensors, so the
+    transform is evaluated once per sess.run no matter how many towers or test/imputation/plotting graphs consume it.
+    The transform is built at the top-level name scope, on the parameters' device and outside of any control
+    dependencies and control flow context: if it is first requested inside a while_loop/map_fn, the cached tensors
+    don't belong to the loop's frame and can also be used outside of it.
+    Args:
+        key: name of the transform
+        params: list of tensors/variables the transform is applied to
+        transform: function building the transform
+
+    Returns:
+        transform(params)
+    """
+    cache_key = (key,) + tuple(p.name for p in params)
+    for cached_key, value in tf.get_collection(TRANSFORM_CACHE):
+        if cached_key == cache_key:
+            return value
+
+    graph = tf.get_default_graph()
+    control_flow_context = graph._get_control_flow_context()
+    graph._set_control_flow_context(None)
+    try:
+        with tf.name_scope(None), tf.control_dependencies(None), tf.device(params[0].device):
+            value = transform(params)
+    finally:
+        graph._set_control_flow_context(control_flow_context)
+    tf.add_to_collection(TRANSFORM_CACHE, (cache_key, value))
+    return value
+
+
+def fold_constants(tensors, np_transform, name='folded'):
+    """
+    Applies np_transform to the values of constant tensors (tf.constant, e.g. the prior) at graph-build time and
+    embeds the results as constants. The values are read with tf.contrib.util.constant_value, i.e. no session is run.
+    Args:
+        tensors: list of tensors
+        np_transform: function mapping the list of NumPy values to a list of NumPy arrays
+        name: tf name scope
+
+    Returns:
+        list of constant tensors (of the tensors' dtype); None if a tensor's value is not known at graph-build time
+    """
+    values = [tf.contrib.util.constant_value(tensor) for tensor in tensors]
+    if any(value is None for value in values):
+        return None
+    dtype = tensors[0].dtype.base_dtype
+    with tf.name_scope(name):
+        return [tf.constant(value, dtype=dtype, name='const_%d' % i) for i, value in enumerate(np_transform(values))]
+
+
+def e_step(phi_enc, phi_gmm, nb_samples, seed=0, top_k=None, name="e_step"):
     """
 
     Args:
@@ -19,104 +75,365 @@ def e_step(phi_enc, phi_gmm, nb_samples, seed=0, name="e_step"):
         phi_gmm: paramters of recognition GMM (eta1_phi2, eta2_phi2, pi_phi2)
         nb_samples: number of times to sample from q(x|z, y)
         seed: random seed
+        top_k: if not None, only the top_k most probable components under q(z|y, phi) are kept for each data point
+               (with renormalised weights); K below then refers to these top_k components.
         name: tensorflow name scope
 
     Returns:
+        x_k_samples: samples from q(x|z=k, y, phi); shape = N, K, S, L
+        log_z_given_y_phi: log q(z|y, phi); shape = N, K
+        phi_tilde: natural parameters of q(x|z=k, y, phi)
+        log_q_x_k: log q(x_k_samples|z=k, y, phi); shape = N, K, S
+        comp_idx: None or, if truncated, the indices of the kept components; shape = N, top_k
+    """
+    with tf.name_scope(name):
+        if top_k is None:
+            phi_tilde, chol_phi_tilde, log_z_given_y_phi = compute_local_params(phi_enc, phi_gmm)
+            comp_idx = None
+        else:
+            # keep only the most probable components (for large K); phi_tilde is only formed for these
+            phi_tilde, chol_phi_tilde, log_z_given_y_phi, comp_idx = compute_local_params_truncated(phi_enc, phi_gmm,
+                                                                                                   top_k)
+
+        eta1_phi_tilde, _ = phi_tilde
+
+        # sample x for each of the K components (x_samps.shape = size_minibatch, nb_components, nb_samples, latent_dim)
+        # and evaluate log q(x|z=k, y, phi) for these samples (log_q_x_k.shape = size_minibatch, nb_components, nb_samples)
+        x_k_samples, log_q_x_k = sample_x_per_comp(eta1_phi_tilde, chol_phi_tilde, nb_samples, seed)
 
+        return x_k_samples, log_z_given_y_phi, phi_tilde, log_q_x_k, comp_idx
+
+
+def e_step_ancestral(phi_enc, phi_gmm, nb_samples, seed=0, name="e_step_ancestral"):
+    """
+    Ancestral version of the e-step: samples z ~ q(z|y, phi) first and x ~ q(x|z, y, phi) only for the chosen
+    component. Use it wherever only x_samples are needed (e.g. m_step, predict, plotting); sampling cost and memory are
+    reduced by a factor of K compared to e_step followed by subsample_x.
+    Args:
+        phi_enc: encoded data; Gaussian natural parameters
+        phi_gmm: paramters of recognition GMM (eta1_phi2, eta2_phi2, pi_phi2)
+        nb_samples: number of times to sample from q(x, z|y)
+        seed: random seed
+        name: tensorflow name scope
+
+    Returns:
+        x_samples: samples from q(x|y, phi); shape = N, S, L
+        z_samples: components chosen for these samples; shape = N, S
+        log_z_given_y_phi: log q(z|y, phi); shape = N, K
+        phi_tilde: natural parameters of q(x|z=k, y, phi)
     """
     with tf.name_scope(name):
-        eta1_phi1, eta2_phi1_diag = phi_enc
-        eta2_phi1 = tf.matrix_diag(eta2_phi1_diag, name='diagonalize')
+        phi_tilde, chol_phi_tilde, log_z_given_y_phi = compute_local_params(phi_enc, phi_gmm)
+        eta1_phi_tilde, _ = phi_tilde
 
-        # get gaussian natparams and dirichlet natparam for recognition GMM
-        eta1_phi2, eta2_phi2, pi_phi2 = unpack_recognition_gmm(phi_gmm)
+        x_samples, z_samples = sample_x_ancestral(eta1_phi_tilde, chol_phi_tilde, log_z_given_y_phi, nb_samples, seed)
 
-        # compute log q(z|y, phi)
-        log_z_given_y_phi, dbg = compute_log_z_given_y(eta1_phi1, eta2_phi1, eta1_phi2, eta2_phi2, pi_phi2)
+        return x_samples, z_samples, log_z_given_y_phi, phi_tilde
 
-        # compute parameters phi_tilde (corresponds to mu_tilde and sigma_tilde in the paper)
-        # eta1_phi_tilde.shape = (N, K, D, 1); eta2_phi_tilde.shape = (N, K, D, D)
-        with tf.name_scope('combine_phi'):
-            eta1_phi_tilde = tf.expand_dims(tf.expand_dims(eta1_phi1, axis=1) + tf.expand_dims(eta1_phi2, axis=0), axis=-1, name='combine_eta1')
-            eta2_phi_tilde = tf.add(tf.expand_dims(eta2_phi1, axis=1), tf.expand_dims(eta2_phi2, axis=0), name='combine_eta2')
-            phi_tilde = tf.tuple((eta1_phi_tilde, eta2_phi_tilde), name='phi_tilde')
 
-        # sample x for each of the K components (x_samps.shape = size_minibatch, nb_components, nb_samples, latent_dim)
-        x_k_samples = sample_x_per_comp(eta1_phi_tilde, eta2_phi_tilde, nb_samples, seed)
+def compute_local_params(phi_enc, phi_gmm):
+    """
+    Combines encoder output and recognition GMM to the parameters of q(x|z, y, phi) and computes q(z|y, phi).
+    Args:
+        phi_enc: encoded data; Gaussian natural parameters
+        phi_gmm: paramters of recognition GMM (eta1_phi2, eta2_phi2, pi_phi2)
+
+    Returns:
+        phi_tilde: natural parameters of q(x|z=k, y, phi); shapes = (N, K, L, 1), (N, K, L, L)
+        chol_phi_tilde: lower Cholesky factor of the precision of q(x|z=k, y, phi); shape = N, K, L, L
+        log_z_given_y_phi: log q(z|y, phi); shape = N, K
+    """
+    # the encoder output enters the PGM part of the model (see helpers/precision.py)
+    eta1_phi1, eta2_phi1_diag = [cast(phi, 'pgm', name='phi_enc') for phi in phi_enc]
 
-        return x_k_samples, log_z_given_y_phi, phi_tilde, dbg
+    # get gaussian natparams and dirichlet natparam for recognition GMM
+    eta1_phi2, eta2_phi2, pi_phi2 = unpack_recognition_gmm(phi_gmm)
+
+    # compute parameters phi_tilde (corresponds to mu_tilde and sigma_tilde in the paper)
+    # eta1_phi_tilde.shape = (N, K, D, 1); eta2_phi_tilde.shape = (N, K, D, D)
+    with tf.name_scope('combine_phi'):
+        eta2_phi1 = tf.matrix_diag(eta2_phi1_diag, name='diagonalize')
+        eta1_phi_tilde = tf.expand_dims(tf.expand_dims(eta1_phi1, axis=1) + tf.expand_dims(eta1_phi2, axis=0), axis=-1, name='combine_eta1')
+        eta2_phi_tilde = tf.add(tf.expand_dims(eta2_phi1, axis=1), tf.expand_dims(eta2_phi2, axis=0), name='combine_eta2')
+        phi_tilde = tf.tuple((eta1_phi_tilde, eta2_phi_tilde), name='phi_tilde')
+
+        # factorise the precision of q(x|z=k, y) once for each (n, k); shape = N, K, D, D
+        chol_phi_tilde = tf.cholesky(-2. * eta2_phi_tilde, name='chol_prec_tilde')
+
+    # compute log q(z|y, phi)
+    log_z_given_y_phi = compute_log_z_given_y(eta1_phi1, eta2_phi1_diag, eta1_phi2, eta2_phi2, pi_phi2,
+                                              chol_phi_tilde)
+
+    return phi_tilde, chol_phi_tilde, log_z_given_y_phi
 
 
-def compute_log_z_given_y(eta1_phi1, eta2_phi1, eta1_phi2, eta2_phi2, pi_phi2, name='log_q_z_given_y_phi'):
+def compute_log_z_given_y(eta1_phi1, eta2_phi1_diag, eta1_phi2, eta2_phi2, pi_phi2, chol_phi_tilde,
+                          name='log_q_z_given_y_phi'):
     """
+    Computes log q(z=k|y, phi) ~ log pi_k + log N(mu_phi1|mu_phi2, sigma_phi1 + sigma_phi2) without solving a dense
+    linear system for every (n, k) pair. The encoder precision Lambda1 = -2 * eta2_phi1 is diagonal, so (with
+    Lambda2 = -2 * eta2_phi2 and M = Lambda1 + Lambda2, the precision of phi_tilde):
+        inv(sigma_phi1 + sigma_phi2) = Lambda1 - Lambda1 * inv(M) * Lambda1
+        log|sigma_phi1 + sigma_phi2| = log|M| - log|Lambda1| - log|Lambda2|
+    Only M needs a factorisation per (n, k); it is the Cholesky factor of phi_tilde which the e-step computes anyway.
+    Lambda2 is factorised once per component.
 
     Args:
-        eta1_phi1: encoder output; shape = N, K, L
-        eta2_phi1: encoder output; shape = N, K, L, L
+        eta1_phi1: encoder output; shape = N, L
+        eta2_phi1_diag: encoder output (diagonal of eta2_phi1); shape = N, L
         eta1_phi2: GMM-EM parameter; shape = K, L
         eta2_phi2: GMM-EM parameter; shape = K, L, L
+        pi_phi2: GMM-EM mixture coefficients; shape = K
+        chol_phi_tilde: lower Cholesky factor of -2 * (eta2_phi1 + eta2_phi2); shape = N, K, L, L
         name: tensorflow name scope
 
     Returns:
-        log q(z|y, phi)
+        log q(z|y, phi); shape = N, K
     """
     with tf.name_scope(name):
         N, L = eta1_phi1.get_shape().as_list()
-        assert eta2_phi1.get_shape() == (N, L, L)
+        assert eta2_phi1_diag.get_shape() == (N, L)
         K, L2 = eta1_phi2.get_shape().as_list()
         assert L2 == L
         assert eta2_phi2.get_shape() == (K, L, L)
+        assert chol_phi_tilde.get_shape() == (N, K, L, L)
+
+        mu_phi2, logdet_phi2 = factorise_phi2(eta1_phi2, eta2_phi2)
+        logprob = component_logprob(eta1_phi1, eta2_phi1_diag, tf.expand_dims(mu_phi2, axis=0),
+                                    tf.expand_dims(logdet_phi2, axis=0), tf.expand_dims(tf.log(pi_phi2), axis=0),
+                                    chol_phi_tilde)
+
+        # log sum exp trick
+        with tf.name_scope('log_sum_exp'):
+            max_logprob = tf.reduce_max(logprob, axis=1, keep_dims=True)
+            normalizer = tf.add(max_logprob, tf.log(tf.reduce_sum(tf.exp(logprob - max_logprob), axis=1, keep_dims=True)))
+
+        return tf.subtract(logprob, normalizer, name='normalized_logprob')
+
+
+def factorise_phi2(eta1_phi2, eta2_phi2, name='factorise_phi2'):
+    """
+    Recognition GMM: one Cholesky factorisation per component.
+    Args:
+        eta1_phi2: GMM-EM parameter; shape = K, L
+        eta2_phi2: GMM-EM parameter; shape = K, L, L
+
+    Returns:
+        mu_phi2: component means; shape = K, L
+        logdet_phi2: log-determinants of the component precisions Lambda2; shape = K
+    """
+    with tf.name_scope(name):
+        K, L = eta1_phi2.get_shape().as_list()
+        chol_phi2 = tf.cholesky(-2. * eta2_phi2, name='chol_prec_phi2')
+        mu_phi2 = tf.reshape(tf.cholesky_solve(chol_phi2, tf.expand_dims(eta1_phi2, axis=-1)), (K, L), name='mu_phi2')
+        logdet_phi2 = 2. * tf.reduce_sum(tf.log(tf.matrix_diag_part(chol_phi2)), axis=-1)
+        return mu_phi2, logdet_phi2
+
+
+def component_logprob(eta1_phi1, eta2_phi1_diag, mu_phi2, logdet_phi2, log_pi_phi2, chol_phi_tilde,
+                      name='component_logprob'):
+    """
+    Unnormalised log q(z=k|y, phi) (see compute_log_z_given_y). The component parameters either have a leading
+    axis of size 1 (all K components for every data point) or of size N (different components per data point).
+    Args:
+        eta1_phi1: encoder output; shape = N, L
+        eta2_phi1_diag: encoder output (diagonal of eta2_phi1); shape = N, L
+        mu_phi2: component means; shape = (1 or N), K, L
+        logdet_phi2: log-determinants of the component precisions; shape = (1 or N), K
+        log_pi_phi2: log mixture coefficients; shape = (1 or N), K
+        chol_phi_tilde: lower Cholesky factor of -2 * (eta2_phi1 + eta2_phi2); shape = N, K, L, L
+        name: tensorflow name scope
 
-        # combine eta2_phi1 and eta2_phi2
-        eta2_phi_tilde = tf.add(tf.expand_dims(eta2_phi1, axis=1), tf.expand_dims(eta2_phi2, axis=0))
+    Returns:
+        log pi_k + log N(mu_phi1|mu_phi2, sigma_phi1 + sigma_phi2); shape = N, K
+    """
+    with tf.name_scope(name):
+        L = eta1_phi1.get_shape().as_list()[1]
 
-        # w_eta2 = -0.5 * inv(sigma_phi1 + sigma_phi2)
-        solved = tf.matrix_solve(eta2_phi_tilde, tf.tile(tf.expand_dims(eta2_phi2, axis=0), [N, 1, 1, 1]))
-        w_eta2 = tf.einsum('nju,nkui->nkij', eta2_phi1, solved)
+        # encoder: diagonal precision and mean in closed form; shape = N, L
+        prec_phi1 = -2. * eta2_phi1_diag
+        mu_phi1 = tf.divide(eta1_phi1, prec_phi1, name='mu_phi1')
 
-        # for nummerical stability...
-        w_eta2 = tf.divide(w_eta2 + tf.matrix_transpose(w_eta2), 2., name='symmetrised')
+        with tf.name_scope('mahalanobis'):
+            # err = mu_phi1 - mu_phi2; shape = N, K, L
+            err = tf.expand_dims(mu_phi1, axis=1) - mu_phi2
+            prec_err = tf.multiply(tf.expand_dims(prec_phi1, axis=1), err, name='prec_phi1_err')
 
-        # w_eta1 = inv(sigma_phi1 + sigma_phi2) * mu_phi2
-        w_eta1 = tf.einsum('nuj,nkuv->nkj',
-                           eta2_phi1,
-                           tf.matrix_solve(eta2_phi_tilde,
-                                           tf.tile(tf.expand_dims(tf.expand_dims(eta1_phi2, axis=0), axis=-1),
-                                                   [N, 1, 1, 1]))  # shape inside solve= N, K, D, 1
-                           )  # w_eta1.shape = N, K, D
+            # err^T Lambda1 err - |inv(C) Lambda1 err|^2 with M = C C^T; shape = N, K
+            half_solved = tf.matrix_triangular_solve(chol_phi_tilde, tf.expand_dims(prec_err, axis=-1), lower=True)
+            mahalanobis_sqr_d = tf.subtract(tf.reduce_sum(tf.multiply(prec_err, err), axis=-1),
+                                            tf.reduce_sum(tf.square(half_solved), axis=[-2, -1]),
+                                            name='mahalanobis_sqr_d')
 
-        # compute means
-        mu_phi1, _ = gaussian.natural_to_standard(eta1_phi1, eta2_phi1)
+        with tf.name_scope('logdet'):
+            logdet_tilde = 2. * tf.reduce_sum(tf.log(tf.matrix_diag_part(chol_phi_tilde)), axis=-1)  # shape = N, K
+            logdet_phi1 = tf.reduce_sum(tf.log(prec_phi1), axis=-1, keep_dims=True)                  # shape = N, 1
+            logdet_cov = logdet_tilde - logdet_phi1 - logdet_phi2                                    # shape = N, K
 
-        # compute log_z_given_y_phi
-        return gaussian.log_probability_nat(mu_phi1, w_eta1, w_eta2, pi_phi2), (w_eta1, w_eta2)
+        with tf.name_scope('gaussian_logprob'):
+            logprob = -0.5 * (mahalanobis_sqr_d + logdet_cov) - L / 2. * np.log(2. * np.pi)
+            return tf.add(logprob, log_pi_phi2, name='component_weighting')
 
 
-def sample_x_per_comp(eta1, eta2, nb_samples, seed=0):
+def compute_local_params_truncated(phi_enc, phi_gmm, top_k, name='truncated_local_params'):
     """
+    Truncated version of compute_local_params which never builds N x K x L x L tensors: the top_k most probable
+    components of every data point are selected in a first pass over the components (without gradients, one
+    N x L x L factorisation at a time); phi_tilde, its Cholesky factor and q(z|y, phi) (renormalised over the kept
+    components) are then computed for these components only.
+    Args:
+        phi_enc: encoded data; Gaussian natural parameters
+        phi_gmm: paramters of recognition GMM (eta1_phi2, eta2_phi2, pi_phi2)
+        top_k: number of components kept per data point
+
+    Returns:
+        phi_tilde: natural parameters of the kept q(x|z=k, y, phi); shapes = (N, top_k, L, 1), (N, top_k, L, L)
+        chol_phi_tilde: lower Cholesky factor of their precisions; shape = N, top_k, L, L
+        log_z_given_y_phi: renormalised log q(z|y, phi) of the kept components (in decreasing order); shape = N, top_k
+        comp_idx: indices of the kept components; shape = N, top_k
+    """
+    eta1_phi1, eta2_phi1_diag = [cast(phi, 'pgm', name='phi_enc') for phi in phi_enc]
+    eta1_phi2, eta2_phi2, pi_phi2 = unpack_recognition_gmm(phi_gmm)
+    K, L = eta1_phi2.get_shape().as_list()
+    assert 0 < top_k <= K
+
+    with tf.name_scope(name):
+        mu_phi2, logdet_phi2 = factorise_phi2(eta1_phi2, eta2_phi2)
+        log_pi_phi2 = tf.log(pi_phi2)
+        eta2_phi1 = tf.matrix_diag(eta2_phi1_diag, name='diagonalize')
+
+        # selection pass: log q(z=k|y) for one component at a time; shape = N, K
+        with tf.name_scope('select_components'):
+            def logprob_of_component(component_params):
+                eta2_phi2_k, mu_phi2_k, logdet_phi2_k, log_pi_phi2_k = component_params
+                chol_tilde_k = tf.cholesky(-2. * (eta2_phi1 + eta2_phi2_k), name='chol_prec_tilde')  # shape = N, L, L
+                return component_logprob(eta1_phi1, eta2_phi1_diag, tf.reshape(mu_phi2_k, (1, 1, L)),
+                                         tf.reshape(logdet_phi2_k, (1, 1)), tf.reshape(log_pi_phi2_k, (1, 1)),
+                                         tf.expand_dims(chol_tilde_k, axis=1))[:, 0]
+
+            logprob_all = tf.map_fn(logprob_of_component,
+                                    [tf.stop_gradient(param) for param in (eta2_phi2, mu_phi2, logdet_phi2,
+                                                                           log_pi_phi2)],
+                                    dtype=eta1_phi1.dtype, back_prop=False, name='logprob_per_component')
+            _, comp_idx = tf.nn.top_k(tf.transpose(tf.stop_gradient(logprob_all)), k=top_k, sorted=True,
+                                      name='top_k')
+
+        # parameters of the kept components; shapes = (N, top_k, ...)
+        with tf.name_scope('combine_phi'):
+            eta1_phi_tilde = tf.expand_dims(tf.expand_dims(eta1_phi1, axis=1) + tf.gather(eta1_phi2, comp_idx),
+                                            axis=-1, name='combine_eta1')
+            eta2_phi_tilde = tf.add(tf.expand_dims(eta2_phi1, axis=1), tf.gather(eta2_phi2, comp_idx),
+                                    name='combine_eta2')
+            phi_tilde = tf.tuple((eta1_phi_tilde, eta2_phi_tilde), name='phi_tilde_truncated')
+            chol_phi_tilde = tf.cholesky(-2. * eta2_phi_tilde, name='chol_prec_tilde')
+
+        # q(z|y, phi) renormalised over the kept components (the normaliser of all K components cancels)
+        with tf.name_scope('log_q_z_given_y_phi'):
+            logprob = component_logprob(eta1_phi1, eta2_phi1_diag, tf.gather(mu_phi2, comp_idx),
+                                        tf.gather(logdet_phi2, comp_idx), tf.gather(log_pi_phi2, comp_idx),
+                                        chol_phi_tilde)
+            log_z_given_y_phi = tf.subtract(logprob, tf.reduce_logsumexp(logprob, axis=1, keep_dims=True),
+                                            name='renormalised')
+
+    return phi_tilde, chol_phi_tilde, log_z_given_y_phi, comp_idx
+
+
+def scatter_responsibilities(r_nk_trunc, comp_idx, nb_components, name='scatter_r_nk'):
+    """
+    Writes the responsibilities of the kept components back into a dense (N, K) matrix (zero elsewhere), e.g. for
+    computing the m-step's sufficient statistics.
+    Args:
+        r_nk_trunc: responsibilities of the kept components; shape = N, T
+        comp_idx: indices of the kept components; shape = N, T
+        nb_components: total number of components K
+
+    Returns:
+        responsibilities of shape (N, K)
+    """
+    with tf.name_scope(name):
+        N, T = comp_idx.get_shape().as_list()
+
+        n_idx = tf.to_int32(tf.tile(tf.reshape(tf.range(N, dtype=tf.float32), (-1, 1)), multiples=[1, T]))
+        nk_idx = tf.stack([n_idx, comp_idx], axis=2, name='nk_idx')
+
+        return tf.scatter_nd(nk_idx, r_nk_trunc, shape=(N, nb_components), name='r_nk')
+
+
+def sample_x_per_comp(eta1, chol_prec, nb_samples, seed=0):
+    """
+    Samples from q(x|z=k, y) using a single Cholesky factor of its precision and returns the samples' log-densities.
+    With inv_sigma = C C^T, the samples are x = mu + inv(C^T) * eps, so (x - mu)^T inv_sigma (x - mu) = eps^T eps and
+    log q(x) only requires the log-determinant given by diag(C); no further solves are needed.
     Args:
         eta1: 1st Gaussian natural parameter, shape = N, K, L, 1
-        eta2: 2nd Gaussian natural parameter, shape = N, K, L, L
+        chol_prec: lower Cholesky factor of the precision -2 * eta2, shape = N, K, L, L
         nb_samples: nb of samples to generate for each of the K components
         seed: random seed
 
     Returns:
-        x ~ N(x|eta1[k], eta2[k]), nb_samples times for each of the K components.
+        x ~ N(x|eta1[k], eta2[k]), nb_samples times for each of the K components; shape = N, K, S, L
+        log N(x|eta1[k], eta2[k]) for each of these samples; shape = N, K, S
     """
     with tf.name_scope('sample_x_k'):
-        inv_sigma = -2 * eta2
-        N, K, _, D = eta2.get_shape()
+        N, K, D, _ = chol_prec.get_shape().as_list()
+
+        # mean: inv_sigma * mu = eta1; two triangular solves with the factor C; shape = N, K, D, 1
+        mean = tf.cholesky_solve(chol_prec, eta1, name='mean')
 
-        # cholesky decomposition and adding noise (raw_noise is of dimension (DxB), where B is the size of MC samples)
-        L = tf.cholesky(inv_sigma)
-        # sample_shape = (D, nb_samples)
-        sample_shape = (int(N), int(K), int(D), nb_samples)
-        raw_noise = tf.random_normal(sample_shape, mean=0., stddev=1., seed=seed)
-        noise = tf.matrix_solve(tf.matrix_transpose(L), raw_noise)
+        # adding noise (raw_noise is of dimension (DxB), where B is the size of MC samples): solve C^T * noise = eps
+        sample_shape = (N, K, D, nb_samples)
+        raw_noise = tf.random_normal(sample_shape, mean=0., stddev=1., seed=seed, dtype=chol_prec.dtype)
+        noise = tf.matrix_triangular_solve(chol_prec, raw_noise, lower=True, adjoint=True)
 
         # reparam-trick-sampling: x_samps = mu_tilde + noise: shape = N, K, S, D
-        x_k_samps = tf.transpose(tf.matrix_solve(inv_sigma, eta1) + noise, [0, 1, 3, 2], name='samples')
-        return x_k_samps
+        x_k_samps = tf.transpose(mean + noise, [0, 1, 3, 2], name='samples')
+
+        # log N(x|mu, sigma) = -1/2 eps^T eps + 1/2 log|inv_sigma| - D/2 log(2 pi); shape = N, K, S
+        with tf.name_scope('log_prob'):
+            logdet_prec = 2. * tf.reduce_sum(tf.log(tf.matrix_diag_part(chol_prec)), axis=-1)  # shape = N, K
+            log_q_x = -0.5 * tf.reduce_sum(tf.square(raw_noise), axis=2)
+            log_q_x += 0.5 * tf.expand_dims(logdet_prec, axis=2)
+            log_q_x = tf.subtract(log_q_x, D / 2. * np.log(2. * np.pi), name='log_q_x')
+
+        return x_k_samps, log_q_x
+
+
+def sample_x_ancestral(eta1, chol_prec, log_q_z_given_y, nb_samples, seed=0):
+    """
+    Samples z ~ q(z|y) and then x ~ N(x|eta1[z], eta2[z]) for the chosen component only.
+    Args:
+        eta1: 1st Gaussian natural parameter, shape = N, K, L, 1
+        chol_prec: lower Cholesky factor of the precision -2 * eta2, shape = N, K, L, L
+        log_q_z_given_y: log q(z_n=k|y_n, phi); shape = N, K
+        nb_samples: nb of samples to generate for each data point
+        seed: random seed
+
+    Returns:
+        x_samples: a sample matrix of shape (N, S, L)
+        z_samples: components the samples have been drawn from; shape = N, S
+    """
+    with tf.name_scope('sample_x_ancestral'):
+        N, K, D, _ = chol_prec.get_shape().as_list()
+        S = nb_samples
+
+        # sample S times z ~ q(z|y, phi) for each N.
+        z_samps = tf.multinomial(logits=log_q_z_given_y, num_samples=S, seed=seed, name='z_samples')
+        z_samps = tf.cast(z_samps, dtype=tf.int32)
+
+        # tf can't tile int32 tensors on the GPU. Therefore, tile it as float and convert to int afterwards
+        n_idx = tf.to_int32(tf.tile(tf.reshape(tf.range(N, dtype=tf.float32), (-1, 1)), multiples=[1, S]))
+
+        # gather parameters of the chosen components; shapes = (N, S, D, 1), (N, S, D, D)
+        nz_idx = tf.stack([n_idx, z_samps], axis=2, name='nz_idx')
+        eta1_z = tf.gather_nd(eta1, nz_idx, name='eta1_z')
+        chol_prec_z = tf.gather_nd(chol_prec, nz_idx, name='chol_prec_z')
+
+        # reparam-trick-sampling: x_samps = mu_tilde[z] + inv(C[z]^T) * eps
+        mean = tf.cholesky_solve(chol_prec_z, eta1_z, name='mean')
+        raw_noise = tf.random_normal((N, S, D, 1), mean=0., stddev=1., seed=seed, dtype=chol_prec.dtype)
+        noise = tf.matrix_triangular_solve(chol_prec_z, raw_noise, lower=True, adjoint=True)
+
+        return tf.reshape(mean + noise, (N, S, D), name='x_samples'), z_samps
 
 
 def subsample_x(x_k_samples, log_q_z_given_y, seed=0):
@@ -163,9 +480,8 @@ def m_step(gmm_prior, x_samples, r_nk):
     """
 
     with tf.name_scope('m_step'):
-        # execute GMM-EM m-step
-        beta_0, m_0, C_0, v_0 = niw.natural_to_standard(*gmm_prior[1:])
-        alpha_0 = dirichlet.natural_to_standard(gmm_prior[0])
+        # execute GMM-EM m-step (the prior is constant: its standard parameters are folded at graph-build time)
+        alpha_0, beta_0, m_0, C_0, v_0 = cached_transform('gmm_prior_standard', gmm_prior, _gmm_prior_to_standard)
 
         alpha_k, beta_k, m_k, C_k, v_k, x_k, S_k = gmm.m_step(x_samples, r_nk, alpha_0, beta_0, m_0, C_0, v_0,
                                                               name='gmm_m_step')
@@ -187,8 +503,8 @@ def m_step_smm(smm_prior, r_nk):
     """
 
     with tf.name_scope('m_step'):
-        # execute SMM-EM m-step to update multinomial
-        alpha_0 = dirichlet.natural_to_standard(smm_prior[0])
+        # execute SMM-EM m-step to update multinomial (the prior is constant, see m_step)
+        alpha_0, = cached_transform('smm_prior_standard', [smm_prior], _smm_prior_to_standard)
 
         N_k = smm.update_Nk(r_nk)
         alpha_k = smm.update_alphak(alpha_0, N_k)
@@ -196,51 +512,90 @@ def m_step_smm(smm_prior, r_nk):
         return tf.identity(alpha, name='alpha_star')
 
 
-def compute_elbo(y, reconstructions, theta, phi_tilde, x_k_samps, log_z_given_y_phi, decoder_type):
-    # ELBO for latent GMM
+def _np_niw_natural_to_standard(A, b, beta, v_hat):
+    # NumPy version of niw.natural_to_standard
+    m = b / beta[:, None]
+    C = A - b[:, :, None] * m[:, None, :]
+    v = v_hat - m.shape[1] - 2
+    return beta, m, C, v
+
+
+def _gmm_prior_to_standard(gmm_prior):
+    # the prior created by init_mm is constant: fold its standard parameters
+    folded = fold_constants(gmm_prior, lambda prior: [prior[0] + 1] + list(_np_niw_natural_to_standard(*prior[1:])),
+                            name='gmm_prior_standard')
+    if folded is not None:
+        return folded
+    with tf.name_scope('gmm_prior_to_stndrd'):
+        beta_0, m_0, C_0, v_0 = niw.natural_to_standard(*gmm_prior[1:])
+        alpha_0 = dirichlet.natural_to_standard(gmm_prior[0])
+    return alpha_0, beta_0, m_0, C_0, v_0
+
+
+def _smm_prior_to_standard(smm_prior):
+    alpha_0 = smm_prior[0]
+    folded = fold_constants([alpha_0], lambda prior: [prior[0] + 1], name='smm_prior_standard')
+    return folded if folded is not None else [dirichlet.natural_to_standard(alpha_0)]
+
+
+def _expected_theta_to_natural(theta):
+    with tf.name_scope('expct_theta_to_nat'):
+        beta_k, m_k, C_k, v_k = niw.natural_to_standard(*theta[1:])
+        mu, sigma = niw.expected_values((beta_k, m_k, C_k, v_k))
+        eta1_theta, eta2_theta = gaussian.standard_to_natural(mu, sigma)
+        alpha_k = dirichlet.natural_to_standard(theta[0])
+        expected_log_pi_theta = dirichlet.expected_log_pi(alpha_k)
+
+        # do not backpropagate through GMM
+        with tf.name_scope('block_backprop'):
+            eta1_theta = tf.stop_gradient(eta1_theta)
+            eta2_theta = tf.stop_gradient(eta2_theta)
+            expected_log_pi_theta = tf.stop_gradient(expected_log_pi_theta)
+
+        return eta1_theta, eta2_theta, expected_log_pi_theta
+
+
+def compute_elbo(y, reconstructions, theta, log_q_x_k, x_k_samps, log_z_given_y_phi, decoder_type, comp_idx=None):
+    # ELBO for latent GMM; if comp_idx is not None, only the kept components comp_idx (shape N, T) are evaluated
     with tf.name_scope('elbo'):
         # unpack phi_gmm and compute expected theta
-        with tf.name_scope('expct_theta_to_nat'):
-            beta_k, m_k, C_k, v_k = niw.natural_to_standard(*theta[1:])
-            mu, sigma = niw.expected_values((beta_k, m_k, C_k, v_k))
-            eta1_theta, eta2_theta = gaussian.standard_to_natural(mu, sigma)
-            alpha_k = dirichlet.natural_to_standard(theta[0])
-            expected_log_pi_theta = dirichlet.expected_log_pi(alpha_k)
-
-            # do not backpropagate through GMM
-            with tf.name_scope('block_backprop'):
-                eta1_theta = tf.stop_gradient(eta1_theta)
-                eta2_theta = tf.stop_gradient(eta2_theta)
-                expected_log_pi_theta = tf.stop_gradient(expected_log_pi_theta)
+        # (computed once per graph and shared by all towers)
+        eta1_theta, eta2_theta, expected_log_pi_theta = cached_transform('expct_theta_to_nat', theta,
+                                                                         _expected_theta_to_natural)
 
         r_nk = tf.exp(log_z_given_y_phi)
 
         # compute negative reconstruction error; sum over minibatch (use VAE function)
-        means, out_2 = reconstructions  # out_2 is either gaussian variances or bernoulli logits.
+        # (the reconstruction term is evaluated in loss precision, see helpers/precision.py)
+        # out_2 is either gaussian variances or bernoulli logits.
+        means, out_2 = [cast(out, 'loss', name='reconstruction') for out in reconstructions]
+        y_loss = cast(y, 'loss', name='y')
+        r_nk_loss = cast(r_nk, 'loss', name='r_nk')
         if decoder_type == 'standard':
-            neg_reconstruction_error = vae.expected_diagonal_gaussian_loglike(y, means, out_2, weights=r_nk)
+            neg_reconstruction_error = vae.expected_diagonal_gaussian_loglike(y_loss, means, out_2, weights=r_nk_loss)
         elif decoder_type == 'bernoulli':
-            neg_reconstruction_error = vae.expected_bernoulli_loglike(y, out_2, r_nk=r_nk)
+            neg_reconstruction_error = vae.expected_bernoulli_loglike(y_loss, out_2, r_nk=r_nk_loss)
         else:
             raise NotImplementedError
 
         # compute E[log q_phi(x,z=k|y)]
-        eta1_phi_tilde, eta2_phi_tilde = phi_tilde
-        N, K, L, _ = eta2_phi_tilde.get_shape().as_list()
-        eta1_phi_tilde = tf.reshape(eta1_phi_tilde, (N, K, L))
-
         N, K, S, L = x_k_samps.get_shape().as_list()
+        assert log_q_x_k.get_shape() == (N, K, S)
 
         with tf.name_scope('compute_regularizer'):
             with tf.name_scope('log_numerator'):
-                log_N_x_given_phi = gaussian.log_probability_nat_per_samp(x_k_samps, eta1_phi_tilde, eta2_phi_tilde)
-                log_numerator = log_N_x_given_phi + tf.expand_dims(log_z_given_y_phi, axis=2)
+                # log q(x|z=k, y, phi) has been computed alongside the samples (see sample_x_per_comp)
+                log_numerator = log_q_x_k + tf.expand_dims(log_z_given_y_phi, axis=2)
 
             with tf.name_scope('log_denominator'):
-                log_N_x_given_theta = gaussian.log_probability_nat_per_samp(x_k_samps,
-                                                                            tf.tile(tf.expand_dims(eta1_theta, axis=0), [N, 1, 1]),
-                                                                            tf.tile(tf.expand_dims(eta2_theta, axis=0), [N, 1, 1, 1]))
-                log_denominator = log_N_x_given_theta + tf.expand_dims(tf.expand_dims(expected_log_pi_theta, axis=0), axis=2)
+                # theta only depends on k: factorise once per component and broadcast against the samples
+                log_N_x_given_theta = gaussian.log_probability_nat_per_comp(x_k_samps, eta1_theta, eta2_theta,
+                                                                            comp_idx=comp_idx)
+                if comp_idx is None:
+                    expected_log_pi_theta = tf.expand_dims(expected_log_pi_theta, axis=0)
+                else:
+                    expected_log_pi_theta = tf.gather(expected_log_pi_theta, comp_idx)
+                log_denominator = log_N_x_given_theta + tf.expand_dims(expected_log_pi_theta, axis=2)
 
             regularizer_term = tf.reduce_mean(
                 tf.reduce_sum(
@@ -251,19 +606,21 @@ def compute_elbo(y, reconstructions, theta, phi_tilde, x_k_samps, log_z_given_y_
                     axis=0)  # sum over minibatch
             )  # mean over samples
 
+        regularizer_term = cast(regularizer_term, 'loss', name='regularizer')
         elbo = tf.subtract(neg_reconstruction_error, regularizer_term, name='elbo')
 
         with tf.name_scope('elbo_summaries'):
             details = tf.tuple((neg_reconstruction_error,
-                                tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_numerator, -1))),
-                                tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_denominator, -1))),
+                                cast(tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_numerator, -1))), 'loss'),
+                                cast(tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_denominator, -1))), 'loss'),
                                 regularizer_term), name='debug')
 
         return elbo, details
 
 
-def compute_elbo_smm(y, reconstructions, theta, phi_tilde, x_k_samps, log_z_given_y_phi, decoder_type):
-    # ELBO for latent SMM
+def compute_elbo_smm(y, reconstructions, theta, log_q_x_k, x_k_samps, log_z_given_y_phi, decoder_type,
+                     comp_idx=None):
+    # ELBO for latent SMM; if comp_idx is not None, only the kept components comp_idx (shape N, T) are evaluated
     with tf.name_scope('elbo'):
         # unpack phi_gmm and compute expected theta
         mu_theta, sigma_theta = unpack_smm(theta[1:3])
@@ -279,28 +636,36 @@ def compute_elbo_smm(y, reconstructions, theta, phi_tilde, x_k_samps, log_z_give
         r_nk = tf.exp(log_z_given_y_phi)
 
         # compute negative reconstruction error; sum over minibatch (use VAE function)
-        means, out_2 = reconstructions  # out_2 is either gaussian variances or bernoulli logits.
+        # (the reconstruction term is evaluated in loss precision, see helpers/precision.py)
+        # out_2 is either gaussian variances or bernoulli logits.
+        means, out_2 = [cast(out, 'loss', name='reconstruction') for out in reconstructions]
+        y_loss = cast(y, 'loss', name='y')
+        r_nk_loss = cast(r_nk, 'loss', name='r_nk')
         if decoder_type == 'standard':
-            neg_reconstruction_error = vae.expected_diagonal_gaussian_loglike(y, means, out_2, weights=r_nk)
+            neg_reconstruction_error = vae.expected_diagonal_gaussian_loglike(y_loss, means, out_2, weights=r_nk_loss)
         elif decoder_type == 'bernoulli':
-            neg_reconstruction_error = vae.expected_bernoulli_loglike(y, out_2, r_nk=r_nk)
+            neg_reconstruction_error = vae.expected_bernoulli_loglike(y_loss, out_2, r_nk=r_nk_loss)
         else:
             raise NotImplementedError
 
-        eta1_phi_tilde, eta2_phi_tilde = phi_tilde
-        N, K, L, _ = eta2_phi_tilde.get_shape().as_list()
-        eta1_phi_tilde = tf.reshape(eta1_phi_tilde, (N, K, L))
+        N, K, S, L = x_k_samps.get_shape().as_list()
+        assert log_q_x_k.get_shape() == (N, K, S)
 
         with tf.name_scope('compute_regularizer'):
             # compute E[log q_phi(x,z=k|y)]
             with tf.name_scope('log_numerator'):
-                log_N_x_given_phi = gaussian.log_probability_nat_per_samp(x_k_samps, eta1_phi_tilde, eta2_phi_tilde)
-                log_numerator = log_N_x_given_phi + tf.expand_dims(log_z_given_y_phi, axis=2)
+                # log q(x|z=k, y, phi) has been computed alongside the samples (see sample_x_per_comp)
+                log_numerator = log_q_x_k + tf.expand_dims(log_z_given_y_phi, axis=2)
 
             with tf.name_scope('log_denominator'):
                 # compute E[log p_theta(x,z=k)]
-                log_N_x_given_theta = student_t.log_probability_per_samp(x_k_samps, mu_theta, sigma_theta, dof)
-                log_denominator = log_N_x_given_theta + tf.expand_dims(tf.expand_dims(expected_log_pi_theta, axis=0), axis=2)
+                log_N_x_given_theta = student_t.log_probability_per_samp(x_k_samps, mu_theta, sigma_theta, dof,
+                                                                         comp_idx=comp_idx)
+                if comp_idx is None:
+                    expected_log_pi_theta = tf.expand_dims(expected_log_pi_theta, axis=0)
+                else:
+                    expected_log_pi_theta = tf.gather(expected_log_pi_theta, comp_idx)
+                log_denominator = log_N_x_given_theta + tf.expand_dims(expected_log_pi_theta, axis=2)
 
             regularizer_term = tf.reduce_mean(
                 tf.reduce_sum(
@@ -311,12 +676,13 @@ def compute_elbo_smm(y, reconstructions, theta, phi_tilde, x_k_samps, log_z_give
                     axis=0)  # sum over data points
             )  # mean over samples
 
+        regularizer_term = cast(regularizer_term, 'loss', name='regularizer')
         elbo = tf.subtract(neg_reconstruction_error, regularizer_term, name='elbo')
 
         with tf.name_scope('elbo_summaries'):
             details = tf.tuple((neg_reconstruction_error,
-                                tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_numerator, -1))),
-                                tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_denominator, -1))),
+                                cast(tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_numerator, -1))), 'loss'),
+                                cast(tf.reduce_sum(tf.multiply(r_nk, tf.reduce_mean(log_denominator, -1))), 'loss'),
                                 regularizer_term), name='debug')
 
         return elbo, details
@@ -333,13 +699,18 @@ def unpack_recognition_gmm_debug(phi_gmm, name='unpack_phi2'):
             L_k = tf.matrix_set_diag(L_k, tf.nn.softplus(tf.matrix_diag_part(L_k), name='softplus_diag'), name='L')
             P = tf.matmul(L_k, tf.matrix_transpose(L_k), name='precision')
 
-        eta2 = tf.multiply(tf.constant(-0.5, dtype=tf.float32), P)
+        eta2 = tf.multiply(tf.constant(-0.5, dtype=P.dtype), P)
         pi_k = tf.nn.softmax(pi_k_raw)
 
         return eta1, eta2, pi_k, L_k_raw
 
 
 def unpack_recognition_gmm(phi_gmm, name='unpack_phi2'):
+    # computed once per graph and shared by all consumers (towers, test inference, imputation, prediction, plotting)
+    return cached_transform(name, phi_gmm, lambda params: _unpack_recognition_gmm(params, name))
+
+
+def _unpack_recognition_gmm(phi_gmm, name='unpack_phi2'):
 
     with tf.name_scope(name):
         eta1, L_k_raw, pi_k_raw = phi_gmm
@@ -350,7 +721,7 @@ def unpack_recognition_gmm(phi_gmm, name='unpack_phi2'):
             L_k = tf.matrix_set_diag(L_k, tf.nn.softplus(tf.matrix_diag_part(L_k), name='softplus_diag'), name='L')
             P = tf.matmul(L_k, tf.matrix_transpose(L_k), name='precision')
 
-        eta2 = tf.multiply(tf.constant(-0.5, dtype=tf.float32), P)
+        eta2 = tf.multiply(tf.constant(-0.5, dtype=P.dtype), P)
 
         # make sure that log_pi_k are valid mixture coefficients
         pi_k = tf.nn.softmax(pi_k_raw)
@@ -359,7 +730,11 @@ def unpack_recognition_gmm(phi_gmm, name='unpack_phi2'):
 
 
 def unpack_smm(theta_smm, name='unpack_theta_smm'):
-    # extract point-estimates for Student-t mixture components
+    # extract point-estimates for Student-t mixture components (computed once per graph, see unpack_recognition_gmm)
+    return cached_transform(name, theta_smm, lambda params: _unpack_smm(params, name))
+
+
+def _unpack_smm(theta_smm, name='unpack_theta_smm'):
 
     with tf.name_scope(name):
         mu, L_k_raw = theta_smm
@@ -392,11 +767,15 @@ def update_gmm_params(current_gmm_params, gmm_params_star, step_size, name='cvi_
             name_re = re.search(r'(?<=\/)[^\:]*', curr_param.name)
             param_name = name_re.group(0) if name_re is not None else 'param_%d' % i
 
+            # step size follows the parameter's precision
+            param_step_size = tf.cast(step_size, curr_param.dtype.base_dtype)
+
             # generate list containing updates for each parameter in theta
             updates.append(
                 tf.identity(
                     tf.assign(curr_param,
-                              tf.add(((1 - step_size) * curr_param), (step_size * param_star), name='convex_combination'),
+                              tf.add(((1 - param_step_size) * curr_param), (param_step_size * param_star),
+                                     name='convex_combination'),
                               name='update_%s' % param_name)
                 )
             )
@@ -421,8 +800,9 @@ def predict(y, phi_gmm, encoder_layers, decoder_layers, seed=0):
         phi_enc = vae.make_encoder(y, layerspecs=encoder_layers)
 
         # predict cluster allocation and sample latent variables (e-step)
-        x_k_samples, log_r_nk, _, _ = e_step(phi_enc, phi_gmm, nb_samples, name="svae_e_step_predict", seed=seed)
-        x_samples = subsample_x(x_k_samples, log_r_nk, seed)[:, 0, :]
+        x_samples, _, log_r_nk, _ = e_step_ancestral(phi_enc, phi_gmm, nb_samples, name="svae_e_step_predict",
+                                                     seed=seed)
+        x_samples = x_samples[:, 0, :]
 
         # decode (reusing current decoder parameters)
         y_mean, _ = vae.make_decoder(x_samples, layerspecs=decoder_layers)
@@ -434,11 +814,14 @@ def init_mm_params(nb_components, latent_dims, alpha_scale=.1, beta_scale=1e-5,
                    seed=0, as_variables=True, trainable=False, device='/gpu:0', name='gmm'):
 
     with tf.name_scope('gmm_initialization'):
-        alpha_init = alpha_scale * tf.ones((nb_components,))
-        beta_init = beta_scale * tf.ones((nb_components,))
-        v_init = tf.tile([float(latent_dims + v_init)], [nb_components])
-        means_init = m_scale * tf.random_uniform((nb_components, latent_dims), minval=-1, maxval=1, seed=seed)
-        covariance_init = C_scale * tf.tile(tf.expand_dims(tf.eye(latent_dims), axis=0), [nb_components, 1, 1])
+        dtype = get_dtype('pgm')
+        alpha_init = alpha_scale * tf.ones((nb_components,), dtype=dtype)
+        beta_init = beta_scale * tf.ones((nb_components,), dtype=dtype)
+        v_init = tf.tile(tf.constant([float(latent_dims + v_init)], dtype=dtype), [nb_components])
+        means_init = m_scale * tf.random_uniform((nb_components, latent_dims), minval=-1, maxval=1, seed=seed,
+                                                 dtype=dtype)
+        covariance_init = C_scale * tf.tile(tf.expand_dims(tf.eye(latent_dims, dtype=dtype), axis=0),
+                                            [nb_components, 1, 1])
 
         # transform to natural parameters
         A, b, beta, v_hat = niw.standard_to_natural(beta_init, means_init, covariance_init, v_init)
@@ -458,12 +841,30 @@ def init_mm_params(nb_components, latent_dims, alpha_scale=.1, beta_scale=1e-5,
         return params
 
 
+def init_mm_prior(nb_components, latent_dims, alpha_scale=.1, beta_scale=1e-5, v_init=10., C_scale=10.,
+                  name='theta_prior'):
+    # constant Dirichlet+NiW prior with zero means; computed in NumPy s.t. its transforms can be folded (see m_step)
+    with tf.name_scope(name):
+        dtype = get_dtype('pgm').as_numpy_dtype
+        alpha = alpha_scale * np.ones(nb_components, dtype=dtype)
+        beta = beta_scale * np.ones(nb_components, dtype=dtype)
+        v = (latent_dims + v_init) * np.ones(nb_components, dtype=dtype)
+        m = np.zeros((nb_components, latent_dims), dtype=dtype)
+        C = C_scale * np.tile(np.eye(latent_dims, dtype=dtype)[None], (nb_components, 1, 1))
+
+        # transform to natural parameters (see niw.standard_to_natural and dirichlet.standard_to_natural)
+        b = beta[:, None] * m
+        A = C + b[:, :, None] * m[:, None, :]
+        v_hat = v + latent_dims + 2
+        return tuple(tf.constant(param, name=param_name) for param, param_name in
+                     zip([alpha - 1, A, b, beta, v_hat], ['alpha_k', 'beta_k', 'm_k', 'C_k', 'v_k']))
+
+
 def init_mm(nb_components, latent_dims, seed=0, param_device='/gpu:0', name='init_mm', theta_as_variable=True):
     with tf.name_scope(name):
         # prior parameters are always tf.constant.
-        theta_prior = init_mm_params(nb_components, latent_dims, alpha_scale=0.05 / nb_components, beta_scale=0.5,
-                                     m_scale=0, C_scale=latent_dims + 0.5, v_init=latent_dims + 0.5,seed=seed,
-                                     as_variables=False, name='theta_prior', trainable=False, device=param_device)
+        theta_prior = init_mm_prior(nb_components, latent_dims, alpha_scale=0.05 / nb_components, beta_scale=0.5,
+                                    C_scale=latent_dims + 0.5, v_init=latent_dims + 0.5)
 
         theta = init_mm_params(nb_components, latent_dims, alpha_scale=1., beta_scale=1., m_scale=5.,
                                C_scale=2 * (latent_dims), v_init=latent_dims + 1., seed=seed, name='theta',
@@ -488,7 +889,8 @@ def make_loc_scale_variables(theta, param_device='/gpu:0', name='copy_m_v'):
 def init_recognition_params(theta, nb_components, seed=0, param_device='/gpu:0', var_scope='phi_gmm'):
     # make parameters for PGM part of recognition network
     with tf.name_scope('init_' + var_scope):
-        pi_k_init = tf.nn.softmax(tf.random_normal(shape=(nb_components,), mean=0.0, stddev=1., seed=seed))
+        pi_k_init = tf.nn.softmax(tf.random_normal(shape=(nb_components,), mean=0.0, stddev=1., seed=seed,
+                                                   dtype=get_dtype('pgm')))
 
         with tf.variable_scope(var_scope):
             mu_k, L_k = make_loc_scale_variables(theta, param_device)
@@ -496,8 +898,54 @@ def init_recognition_params(theta, nb_components, seed=0, param_device='/gpu:0',
             return mu_k, L_k, pi_k
 
 
+def init_model_params(method, nb_components, latent_dims, dof=None, seed=0, param_device='/gpu:0'):
+    """
+    Creates the PGM parameters of the SVAE.
+    Args:
+        method: method name; if it contains 'smm', the model is a Student-t mixture, otherwise a GMM
+        nb_components: number of mixture components
+        latent_dims: latent dimensionality
+        dof: Student-t degrees of freedom (SMM only)
+        seed: random seed
+        param_device: where parameters are stored
+
+    Returns:
+        prior, model parameters theta and recognition GMM parameters phi_gmm
+    """
+    # mu_theta and sigma_theta are point estimates in the SMM case.
+    if 'smm' in method:
+        # init helper values for SMM (theta is a constant, we just need it to init the rec GMM below)
+        gmm_prior, theta = init_mm(nb_components, latent_dims, seed=seed, param_device=param_device,
+                                   theta_as_variable=False)
+
+        # create tensor for Student-t parameters
+        with tf.variable_scope('theta'):
+            mu_k, L_k = make_loc_scale_variables(gmm_prior, param_device=param_device)
+            DoF = dof * tf.ones((nb_components,), dtype=get_dtype('pgm'))
+            DoF = variable_on_device('DoF_k', shape=None, initializer=DoF, trainable=False, device=param_device)
+
+            alpha_k = variable_on_device('alpha_k', shape=None, initializer=theta[0], trainable=False,
+                                         device=param_device)
+
+        # init inference GMM parameters
+        phi_gmm = init_recognition_params(theta, nb_components, seed=seed, param_device=param_device)
+
+        # only keep dirichlet prior, as other parameters will be point estimates
+        gmm_prior = gmm_prior[0]
+        theta = (alpha_k, mu_k, L_k, DoF)
+
+    else:
+        # init model-GMM
+        gmm_prior, theta = init_mm(nb_components, latent_dims, seed=seed, param_device=param_device)
+
+        # init recognition-GMM
+        phi_gmm = init_recognition_params(theta, nb_components, seed=seed, param_device=param_device)
+
+    return gmm_prior, theta, phi_gmm
+
+
 def inference(y, phi_gmm, encoder_layers, decoder_layers, nb_samples=10, stddev_init_nn=0.01, seed=0, name='inference',
-              param_device='/gpu:0'):
+              param_device='/gpu:0', top_k=None):
     with tf.name_scope(name):
 
         # Use VAE encoder
@@ -505,7 +953,8 @@ def inference(y, phi_gmm, encoder_layers, decoder_layers, nb_samples=10, stddev_
                                          param_device=param_device, seed=seed)
 
         # execute E-step (update/sample local variables)
-        x_k_samples, log_z_given_y_phi, phi_tilde, w_eta_12 = e_step(x_given_y_phi, phi_gmm, nb_samples, seed=seed)
+        x_k_samples, log_z_given_y_phi, phi_tilde, log_q_x_k, comp_idx = e_step(x_given_y_phi, phi_gmm, nb_samples,
+                                                                                 seed=seed, top_k=top_k)
 
         # compute reconstruction
         y_reconstruction = vae.make_decoder(x_k_samples, layerspecs=decoder_layers, stddev_init=stddev_init_nn,
@@ -513,7 +962,8 @@ def inference(y, phi_gmm, encoder_layers, decoder_layers, nb_samples=10, stddev_
 
         x_samples = subsample_x(x_k_samples, log_z_given_y_phi, seed)[:, 0, :]
 
-        return y_reconstruction, x_given_y_phi, x_k_samples, x_samples, log_z_given_y_phi, phi_gmm, phi_tilde
+        return (y_reconstruction, x_given_y_phi, x_k_samples, x_samples, log_z_given_y_phi, phi_gmm, phi_tilde,
+                log_q_x_k, comp_idx)
 
 
 def identity_transform(input, nb_components, nb_samples, type='standard', name='debug_nn'):
@@ -521,7 +971,8 @@ def identity_transform(input, nb_components, nb_samples, type='standard', name='
     with tf.name_scope(name):
         nn_var = 1e-1
         mu = input
-        sigma = tf.constant(np.repeat(np.array([[nn_var, 0], [0, nn_var]])[None, :, :], mu.shape[0], axis=0), dtype=tf.float32)
+        sigma = tf.constant(np.repeat(np.array([[nn_var, 0], [0, nn_var]])[None, :, :], mu.shape[0], axis=0),
+                            dtype=mu.dtype)
 
         if type == 'natparam':
             eta1, eta2 = gaussian.standard_to_natural(mu, sigma)
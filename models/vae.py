@@ -10,16 +10,18 @@ from data import make_minibatch
 from helpers.logging_utils import generate_log_id
 from losses import weighted_mse, diagonal_gaussian_logprob, bernoulli_logprob, generate_missing_data_mask, \
     imputation_losses
+from helpers.precision import cast, fp32_storage_getter, get_dtype
 from helpers.scheduling import create_schedule
 from helpers.tf_utils import variable_on_device
 
 
 def make_layer(inputs, units, stddev=1, activation=tf.tanh, name='layer', param_device='/gpu:0', seed=0):
     # make sure that variables are saved on parameter device (important in multi-GPU setup)
+    dtype = inputs.dtype.base_dtype
     with tf.device(param_device):
         return tf.layers.dense(inputs, units=units,
-                               bias_initializer=tf.random_normal_initializer(stddev=stddev, dtype=tf.float32, seed=seed),
-                               kernel_initializer=tf.random_normal_initializer(stddev=stddev, dtype=tf.float32, seed=seed),
+                               bias_initializer=tf.random_normal_initializer(stddev=stddev, dtype=dtype, seed=seed),
+                               kernel_initializer=tf.random_normal_initializer(stddev=stddev, dtype=dtype, seed=seed),
                                activation=activation,
                                name=name)
 
@@ -74,7 +76,12 @@ def rand_partial_isometry(m, n, stddev, seed=0):
 
 def make_nnet(input, layerspecs, stddev, name, param_device='/gpu:0', seed=0):
 
-    with tf.variable_scope(name):
+    # variables are stored in float32 if the net runs in float16 (see helpers/precision.py)
+    with tf.variable_scope(name, custom_getter=fp32_storage_getter):
+        # run neural nets in their own precision (see helpers/precision.py)
+        dtype = get_dtype('nn')
+        input = cast(input, 'nn')
+
         # ravel inputs: (M, K, D) -> (M*K, D)
         input_shape = input.get_shape()
         input_dim = int(input_shape[-1])
@@ -95,22 +102,22 @@ def make_nnet(input, layerspecs, stddev, name, param_device='/gpu:0', seed=0):
 
         # create resnet-like shortcut (as in Johnson's SVAE code)
         with tf.variable_scope('shortcut'):
-            orthonormal_cols = tf.constant(rand_partial_isometry(input_dim, output_dim, 1., seed=seed), dtype=tf.float32)
+            orthonormal_cols = tf.constant(rand_partial_isometry(input_dim, output_dim, 1., seed=seed), dtype=dtype)
             W = variable_on_device('W', shape=None, initializer=orthonormal_cols, trainable=True, device=param_device,
-                                   dtype=tf.float32)
-            b1 = variable_on_device('b1', shape=None, initializer=tf.zeros(output_dim), trainable=True,
-                                    device=param_device, dtype=tf.float32)
+                                   dtype=dtype)
+            b1 = variable_on_device('b1', shape=None, initializer=tf.zeros(output_dim, dtype=dtype), trainable=True,
+                                    device=param_device, dtype=dtype)
             out_res = tf.add(tf.matmul(input, W), b1, name='res_shortcut_1')
 
             # create shortcut for second output (in Gaussian case)
             if type != 'bernoulli':
-                b2 = variable_on_device('b2', shape=None, initializer=tf.zeros(output_dim), trainable=True,
-                                        device=param_device, dtype=tf.float32)
+                b2 = variable_on_device('b2', shape=None, initializer=tf.zeros(output_dim, dtype=dtype), trainable=True,
+                                        device=param_device, dtype=dtype)
 
                 if type == 'standard':
-                    a = tf.constant(1., dtype=tf.float32)
+                    a = tf.constant(1., dtype=dtype)
                 elif type == 'natparam':
-                    a = tf.constant(-0.5, dtype=tf.float32)
+                    a = tf.constant(-0.5, dtype=dtype)
                 else:
                     raise NotImplementedError
                 out_res = (out_res, tf.multiply(a, tf.log1p(tf.exp(b2)), name='res_shortcut_2'))
@@ -221,10 +228,11 @@ def expected_diagonal_gaussian_loglike(y, means, vars, weights=None, name='diag_
 
             sample_mean = tf.reduce_sum(tf.pow(tf.expand_dims(y, axis=1) - means, 2) / vars) + tf.reduce_sum(tf.log(vars))
 
-            S = tf.constant(int(S), dtype=tf.float32, name='number_samples')
-            M = tf.constant(int(M), dtype=tf.float32, name='size_minibatch')
-            L = tf.constant(int(L), dtype=tf.float32, name='latent_dimensions')
-            pi = tf.constant(np.pi, dtype=tf.float32, name='pi')
+            dtype = means.dtype.base_dtype
+            S = tf.constant(int(S), dtype=dtype, name='number_samples')
+            M = tf.constant(int(M), dtype=dtype, name='size_minibatch')
+            L = tf.constant(int(L), dtype=dtype, name='latent_dimensions')
+            pi = tf.constant(np.pi, dtype=dtype, name='pi')
 
             sample_mean /= S
             loglik = -1/2 * sample_mean - M * L/2. * tf.log(2. * pi)
@@ -239,10 +247,11 @@ def expected_diagonal_gaussian_loglike(y, means, vars, weights=None, name='diag_
 
             sample_mean = tf.einsum('nksd,nk->', tf.square(y - means)/ vars + tf.log(vars + 1e-8), weights)
 
-            M = tf.constant(int(M), dtype=tf.float32, name='size_minibatch')
-            S = tf.constant(int(S), dtype=tf.float32, name='number_samples')
-            L = tf.constant(int(L), dtype=tf.float32, name='latent_dimensions')
-            pi = tf.constant(np.pi, dtype=tf.float32, name='pi')
+            dtype = means.dtype.base_dtype
+            M = tf.constant(int(M), dtype=dtype, name='size_minibatch')
+            S = tf.constant(int(S), dtype=dtype, name='number_samples')
+            L = tf.constant(int(L), dtype=dtype, name='latent_dimensions')
+            pi = tf.constant(np.pi, dtype=dtype, name='pi')
 
             sample_mean /= S
             loglik = -1/2 * sample_mean - M * L/2. * tf.log(2. * pi)
@@ -290,7 +299,8 @@ def reparam_trick_sampling(mean, var_diag, nb_samples, seed):
         expa_mean = tf.expand_dims(mean, axis=1)
         expa_var = tf.expand_dims(var_diag, axis=1)
 
-        epsilon = tf.contrib.distributions.Normal(loc=tf.zeros(sample_shape), scale=tf.ones(sample_shape))
+        epsilon = tf.contrib.distributions.Normal(loc=tf.zeros(sample_shape, dtype=mean.dtype),
+                                                  scale=tf.ones(sample_shape, dtype=mean.dtype))
         var_sample = tf.einsum('msl,msl->msl', tf.sqrt(expa_var), epsilon.sample(seed=seed))
 
         return expa_mean + var_sample
@@ -440,13 +450,13 @@ if __name__ == '__main__':
                 missing_data_mask = generate_missing_data_mask(y_te, ratio_missing_data, seed=seed)
 
                 # define imputation procedure for VAE (encode perturbed data end decode it again)
-                def impute(y_perturbed):
+                def impute(y_perturbed, chunk_seed):
                     with tf.name_scope('missing_data_imputation'):
                         tf.get_variable_scope().reuse_variables()
                         N_pert, _ = y_perturbed.get_shape().as_list()
                         x_imp_mean, x_imp_var_diag = make_encoder(y_perturbed, layerspecs=encoder_layers,
                                                                   stddev_init=stddev_init, seed=seed)
-                        x_imp_samp = reparam_trick_sampling(x_imp_mean, x_imp_var_diag, nb_samples_te, seed)
+                        x_imp_samp = reparam_trick_sampling(x_imp_mean, x_imp_var_diag, nb_samples_te, chunk_seed)
                         y_imp_mean, y_imp_var_diag = make_decoder(x_imp_samp, layerspecs=decoder_layers,
                                                                   stddev_init=stddev_init, seed=seed)
 
@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+from helpers.precision import compute_scaled_gradients
+from helpers.tf_utils import accumulate_gradients, average_gradients
+from models import svae
+
+"""
+Training graph of the SVAE: model (recognition GMM, encoder/decoder networks, PGM), ELBO and the training step, which
+updates the PGM parameters theta with a CVI step and all other parameters with the given optimizer.
+Shared by experiments.py (one tower per device) and ensemble.py (one replica per seed).
+"""
+
+
+def build_training_graph(y_tr, config, opt, lrcvi, encoder_layers, decoder_layers, decoder_type, nb_samples,
+                         param_device, devices, global_step=None, nb_micro_batches=1):
+    """
+    Builds the SVAE and its training step; the minibatch is distributed over towers which share all parameters.
+    Args:
+        y_tr: list of minibatches, one per tower
+        config: experiment config (method, K, L, DoF, seed and top_k are used)
+        opt: optimizer for the deterministic parameters (recognition GMM and neural networks)
+        lrcvi: step size of the CVI update of theta
+        encoder_layers: encoder architecture (see vae.make_encoder)
+        decoder_layers: decoder architecture (see vae.make_decoder)
+        decoder_type: 'standard' or 'bernoulli'
+        nb_samples: nb samples for gradient computation
+        param_device: where parameters are stored and theta is updated
+        devices: one device per tower (e.g. tf_utils.tower_devices)
+        global_step: incremented by the update of the deterministic parameters (if not None)
+        nb_micro_batches: nb minibatches over which gradients are accumulated before they are applied; this only
+            applies to the deterministic parameters: the CVI update of theta in the training step only uses the last
+            minibatch (x_samples and r_nk of the accumulation steps are discarded), i.e. theta sees 1/nb_micro_batches
+            of the data processed per training step
+
+    Returns:
+        dict with the model parameters (gmm_prior, theta, phi_gmm), the training step (training_step, and
+        accumulate_step if nb_micro_batches > 1) and the tensors of all towers needed for performance measures:
+        log_z_given_y_phi, r_nk, x_samples, y_mean_rec, out2_rec (concatenated over towers), elbo and
+        details = (neg_rec_err, numerator, denominator, regularizer) (summed over towers)
+    """
+    top_k = config.get('top_k', None)
+
+    # init model-GMM/SMM and recognition-GMM
+    gmm_prior, theta, phi_gmm = svae.init_model_params(config['method'], config['K'], config['L'],
+                                                       dof=config.get('DoF'), seed=config['seed'],
+                                                       param_device=param_device)
+
+    # init lists for collecting tower outputs
+    tower_grads = []
+    tower_x_samps = []
+    tower_r_nk = []
+    tower_comp_idx = []
+    tower_elbo = []
+    tower_details = []
+    tower_mean_rec = []
+    tower_out2_rec = []
+
+    # build computation graph (distributed on multiple GPUs or logical CPU devices if required)
+    with tf.variable_scope(tf.get_variable_scope()) as v_scope:
+        for tower_id, (y_tr_tower, tower_device) in enumerate(zip(y_tr, devices)):
+            with tf.device(tower_device):
+                with tf.name_scope('tower_%d' % tower_id):
+
+                    # build model, using parameters saved on param_device
+                    (y_k_rec, y_enc, x_k_samples, x_samples,
+                     log_z_given_y_phi,
+                     phi_gmm, phi_tilde, log_q_x_k, comp_idx) = svae.inference(y_tr_tower, phi_gmm, encoder_layers,
+                                                                               decoder_layers, nb_samples,
+                                                                               param_device=param_device,
+                                                                               seed=config['seed'], top_k=top_k)
+
+                    # share model parameters across GPUs
+                    v_scope.reuse_variables()
+
+                    # collect local variables for updating PGM parameter theta
+                    tower_x_samps.append(x_samples)
+                    tower_r_nk.append(log_z_given_y_phi)
+                    tower_comp_idx.append(comp_idx)
+
+                    # compute elbo
+                    if 'smm' in config['method']:
+                        elbo, details = svae.compute_elbo_smm(y_tr_tower, y_k_rec, theta, log_q_x_k,
+                                                              x_k_samples, log_z_given_y_phi,
+                                                              decoder_type=decoder_type, comp_idx=comp_idx)
+                    else:
+                        elbo, details = svae.compute_elbo(y_tr_tower, y_k_rec, theta, log_q_x_k,
+                                                          x_k_samples, log_z_given_y_phi,
+                                                          decoder_type=decoder_type, comp_idx=comp_idx)
+
+                    # compute gradients for this tower
+                    grads_and_vars = compute_scaled_gradients(opt, -elbo, gate_gradients=0)
+                    tower_grads.append(grads_and_vars)
+
+                    # save values computed in this tower
+                    y_k_mean_rec, out2_rec = y_k_rec  # out2 are either bernoulli logits or gaussian variances
+                    tower_mean_rec.append(y_k_mean_rec)
+                    tower_out2_rec.append(out2_rec)
+                    tower_elbo.append(elbo)
+                    tower_details.append(details)
+
+    # collect local variables from all towers
+    log_z_given_y_phi = tf.concat(tower_r_nk, axis=0)
+    x_samples = tf.concat(tower_x_samps, axis=0)
+
+    # responsibilities of all K components (zero for components dropped by truncation)
+    if top_k is None:
+        r_nk = tf.exp(log_z_given_y_phi)
+    else:
+        r_nk = svae.scatter_responsibilities(tf.exp(log_z_given_y_phi), tf.concat(tower_comp_idx, axis=0),
+                                             config['K'])
+
+    # update GMM on param_device (with the last micro-batch only, see nb_micro_batches)
+    with tf.name_scope('GMM_update'):
+        with tf.device(param_device):
+            if 'smm' in config['method']:
+                # only alpha is updated...
+                alpha_star = svae.m_step_smm(smm_prior=gmm_prior, r_nk=r_nk)
+                update_theta = svae.update_gmm_params([theta[0]], [alpha_star], lrcvi)
+            else:
+                theta_star = svae.m_step(gmm_prior=gmm_prior, x_samples=x_samples, r_nk=r_nk)
+                update_theta = svae.update_gmm_params(theta, theta_star, lrcvi)
+
+    # update deterministic parameters
+    accumulate_step = None
+    with tf.name_scope('training'):
+        grads_and_vars = average_gradients(tower_grads)
+        if nb_micro_batches > 1:
+            # the training step applies the gradients averaged over this and the preceding accumulation steps
+            accumulate_step, grads_and_vars, grad_accumulators = accumulate_gradients(grads_and_vars,
+                                                                                      nb_micro_batches)
+        update_deterministic = opt.apply_gradients(grads_and_vars, global_step=global_step)
+        if nb_micro_batches > 1:
+            with tf.control_dependencies([update_deterministic]):
+                update_deterministic = tf.group(*[tf.assign(acc, tf.zeros_like(acc))
+                                                  for acc in grad_accumulators], name='reset_accumulators')
+
+    training_step = tf.group(update_theta, update_deterministic, name='training_ops')
+
+    return {
+        'gmm_prior': gmm_prior,
+        'theta': theta,
+        'phi_gmm': phi_gmm,
+        'training_step': training_step,
+        'accumulate_step': accumulate_step,
+        'log_z_given_y_phi': log_z_given_y_phi,
+        'r_nk': r_nk,
+        'x_samples': x_samples,
+        'y_mean_rec': tf.concat(tower_mean_rec, axis=0),
+        'out2_rec': tf.concat(tower_out2_rec, axis=0),
+        'elbo': tf.reduce_sum(tower_elbo),
+        'details': tuple(tf.reduce_sum(tower_detail) for tower_detail in zip(*tower_details))
+    }
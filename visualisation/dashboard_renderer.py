@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import numpy as np
+
+try:
+    from queue import Full
+except ImportError:  # python 2
+    from Queue import Full
+
+"""
+Off-thread rendering of the SVAE dashboard (see visualise_svae.svae_dashboard): the training loop submits NumPy
+snapshots of the plotted values to a renderer process through a bounded queue; if the renderer falls behind, new frames
+are dropped instead of blocking training. The PCA projection of the test data is fitted once per run.
+The renderer has to be started before TF sessions (and their threads) are created, since it is forked.
+"""
+
+
+def _render_loop(queue):
+    # matplotlib is only imported in the renderer process (the backend is inherited from the parent)
+    from sklearn.decomposition import PCA
+    from visualisation.visualise_svae import svae_dashboard
+
+    y_te, pca, path = None, None, None
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+
+        kind, data = message
+        if kind == 'run':
+            y_te, path = data
+            pca = PCA(n_components=2).fit(y_te) if y_te.shape[1] > 2 else None
+        else:
+            try:
+                plt = svae_dashboard(data['iter'], y_te, data['y_te_rec'], data['x_samps'], data['r_nk'],
+                                     data['cluster_alloc'], data['theta'], data['size_minibatch'],
+                                     data['perf_meas_iters'], data['measurement_freq'], data['elbo'],
+                                     data['debug_meas'], None, pca=pca, pause=False)
+                plt.tight_layout()
+                plt.savefig(path)
+            except Exception as e:
+                # a failing plot shouldn't stop the renderer (or training)
+                print('Dashboard rendering of iteration %d failed: %s' % (data['iter'], str(e)))
+
+
+class DashboardRenderer(object):
+
+    def __init__(self, max_queued_frames=2):
+        """
+        Starts the renderer process.
+        Args:
+            max_queued_frames: frames submitted while this many frames are waiting are dropped
+        """
+        self.queue = multiprocessing.Queue(maxsize=max_queued_frames)
+        self.process = multiprocessing.Process(target=_render_loop, args=(self.queue,), name='dashboard_renderer')
+        self.process.daemon = True
+        self.process.start()
+        self.nb_dropped = 0
+
+    def new_run(self, y_te, path):
+        # test data (the PCA projection is fitted on it) and output path of the following frames
+        self.queue.put(('run', (np.array(y_te), path)))
+
+    def submit(self, **frame):
+        """
+        Args:
+            **frame: arguments of svae_dashboard (iter, y_te_rec, x_samps, r_nk, cluster_alloc, theta, size_minibatch,
+                perf_meas_iters, measurement_freq, elbo, debug_meas); arrays are copied, s.t. the caller can keep
+                updating them
+
+        Returns:
+            False if the frame was dropped
+        """
+        snapshot = dict((key, np.array(val) if isinstance(val, np.ndarray) else val) for key, val in frame.items())
+        try:
+            self.queue.put_nowait(('frame', snapshot))
+            return True
+        except Full:
+            self.nb_dropped += 1
+            return False
+
+    def close(self):
+        # renders the remaining frames and stops the renderer process
+        self.queue.put(None)
+        self.process.join()
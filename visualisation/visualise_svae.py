@@ -8,7 +8,9 @@ plt.ion()
 fig, ax = plt.subplots(2, 2)
 
 
-def svae_dashboard(iter, y_te, y_te_rec, x_samps, r_nk, cluster_alloc, theta, size_minibatch, perf_meas_iters, measurement_freq, elbo, debug_meas, debug):
+def svae_dashboard(iter, y_te, y_te_rec, x_samps, r_nk, cluster_alloc, theta, size_minibatch, perf_meas_iters, measurement_freq, elbo, debug_meas, debug,
+                   pca=None, pause=True):
+    # pca: 2D projection of the data (fitted on y_te if None); pause: update interactive figure
 
     means, covs, pi = theta
 
@@ -17,7 +19,8 @@ def svae_dashboard(iter, y_te, y_te_rec, x_samps, r_nk, cluster_alloc, theta, si
             subplot.clear()
 
     if y_te.shape[1] > 2:
-        pca = PCA(n_components=2).fit(y_te)
+        if pca is None:
+            pca = PCA(n_components=2).fit(y_te)
         y_te_2d = pca.transform(y_te)
         y_te_rec_2d = pca.transform(y_te_rec)
     else:
@@ -48,7 +51,8 @@ def svae_dashboard(iter, y_te, y_te_rec, x_samps, r_nk, cluster_alloc, theta, si
     visualise_gmm.plot_clustered_data(y_te_2d, y_te_rec_2d, cluster_alloc, ax=ax[1, 1])
     ax[1, 1].set_title('Data')
 
-    plt.pause(0.001)
+    if pause:
+        plt.pause(0.001)
 
     return plt
     # print('iter=%d' % iter)